@@ -0,0 +1,29 @@
+from __future__ import absolute_import, division, print_function
+
+# LIBTBX_SET_DISPATCHER_NAME prime.build_frame_store
+
+"""
+Description : Convert cctbx.xfel integration pickles (or tar files) to a
+              memory-mapped frame store. Use the output directory as data=
+              in prime.run.
+"""
+import argparse
+from prime.postrefine.mod_input import read_pickles
+from prime.postrefine.mod_frame_store import build_frame_store
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert integration pickles to a memory-mapped frame store"
+    )
+    parser.add_argument(
+        "data",
+        nargs="+",
+        help="Integration pickles: directory, glob, list file or tar files (as data= in prime.run)",
+    )
+    parser.add_argument(
+        "-o", "--output", default="frame_store", help="Output frame store directory"
+    )
+    args = parser.parse_args()
+    frame_files = read_pickles(args.data)
+    print("Converting %d frames to %s" % (len(frame_files), args.output))
+    print(build_frame_store(frame_files, args.output))
@@ -9,6 +9,7 @@ __author__ = "Monarin Uervirojnangkoorn, monarin@gmail.com"
 
 from prime.isoform_cluster.mod_isoform_cluster import isoform_cluster_handler
 from prime.index_ambiguity.mod_kmeans import kmeans_handler
+from prime.index_ambiguity.mod_sparse_cc import calc_r_matrix
 from prime.postrefine.mod_mx import mx_handler
 from six.moves import cPickle as pickle
 from libtbx.easy_mp import pool_map
@@ -26,16 +27,6 @@ def solve_with_mtz_mproc(args):
     return pickle_filename, cluster_id
 
 
-def calculate_r_mproc(args):
-    frame_no, pickle_filename, obs_main, obs_list = args
-    isoch = isoform_cluster_handler()
-    r_set, main_obs, txt_out = isoch.calc_r(
-        frame_no, pickle_filename, obs_main, obs_list
-    )
-    print(txt_out)
-    return pickle_filename, r_set, main_obs
-
-
 def get_obs_mproc(args):
     frame_no, pickle_filename, iparams = args
     isoch = isoform_cluster_handler()
@@ -143,27 +134,14 @@ class isoform_cluster_run_handler(object):
         frame_files_sel, obs_list = self.get_observation_set(
             iparams, frame_files, iparams.isoform_cluster.n_sample_frames
         )
-        frames = [
-            (i, frame_files_sel[i], obs_list[i], obs_list)
-            for i in range(len(frame_files_sel))
-        ]
         # calculate r
         print("Calculating R")
-        calc_r_results = pool_map(
-            iterable=frames, func=calculate_r_mproc, processes=iparams.n_processors
+        r_matrix, txt_out_r = calc_r_matrix(
+            obs_list,
+            [os.path.basename(frame_file) for frame_file in frame_files_sel],
+            n_processors=iparams.n_processors,
         )
-        frame_files_sel = []
-        r_matrix = []
-        obs_list = []
-        for result in calc_r_results:
-            if result:
-                pickle_filename, r_set, obs = result
-                frame_files_sel.append(pickle_filename)
-                obs_list.append(obs)
-                if len(r_matrix) == 0:
-                    r_matrix = r_set
-                else:
-                    r_matrix = np.append(r_matrix, r_set, axis=0)
+        print(txt_out_r)
         # choose groups with best R
         print("Selecting frames with best R")
         i_mean_r = np.argsort(np.mean(r_matrix, axis=1))[::-1]
@@ -183,26 +161,13 @@ class isoform_cluster_run_handler(object):
                     print("Found all %6.0f good frames" % (len(frame_files_sel)))
                     break
         # Recalculate r for the new selected list
-        frames = [
-            (i, frame_files_sel[i], obs_sel[i], obs_sel)
-            for i in range(len(frame_files_sel))
-        ]
         print("Re-calculating R")
-        calc_r_results = pool_map(
-            iterable=frames, func=calculate_r_mproc, processes=iparams.n_processors
+        r_matrix, txt_out_r = calc_r_matrix(
+            obs_sel,
+            [os.path.basename(frame_file) for frame_file in frame_files_sel],
+            n_processors=iparams.n_processors,
         )
-        frame_files_sel = []
-        r_matrix = []
-        obs_list = []
-        for result in calc_r_results:
-            if result:
-                pickle_filename, r_set, obs = result
-                frame_files_sel.append(pickle_filename)
-                obs_list.append(obs)
-                if len(r_matrix) == 0:
-                    r_matrix = r_set
-                else:
-                    r_matrix = np.append(r_matrix, r_set, axis=0)
+        print(txt_out_r)
         print("Minimizing frame distance")
         isoch = isoform_cluster_handler()
         x_set = isoch.optimize(r_matrix, flag_plot=iparams.flag_plot)
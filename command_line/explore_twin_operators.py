@@ -2,14 +2,22 @@ from __future__ import absolute_import, division, print_function
 
 # LIBTBX_SET_DISPATCHER_NAME prime.explore_twin_operators
 
-from prime.index_ambiguity.mod_indexing_ambiguity import indamb_handler
+from prime.index_ambiguity.mod_twin_operators import (
+    TWIN_OPERATOR_CACHE_FILENAME,
+    get_twin_operator_cache,
+)
 import argparse, os
 from prime.postrefine.mod_input import read_frame, read_pickles
 import six
 
 
-def main(data, only_merohedral):
-    indambh = indamb_handler()
+def main(data, only_merohedral, run_no=None):
+    # reuse twin operators found by earlier runs
+    twin_operator_cache = get_twin_operator_cache(
+        os.path.join(run_no, "index_ambiguity", TWIN_OPERATOR_CACHE_FILENAME)
+        if run_no
+        else None
+    )
     intFileList = read_pickles([data])
     if intFileList:
         obsList = {}
@@ -26,13 +34,13 @@ def main(data, only_merohedral):
                 flag_all = False
             else:
                 flag_all = True
-            ops = indambh.generate_twin_operators(value, flag_all=flag_all)
+            ops = twin_operator_cache.get_operators(value, flag_all=flag_all)
             if ops:
                 print(
                     os.path.basename(key),
                     "%6.1f,%6.1f,%6.1f,%6.1f,%6.1f,%6.1f"
                     % value.unit_cell().parameters(),
-                    " ".join([op.operator.r().as_hkl() for op in ops]),
+                    " ".join(ops),
                 )
             else:
                 print(
@@ -60,6 +68,12 @@ if __name__ == "__main__":
         default=False,
         help="Flag for showing only merohedral twinnings",
     )
+    parser.add_argument(
+        "--run_no",
+        dest="run_no",
+        default=None,
+        help="prime run folder, twin operators are cached in its index_ambiguity folder",
+    )
     args = parser.parse_args()
     if args.only_merohedral:
         print("Only showing results with merohedral twinning operators")
@@ -67,4 +81,4 @@ if __name__ == "__main__":
         print("Showing all possible pseudo- and true-merohedral twinning operators")
     args = parser.parse_args()
 
-    main(args.integration_pickles, args.only_merohedral)
+    main(args.integration_pickles, args.only_merohedral, run_no=args.run_no)
@@ -10,16 +10,20 @@ import numpy as np
 import math
 from iotbx import reflection_file_reader
 from cctbx.array_family import flex
-from cctbx import miller
 from six.moves import cPickle as pickle
 from cctbx.crystal import symmetry
 from scitbx.matrix import sqr
 import shutil
 from libtbx.easy_mp import pool_map
 from prime.postrefine.mod_input import read_frame
+from prime.postrefine.mod_hkl import miller_index_lookup
 from six.moves import range
 
 
+# reference sets read by this process
+_reference_lookups = {}
+
+
 def read_input(args):
     from prime.postrefine.mod_input import process_input
 
@@ -185,27 +189,35 @@ def get_observations_ref(hklrefin):
     return miller_array_iso
 
 
-def calc_cc(miller_array_ref, miller_array_obs):
-    """Calculate cc between matched intensities."""
-    matches_ref = miller.match_multi_indices(
-        miller_indices_unique=miller_array_ref.indices(),
-        miller_indices=miller_array_obs.indices(),
-    )
+def get_observations_ref_lookup(hklrefin):
+    """Return ref.
 
-    I_ref = flex.double(
-        [miller_array_ref.data()[pair[0]] for pair in matches_ref.pairs()]
-    )
-    I_o = flex.double(
-        [miller_array_obs.data()[pair[1]] for pair in matches_ref.pairs()]
-    )
+    observations and their miller index lookup (read once per process).
+    """
+    if hklrefin not in _reference_lookups:
+        miller_array_ref = get_observations_ref(hklrefin)
+        _reference_lookups[hklrefin] = (
+            miller_array_ref,
+            miller_index_lookup(miller_array_ref.indices()),
+        )
+    return _reference_lookups[hklrefin]
+
+
+def calc_cc(miller_array_ref, miller_array_obs, lookup=None):
+    """Calculate cc between matched intensities."""
+    if lookup is None:
+        lookup = miller_index_lookup(miller_array_ref.indices())
+    i_ref, i_obs = lookup.lookup(miller_array_obs.indices())
+    I_ref = miller_array_ref.data().as_numpy_array()[i_ref]
+    I_o = miller_array_obs.data().as_numpy_array()[i_obs]
 
     cc = 0
     n_refl = 0
-    if len(matches_ref.pairs()) > 0:
+    if len(i_ref) > 0:
         cc = np.corrcoef(I_o, I_ref)[0, 1]
         if math.isnan(cc):
             cc = 0
-        n_refl = len(matches_ref.pairs())
+        n_refl = len(i_ref)
 
     return cc, n_refl
 
@@ -340,20 +352,32 @@ def select_best_by_cc_mproc(shot_no, cryst_id, iparams):
                             )
 
                             # calculate CCori CCEoc
-                            miller_array_ref = get_observations_ref(iparams.hklrefin)
+                            miller_array_ref, lookup_ref = get_observations_ref_lookup(
+                                iparams.hklrefin
+                            )
                             cc_eoc, n_refl_eoc = calc_cc(
-                                miller_array_ref, observations_Eoc_corrected_asu
+                                miller_array_ref,
+                                observations_Eoc_corrected_asu,
+                                lookup=lookup_ref,
                             )
                             cc_ori, n_refl_ori = calc_cc(
-                                miller_array_ref, observations_original_asu
+                                miller_array_ref,
+                                observations_original_asu,
+                                lookup=lookup_ref,
                             )
 
-                            miller_array_iso = get_observations_ref(iparams.hklisoin)
+                            miller_array_iso, lookup_iso = get_observations_ref_lookup(
+                                iparams.hklisoin
+                            )
                             cc_iso_eoc, n_refl_iso_eoc = calc_cc(
-                                miller_array_iso, observations_Eoc_corrected_asu
+                                miller_array_iso,
+                                observations_Eoc_corrected_asu,
+                                lookup=lookup_iso,
                             )
                             cc_iso_ori, n_refl_iso_ori = calc_cc(
-                                miller_array_iso, observations_original_asu
+                                miller_array_iso,
+                                observations_original_asu,
+                                lookup=lookup_iso,
                             )
                         except Exception:
                             dummy = 0
@@ -7,6 +7,10 @@ from prime.postrefine.mod_input import process_input, read_pickles
 from prime.postrefine.mod_util import intensities_scaler
 from prime.postrefine.mod_merge_data import merge_data_handler
 from prime.postrefine import postref_handler
+from prime.postrefine.mod_reference import (
+    get_reference_from_miller_array,
+    share_reference_mpi,
+)
 from cctbx.array_family import flex
 import time, math
 from six.moves import range
@@ -45,9 +49,7 @@ def master(frame_token, iparams, activity):
                 (activity, (frame_objects[i:i_end], iparams, avg_mode)), dest=rankreq
             )
     elif activity == "merge":
-        frame_objects, avg_mode = frame_token
-        its = intensities_scaler()
-        cpo = its.combine_pre_merge(frame_objects, iparams)
+        cpo, avg_mode = frame_token
         # assign at least 100k reflections at a time
         n_batch = int(1e5 / (len(cpo[1]) / cpo[0]))
         if n_batch < 1:
@@ -66,10 +68,12 @@ def master(frame_token, iparams, activity):
             batch_prep.append(cpo[13])
             batch_prep.append(cpo[14])
             batch_prep.append(cpo[15].select(sel))
+            # the frame table was broadcast to the clients
+            batch_prep.append(None)
             batch_prep.append("")
             comm.send((activity, (tuple(batch_prep), iparams, avg_mode)), dest=rankreq)
     elif activity == "postref":
-        frame_files, miller_array_ref, results, avg_mode = frame_token
+        frame_files, results, avg_mode = frame_token
         # convert results to a dict obj so that pickle_filename is the key
         pres_dict = {}
         for pres in results:
@@ -84,7 +88,6 @@ def master(frame_token, iparams, activity):
                         i,
                         frame_files[i],
                         iparams,
-                        miller_array_ref,
                         pres_dict[frame_files[i]]
                         if frame_files[i] in pres_dict
                         else None,
@@ -102,7 +105,10 @@ def master(frame_token, iparams, activity):
         comm.send("endrun", dest=rankreq)
 
 
-def client():
+def client(reference=None, frame_files=None):
+    """Process tasks from the master. reference is the (node-shared)
+    reference set for post-refinement, frame_files the frame table of the
+    merge batches."""
     result = []
     prh = postref_handler()
     while True:
@@ -114,10 +120,9 @@ def client():
         activity, act_params = msg
         if activity == "scale":
             frame_files, iparams = act_params
-            for frame_index, frame_file in enumerate(frame_files):
-                pres, _ = prh.scale_frame_by_mean_I(
-                    frame_index, frame_file, iparams, 0, "average"
-                )
+            for pres, _ in prh.scale_frames_by_mean_I(
+                list(range(len(frame_files))), frame_files, iparams, 0, "average"
+            ):
                 result.append(pres)
         elif activity == "pre_merge":
             frame_results, iparams, avg_mode = act_params
@@ -127,16 +132,16 @@ def client():
         elif activity == "merge":
             batch_prep, iparams, avg_mode = act_params
             its = intensities_scaler()
-            mdh, _, txt_out_rejection = its.calc_avg_I_cpp(
-                batch_prep, iparams, avg_mode
+            batch_prep = batch_prep[:16] + (frame_files,) + batch_prep[17:]
+            # one thread per MPI rank
+            mdh, _, reject_out = its.calc_avg_I_cpp(
+                batch_prep, iparams, avg_mode, n_threads=1
             )
-            result.append([mdh, txt_out_rejection])
+            result.append([mdh, reject_out])
         elif activity == "postref":
-            frame_no, frame_file, iparams, miller_array_ref, pres_in, avg_mode = (
-                act_params
-            )
+            frame_no, frame_file, iparams, pres_in, avg_mode = act_params
             pres, _ = prh.postrefine_by_frame(
-                frame_no, frame_file, iparams, miller_array_ref, pres_in, avg_mode
+                frame_no, frame_file, iparams, reference, pres_in, avg_mode
             )
             result.append(pres)
     return result
@@ -160,10 +165,18 @@ def merge(pres_result, iparams, txt_out_prefix, output_prefix, avg_mode):
     # merge task
     if rank == 0:
         print("Pre-merge is done on %d cores" % (len(premerge_result)))
-        master((premerge_result, avg_mode), iparams, "merge")
+        its = intensities_scaler()
+        cpo = its.combine_pre_merge(premerge_result, iparams)
+        frame_files = cpo[16]
+    else:
+        frame_files = None
+    # the frame table is sent once to each client instead of with every batch
+    frame_files = comm.bcast(frame_files, root=0)
+    if rank == 0:
+        master((cpo, avg_mode), iparams, "merge")
         merge_result = []
     else:
-        merge_result = client()
+        merge_result = client(frame_files=frame_files)
     # finalize merge
     merge_result = comm.gather(merge_result, root=0)
     comm.Barrier()
@@ -171,10 +184,10 @@ def merge(pres_result, iparams, txt_out_prefix, output_prefix, avg_mode):
         print("Merge completed on %d cores" % (len(merge_result)))
         merge_results = sum(merge_result, [])
         mdh = merge_data_handler()
-        txt_out_rejection = ""
-        for _mdh, _txt_out_rejection in merge_results:
+        reject_out_list = []
+        for _mdh, _reject_out in merge_results:
             mdh.extend(_mdh)
-            txt_out_rejection += _txt_out_rejection
+            reject_out_list.append(_reject_out)
         # selet only indices with non-Inf non-Nan stats
         selections = flex.bool(
             [
@@ -196,7 +209,11 @@ def merge(pres_result, iparams, txt_out_prefix, output_prefix, avg_mode):
         with open(os.path.join(iparams.run_no, "log.txt"), "a") as f:
             f.write(txt_out_prefix + txt_merge_mean_table)
         with open(os.path.join(iparams.run_no, "rejections.txt"), "a") as f:
-            f.write(txt_out_rejection)
+            f.write(
+                its.format_rejections(
+                    its.combine_rejections(reject_out_list), frame_files
+                )
+            )
     else:
         merge_results = None
         mdh = None
@@ -240,18 +257,22 @@ def run(argv):
         comm.Barrier()
         if i_iter == n_postref_cycle - 1:
             avg_mode = "final"
+        # the reference is sent once per node instead of with every frame
+        reference = share_reference_mpi(
+            get_reference_from_miller_array(mdh.miller_array_merge)
+            if rank == 0
+            else None,
+            comm,
+        )
         if rank == 0:
             print("Start post-refinement cycle %d" % (i_iter + 1))
-            master(
-                (frame_files, mdh.miller_array_merge, results, avg_mode),
-                iparams,
-                "postref",
-            )
+            master((frame_files, results, avg_mode), iparams, "postref")
             result = []
         else:
-            result = client()
+            result = client(reference=reference)
         result = comm.gather(result, root=0)
         comm.Barrier()
+        reference.release()
         results, mdh = merge(
             result, iparams, "", "postref_cycle_%d" % (i_iter + 1), avg_mode
         )
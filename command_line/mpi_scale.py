@@ -40,8 +40,8 @@ def master(frame_objects, iparams, activity):
             rankreq = comm.recv(source=MPI.ANY_SOURCE)
             comm.send((activity, (frame_objects[i:i_end], iparams)), dest=rankreq)
     if activity == "merge":
-        its = intensities_scaler()
-        cpo = its.combine_pre_merge(frame_objects, iparams)
+        # combined pre-merge output
+        cpo = frame_objects
         # assign at least 100k reflections at a time
         n_batch = int(1e5 / (len(cpo[1]) / cpo[0]))
         if n_batch < 1:
@@ -60,6 +60,8 @@ def master(frame_objects, iparams, activity):
             batch_prep.append(cpo[13])
             batch_prep.append(cpo[14])
             batch_prep.append(cpo[15].select(sel))
+            # the frame table was broadcast to the clients
+            batch_prep.append(None)
             batch_prep.append("")
             comm.send((activity, (tuple(batch_prep), iparams)), dest=rankreq)
     print(
@@ -71,7 +73,9 @@ def master(frame_objects, iparams, activity):
         comm.send("endrun", dest=rankreq)
 
 
-def client():
+def client(frame_files=None):
+    """Process tasks from the master (frame_files is the frame table of the
+    merge batches)."""
     result = []
     while True:
         comm.send(rank, dest=0)
@@ -85,10 +89,9 @@ def client():
             from prime.postrefine import postref_handler
 
             prh = postref_handler()
-            for frame_index, frame_file in enumerate(frame_files):
-                pres, _ = prh.scale_frame_by_mean_I(
-                    frame_index, frame_file, iparams, 0, "average"
-                )
+            for pres, _ in prh.scale_frames_by_mean_I(
+                list(range(len(frame_files))), frame_files, iparams, 0, "average"
+            ):
                 result.append(pres)
         if activity == "pre_merge":
             frame_results, iparams = act_params
@@ -98,10 +101,12 @@ def client():
         if activity == "merge":
             batch_prep, iparams = act_params
             its = intensities_scaler()
-            mdh, _, txt_out_rejection = its.calc_avg_I_cpp(
-                batch_prep, iparams, "average"
+            batch_prep = batch_prep[:16] + (frame_files,) + batch_prep[17:]
+            # one thread per MPI rank
+            mdh, _, reject_out = its.calc_avg_I_cpp(
+                batch_prep, iparams, "average", n_threads=1
             )
-            result.append([mdh, txt_out_rejection])
+            result.append([mdh, reject_out])
     return result
 
 
@@ -140,10 +145,18 @@ def run(argv):
     # merge task
     if rank == 0:
         print("Pre-merge is done on %d cores" % (len(result)))
-        master(result, iparams, "merge")
+        its = intensities_scaler()
+        cpo = its.combine_pre_merge(result, iparams)
+        frame_files = cpo[16]
+    else:
+        frame_files = None
+    # the frame table is sent once to each client instead of with every batch
+    frame_files = comm.bcast(frame_files, root=0)
+    if rank == 0:
+        master(cpo, iparams, "merge")
         result = []
     else:
-        result = client()
+        result = client(frame_files=frame_files)
     # finalize merge
     result = comm.gather(result, root=0)
     comm.Barrier()
@@ -151,10 +164,10 @@ def run(argv):
         print("Merge completed on %d cores" % (len(result)))
         results = sum(result, [])
         mdh = merge_data_handler()
-        txt_out_rejection = ""
-        for _mdh, _txt_out_rejection in results:
+        reject_out_list = []
+        for _mdh, _reject_out in results:
             mdh.extend(_mdh)
-            txt_out_rejection += _txt_out_rejection
+            reject_out_list.append(_reject_out)
         # selet only indices with non-Inf non-Nan stats
         selections = flex.bool(
             [
@@ -180,7 +193,11 @@ def run(argv):
         with open(os.path.join(iparams.run_no, "log.txt"), "w") as f:
             f.write(txt_out_input + txt_merge_mean_table + txt_time)
         with open(os.path.join(iparams.run_no, "rejections.txt"), "w") as f:
-            f.write(txt_out_rejection)
+            f.write(
+                its.format_rejections(
+                    its.combine_rejections(reject_out_list), frame_files
+                )
+            )
     MPI.Finalize()
 
 
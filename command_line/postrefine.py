@@ -12,6 +12,9 @@ from prime.command_line.solve_indexing_ambiguity import indexing_ambiguity_handl
 from prime.postrefine.mod_mx import mx_handler
 from prime.postrefine.mod_input import read_pickles
 from prime.postrefine.mod_util import intensities_scaler
+from prime.postrefine.mod_worker_pool import frame_worker_pool
+from prime.postrefine.mod_reference import get_reference_from_miller_array
+from prime.postrefine.mod_convergence import convergence_handler
 import os, sys, math
 import numpy as np
 from datetime import datetime, time
@@ -44,26 +47,35 @@ def postrefine_by_frame_mproc(args):
     from prime.postrefine import postref_handler
 
     prh = postref_handler()
-    frame_no, frame_file, iparams, miller_array_ref, pres_in, avg_mode = args
+    frame_no, frame_file, iparams, miller_array_ref, pres_in, avg_mode, skip_mode = args
     pres = prh.postrefine_by_frame(
-        frame_no, frame_file, iparams, miller_array_ref, pres_in, avg_mode
+        frame_no,
+        frame_file,
+        iparams,
+        miller_array_ref,
+        pres_in,
+        avg_mode,
+        skip_mode=skip_mode,
     )
     return pres
 
 
-def scale_frames(frames, frame_files, iparams):
+def scale_frames(frames, frame_files, iparams, pool=None):
     """scale frames."""
     avg_mode = "average"
     if iparams.flag_apply_b_by_frame:
         mean_of_mean_I = 0
     else:
         # Calculate <I> for each frame
-        frame_args = [(frame_file, iparams, avg_mode) for frame_file in frame_files]
-        determine_mean_I_result = parallel_map(
-            iterable=frame_args,
-            func=determine_mean_I_mproc,
-            processes=iparams.n_processors,
-        )
+        if pool is not None:
+            determine_mean_I_result = pool.calc_mean_intensity(iparams, avg_mode)
+        else:
+            frame_args = [(frame_file, iparams, avg_mode) for frame_file in frame_files]
+            determine_mean_I_result = parallel_map(
+                iterable=frame_args,
+                func=determine_mean_I_mproc,
+                processes=iparams.n_processors,
+            )
         frames_mean_I = flex.double()
         for result in determine_mean_I_result:
             if result is not None:
@@ -72,15 +84,20 @@ def scale_frames(frames, frame_files, iparams):
                     frames_mean_I.append(mean_I)
         mean_of_mean_I = np.median(frames_mean_I)
     # use the calculate <mean_I> to scale each frame
-    frame_args = [
-        (frame_no, frame_file, iparams, mean_of_mean_I, avg_mode)
-        for frame_no, frame_file in zip(frames, frame_files)
-    ]
-    scale_frame_by_mean_I_result = parallel_map(
-        iterable=frame_args,
-        func=scale_frame_by_mean_I_mproc,
-        processes=iparams.n_processors,
-    )
+    if pool is not None:
+        scale_frame_by_mean_I_result = pool.scale_frame_by_mean_I(
+            iparams, mean_of_mean_I, avg_mode
+        )
+    else:
+        frame_args = [
+            (frame_no, frame_file, iparams, mean_of_mean_I, avg_mode)
+            for frame_no, frame_file in zip(frames, frame_files)
+        ]
+        scale_frame_by_mean_I_result = parallel_map(
+            iterable=frame_args,
+            func=scale_frame_by_mean_I_mproc,
+            processes=iparams.n_processors,
+        )
     observations_merge_mean_set = []
     for result in scale_frame_by_mean_I_result:
         if result is not None:
@@ -97,9 +114,7 @@ def merge_frames(pres_set, iparams, avg_mode="average", mtz_out_prefix="mean_sca
     if pres_set:
         prep_output = intscal.prepare_output(pres_set, iparams, avg_mode)
         if prep_output:
-            mdh, _, txt_out_rejection = intscal.calc_avg_I_cpp(
-                prep_output, iparams, avg_mode
-            )
+            mdh, _, reject_out = intscal.calc_avg_I_cpp(prep_output, iparams, avg_mode)
             # select only indices with non-Inf non-Nan stats
             selections = flex.bool(
                 [
@@ -117,14 +132,7 @@ def merge_frames(pres_set, iparams, avg_mode="average", mtz_out_prefix="mean_sca
             mdh.reduce_by_selection(selections)
 
             # handle rejected reflections
-            rejections = {}
-            for reject in txt_out_rejection.split("\n"):
-                data = reject.split()
-                if data:
-                    if not data[0] in rejections:
-                        rejections[data[0]] = flex.miller_index()
-                    rejections[data[0]].append(tuple([int(_d) for _d in data[1:4]]))
-
+            rejections = intscal.get_rejection_keys(reject_out, prep_output[16])
             if len(rejections) > 0:
                 if not iparams.rejections:
                     iparams.rejections = {}
@@ -141,24 +149,89 @@ def merge_frames(pres_set, iparams, avg_mode="average", mtz_out_prefix="mean_sca
 
 
 def postrefine_frames(
-    i_iter, frames, frame_files, iparams, pres_set, miller_array_ref, avg_mode
+    i_iter,
+    frames,
+    frame_files,
+    iparams,
+    pres_set,
+    miller_array_ref,
+    avg_mode,
+    pool=None,
+    skip_modes=None,
 ):
-    """postrefine given frames and previous postrefinement results."""
-    miller_array_ref = miller_array_ref.generate_bijvoet_mates()
+    """postrefine given frames and previous postrefinement results (kept by
+    the workers if pool is given). Frames with a skip mode (see
+    mod_convergence) keep their previous results."""
+    if skip_modes is None:
+        skip_modes = [None] * len(frame_files)
+    # the reference is published once per cycle, tasks carry only its name
+    reference = get_reference_from_miller_array(
+        miller_array_ref.generate_bijvoet_mates()
+    ).publish()
     txt_merge_postref = (
         "Post-refinement cycle " + str(i_iter + 1) + " (" + avg_mode + ")\n"
     )
     txt_merge_postref += " * R and CC show percent change.\n"
+    n_reuse = skip_modes.count("reuse")
+    n_refresh = skip_modes.count("refresh")
+    if n_reuse or n_refresh:
+        txt_merge_postref += (
+            " * %d frames skipped (converged), %d with partialities recomputed.\n"
+            % (n_reuse + n_refresh, n_refresh)
+        )
     print(txt_merge_postref)
-    frame_args = [
-        (frame_no, frame_file, iparams, miller_array_ref, pres_in, avg_mode)
-        for frame_no, frame_file, pres_in in zip(frames, frame_files, pres_set)
-    ]
-    postrefine_by_frame_result = parallel_map(
-        iterable=frame_args,
-        func=postrefine_by_frame_mproc,
-        processes=iparams.n_processors,
-    )
+    try:
+        if pool is not None:
+            postrefine_by_frame_result = pool.postrefine_by_frame(
+                iparams,
+                reference,
+                avg_mode,
+                skip_modes=dict(
+                    (frame_no, skip_mode)
+                    for frame_no, skip_mode in zip(frames, skip_modes)
+                    if skip_mode is not None
+                ),
+            )
+        else:
+            from prime.postrefine import postref_handler
+
+            prh = postref_handler()
+            postrefine_by_frame_result = [None] * len(frame_files)
+            frame_args = []
+            i_frame_args = []
+            for i_frame, (frame_no, frame_file, pres_in, skip_mode) in enumerate(
+                zip(frames, frame_files, pres_set, skip_modes)
+            ):
+                if skip_mode == "reuse":
+                    # nothing to compute
+                    postrefine_by_frame_result[i_frame] = prh.reuse_postrefine_frame(
+                        frame_file, pres_in
+                    )
+                    continue
+                frame_args.append(
+                    (
+                        frame_no,
+                        frame_file,
+                        iparams,
+                        reference,
+                        pres_in,
+                        avg_mode,
+                        skip_mode,
+                    )
+                )
+                i_frame_args.append(i_frame)
+            if frame_args:
+                for i_frame, result in zip(
+                    i_frame_args,
+                    parallel_map(
+                        iterable=frame_args,
+                        func=postrefine_by_frame_mproc,
+                        processes=iparams.n_processors,
+                    ),
+                ):
+                    postrefine_by_frame_result[i_frame] = result
+    finally:
+        reference.release()
     postrefine_by_frame_good = []
     postrefine_by_frame_pres_list = []
     for results in postrefine_by_frame_result:
@@ -210,58 +283,89 @@ def run(argv):
     # 0.3 read frames
     frame_files = read_pickles(iparams.data)
     frames = range(len(frame_files))
-    # 1. prepare reference miller array
-    txt_merge_mean = "Generating a reference set (will not be used if hklrefin is set)"
-    print(txt_merge_mean)
-    # Always generate the mean-intensity scaled set.
-    scaled_pres_set = scale_frames(frames, frame_files, iparams)
-    mdh, _txt_merge_mean = merge_frames(scaled_pres_set, iparams)
-    miller_array_ref = mdh.miller_array_merge
-    txt_merge_mean += "\n" + _txt_merge_mean
-    if not iparams.n_postref_cycle:
-        with open(iparams.run_no + "/log.txt", "a") as f:
-            f.write(txt_indexing_ambiguity + txt_merge_mean)
-        raise Usage(
-            "No. of post-refinement cycle was set to 0. Exit without post-refinement."
-        )
-    if iparams.hklrefin is not None:
-        mxh = mx_handler()
-        _, miller_array_ref = mxh.get_miller_array_from_reflection_file(
-            iparams.hklrefin
-        )
-    if miller_array_ref is None:
-        raise Usage(
-            "Problem with the assigned reference set. Try setting hklrefin=None and rerun the program."
+    pool = None
+    if iparams.flag_worker_pool:
+        pool = frame_worker_pool(frames, frame_files, iparams.n_processors)
+    try:
+        # 1. prepare reference miller array
+        txt_merge_mean = (
+            "Generating a reference set (will not be used if hklrefin is set)"
         )
-    # 2. Post-refinement
-    txt_merge_postref = ""
-    postref_pres_set = [None] * len(frames)
-    avg_mode = "weighted"
-    for i_iter in range(iparams.n_postref_cycle):
-        if i_iter == (iparams.n_postref_cycle - 1):
-            avg_mode = "final"
-        postref_good_pres_set, postref_pres_set, _txt_merge_postref = postrefine_frames(
-            i_iter,
-            frames,
-            frame_files,
-            iparams,
-            postref_pres_set,
-            miller_array_ref,
-            avg_mode,
-        )
-        if postref_good_pres_set:
-            mdh, _txt_merge_postref = merge_frames(
-                postref_good_pres_set,
-                iparams,
-                avg_mode=avg_mode,
-                mtz_out_prefix="postref_cycle_" + str(i_iter + 1),
+        print(txt_merge_mean)
+        # Always generate the mean-intensity scaled set.
+        scaled_pres_set = scale_frames(frames, frame_files, iparams, pool=pool)
+        mdh, _txt_merge_mean = merge_frames(scaled_pres_set, iparams)
+        miller_array_ref = mdh.miller_array_merge
+        txt_merge_mean += "\n" + _txt_merge_mean
+        if not iparams.n_postref_cycle:
+            with open(iparams.run_no + "/log.txt", "a") as f:
+                f.write(txt_indexing_ambiguity + txt_merge_mean)
+            raise Usage(
+                "No. of post-refinement cycle was set to 0. Exit without post-refinement."
             )
-            miller_array_ref = mdh.miller_array_merge
-            txt_merge_postref += _txt_merge_postref
-        else:
+        if iparams.hklrefin is not None:
+            mxh = mx_handler()
+            _, miller_array_ref = mxh.get_miller_array_from_reflection_file(
+                iparams.hklrefin
+            )
+        if miller_array_ref is None:
             raise Usage(
-                "Problem with post-refinement. No images refined. Please check your input file."
+                "Problem with the assigned reference set. Try setting hklrefin=None and rerun the program."
+            )
+        # 2. Post-refinement
+        txt_merge_postref = ""
+        postref_pres_set = [None] * len(frames)
+        avg_mode = "weighted"
+        convh = None
+        if iparams.postref.skip_converged.flag_on:
+            convh = convergence_handler(iparams)
+        for i_iter in range(iparams.n_postref_cycle):
+            if i_iter == (iparams.n_postref_cycle - 1):
+                avg_mode = "final"
+            skip_modes = None
+            if convh is not None:
+                convh.set_reference(i_iter, miller_array_ref)
+                skip_modes = convh.get_skip_modes(
+                    i_iter, postref_pres_set, frame_files, avg_mode
+                )
+            postref_pres_set_prev = postref_pres_set
+            postref_good_pres_set, postref_pres_set, _txt_merge_postref = postrefine_frames(
+                i_iter,
+                frames,
+                frame_files,
+                iparams,
+                postref_pres_set,
+                miller_array_ref,
+                avg_mode,
+                pool=pool,
+                skip_modes=skip_modes,
             )
+            if convh is not None:
+                # before merging, which updates the rejections
+                convh.update(
+                    i_iter,
+                    postref_pres_set_prev,
+                    postref_pres_set,
+                    frame_files,
+                    skip_modes,
+                    avg_mode,
+                )
+            if postref_good_pres_set:
+                mdh, _txt_merge_postref = merge_frames(
+                    postref_good_pres_set,
+                    iparams,
+                    avg_mode=avg_mode,
+                    mtz_out_prefix="postref_cycle_" + str(i_iter + 1),
+                )
+                miller_array_ref = mdh.miller_array_merge
+                txt_merge_postref += _txt_merge_postref
+            else:
+                raise Usage(
+                    "Problem with post-refinement. No images refined. Please check your input file."
+                )
+    finally:
+        if pool is not None:
+            pool.close()
     # 3. collect caculating time
     time_global_end = datetime.now()
     time_global_spent = time_global_end - time_global_start
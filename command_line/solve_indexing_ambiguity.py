@@ -9,8 +9,11 @@ from libtbx.easy_mp import parallel_map
 from prime.index_ambiguity.mod_indexing_ambiguity import indamb_handler
 from six.moves import cPickle as pickle
 from prime.index_ambiguity.mod_kmeans import kmeans_handler
+from prime.index_ambiguity.mod_sparse_cc import calc_r_matrix
+from prime.index_ambiguity.mod_twin_operators import get_twin_operator_cache
 from prime.postrefine.mod_mx import mx_handler
-import random
+from prime.postrefine.mod_reference import get_reference_from_miller_array
+import random, os
 from six.moves import range
 from six.moves import zip
 
@@ -25,14 +28,20 @@ def solve_with_mtz_mproc(args):
     return pickle_filename, index_basis
 
 
-def calculate_r_mproc(args):
-    frame_no, pickle_filename, index_basis, obs_main, obs_list = args
-    idah = indamb_handler()
-    r_set, txt_out = idah.calc_r(
-        frame_no, pickle_filename, index_basis, obs_main, obs_list
-    )
-    print(txt_out)
-    return pickle_filename, index_basis, r_set
+def solve_with_reference(frame_files, iparams, miller_array_ref):
+    """Return index basis of each frame from its CC with the reference (the
+    reference is published once to shared memory for all frames)."""
+    reference = get_reference_from_miller_array(miller_array_ref).publish()
+    try:
+        frames = [
+            (i, frame_files[i], iparams, reference) for i in range(len(frame_files))
+        ]
+        cc_results = parallel_map(
+            iterable=frames, func=solve_with_mtz_mproc, processes=iparams.n_processors
+        )
+    finally:
+        reference.release()
+    return cc_results
 
 
 def get_obs_mproc(args):
@@ -45,15 +54,50 @@ def get_obs_mproc(args):
 class indexing_ambiguity_handler(object):
     def __init__(self):
         """Intialize parameters."""
+        # reindexed alternates of each frame read in this solve
+        self.alt_dict_cache = {}
+
+    def get_alt_dicts(self, frame_files, iparams):
+        """Return {frame: alternates} of frame_files, reading and
+        reindexing only frames that are not in the cache."""
+        frames = [
+            (i, frame_file, iparams)
+            for i, frame_file in enumerate(frame_files)
+            if frame_file not in self.alt_dict_cache
+        ]
+        if frames:
+            alt_dict_results = parallel_map(
+                iterable=frames, func=get_obs_mproc, processes=iparams.n_processors
+            )
+            for alt_dict, pickle_filename in alt_dict_results:
+                self.alt_dict_cache[pickle_filename] = alt_dict
+        return dict(
+            (frame_file, self.alt_dict_cache[frame_file]) for frame_file in frame_files
+        )
+
+    def get_observation_list(self, frame_files, iparams):
+        """Return frame file, basis and observations of each alternate of
+        frame_files."""
+        alt_dicts = self.get_alt_dicts(frame_files, iparams)
+        frame_dup_files = []
+        frame_keys = []
+        obs_list = []
+        for pickle_filename in frame_files:
+            alt_dict = alt_dicts[pickle_filename]
+            if alt_dict is not None:
+                for key in alt_dict.keys():
+                    frame_dup_files.append(pickle_filename)
+                    frame_keys.append(key)
+                    obs_list.append(alt_dict[key])
+        return frame_dup_files, frame_keys, obs_list
 
     def get_twin_operators(self, obs):
-        idah = indamb_handler()
-        return idah.generate_twin_operators(obs_in)
+        """Return twin operators of obs as hkl strings."""
+        return get_twin_operator_cache().get_operators(obs)
 
     def should_terminate(self, iparams, pickle_filename):
         # if no indexing ambiguity problem detected and mode is not set to "Forced"
-        idah = indamb_handler()
-        alt_dict = idah.get_observations(pickle_filename, iparams)
+        alt_dict = self.get_alt_dicts([pickle_filename], iparams)[pickle_filename]
         if len(alt_dict) == 1 and iparams.indexing_ambiguity.mode != "Forced":
             return True
         if (
@@ -111,14 +155,8 @@ class indexing_ambiguity_handler(object):
                     )
                     return None, iparams
                 else:
-                    frames = [
-                        (i, frame_files[i], iparams, miller_array_ref)
-                        for i in range(n_frames)
-                    ]
-                    cc_results = parallel_map(
-                        iterable=frames,
-                        func=solve_with_mtz_mproc,
-                        processes=iparams.n_processors,
+                    cc_results = solve_with_reference(
+                        frame_files, iparams, miller_array_ref
                     )
                     sol_pickle = {}
                     for result in cc_results:
@@ -128,48 +166,28 @@ class indexing_ambiguity_handler(object):
                     return sol_pickle, iparams
         # *************************************************
         # solve with Brehm & Diederichs - sample size n_sample_frames then bootstrap the rest
-        frames = [
-            (i, frame_files[i], iparams)
+        frame_files_sample = [
+            frame_files[i]
             for i in random.sample(
                 range(n_frames), iparams.indexing_ambiguity.n_sample_frames
             )
         ]
         # get observations list
         print("Reading observations")
-        alt_dict_results = parallel_map(
-            iterable=frames, func=get_obs_mproc, processes=iparams.n_processors
+        frame_dup_files, frame_keys, obs_list = self.get_observation_list(
+            frame_files_sample, iparams
         )
-        frame_dup_files = []
-        frame_keys = []
-        obs_list = []
-        for result in alt_dict_results:
-            alt_dict, pickle_filename = result
-            if alt_dict is not None:
-                for key in alt_dict.keys():
-                    frame_dup_files.append(pickle_filename)
-                    frame_keys.append(key)
-                    obs_list.append(alt_dict[key])
-        frames = [
-            (i, frame_dup_files[i], frame_keys[i], obs_list[i], obs_list)
-            for i in range(len(frame_dup_files))
-        ]
         # calculate r
         print("Calculating R")
-        calc_r_results = parallel_map(
-            iterable=frames, func=calculate_r_mproc, processes=iparams.n_processors
+        r_matrix, txt_out = calc_r_matrix(
+            obs_list,
+            [
+                os.path.basename(frame_file) + " " + frame_key
+                for frame_file, frame_key in zip(frame_dup_files, frame_keys)
+            ],
+            n_processors=iparams.n_processors,
         )
-        frame_dup_files = []
-        frame_keys = []
-        r_matrix = []
-        for result in calc_r_results:
-            if result is not None:
-                pickle_filename, index_basis, r_set = result
-                frame_dup_files.append(pickle_filename)
-                frame_keys.append(index_basis)
-                if len(r_matrix) == 0:
-                    r_matrix = r_set
-                else:
-                    r_matrix = np.append(r_matrix, r_set, axis=0)
+        print(txt_out)
         # choose groups with best CC
         print("Selecting frames with best R")
         i_mean_r = np.argsort(np.mean(r_matrix, axis=1))[::-1]
@@ -191,46 +209,21 @@ class indexing_ambiguity_handler(object):
                     break
         ##
         # rebuild observations and r_matrix
-        frames = [
-            (i, frame_dup_files_sel[i], iparams)
-            for i in range(len(frame_dup_files_sel))
-        ]
-        # get observations list
-        print("Re-reading observations")
-        alt_dict_results = parallel_map(
-            iterable=frames, func=get_obs_mproc, processes=iparams.n_processors
+        # get observations list (cached from the sampling pass)
+        frame_dup_files, frame_keys, obs_list = self.get_observation_list(
+            frame_dup_files_sel, iparams
         )
-        frame_dup_files = []
-        frame_keys = []
-        obs_list = []
-        for result in alt_dict_results:
-            alt_dict, pickle_filename = result
-            if alt_dict is not None:
-                for key in alt_dict.keys():
-                    frame_dup_files.append(pickle_filename)
-                    frame_keys.append(key)
-                    obs_list.append(alt_dict[key])
-        frames = [
-            (i, frame_dup_files[i], frame_keys[i], obs_list[i], obs_list)
-            for i in range(len(frame_dup_files))
-        ]
         # calculate r
         print("Re-calculating R")
-        calc_r_results = parallel_map(
-            iterable=frames, func=calculate_r_mproc, processes=iparams.n_processors
+        r_matrix, txt_out = calc_r_matrix(
+            obs_list,
+            [
+                os.path.basename(frame_file) + " " + frame_key
+                for frame_file, frame_key in zip(frame_dup_files, frame_keys)
+            ],
+            n_processors=iparams.n_processors,
         )
-        frame_dup_files = []
-        frame_keys = []
-        r_matrix = []
-        for result in calc_r_results:
-            if result is not None:
-                pickle_filename, index_basis, r_set = result
-                frame_dup_files.append(pickle_filename)
-                frame_keys.append(index_basis)
-                if len(r_matrix) == 0:
-                    r_matrix = r_set
-                else:
-                    r_matrix = np.append(r_matrix, r_set, axis=0)
+        print(txt_out)
         print("Minimizing frame distance")
         idah = indamb_handler()
         x_set = idah.optimize(r_matrix, flag_plot=iparams.flag_plot)
@@ -243,7 +236,8 @@ class indexing_ambiguity_handler(object):
         pickle.dump(x_pickle, open(iparams.run_no + "/index_ambiguity/x.out", "wb"))
         print("Clustering results")
         kmh = kmeans_handler()
-        k = 2 ** (len(idah.get_observations(frame_dup_files[0], iparams)) - 1)
+        alt_dict = self.get_alt_dicts(frame_dup_files[:1], iparams)[frame_dup_files[0]]
+        k = 2 ** (len(alt_dict) - 1)
         centroids, labels = kmh.run(x_set, k, flag_plot=iparams.flag_plot)
         print("Get solution pickle")
         sample_fname = iparams.run_no + "/index_ambiguity/sample.lst"
@@ -274,14 +268,8 @@ class indexing_ambiguity_handler(object):
             frame_files_remain = [
                 frame for frame in frame_files if frame not in sol_pickle
             ]
-            frames = [
-                (i, frame_files_remain[i], iparams, miller_array_ref)
-                for i in range(len(frame_files_remain))
-            ]
-            cc_results = parallel_map(
-                iterable=frames,
-                func=solve_with_mtz_mproc,
-                processes=iparams.n_processors,
+            cc_results = solve_with_reference(
+                frame_files_remain, iparams, miller_array_ref
             )
             for result in cc_results:
                 pickle_filename, index_basis = result
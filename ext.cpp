@@ -7,15 +7,20 @@
 #include <boost/python/class.hpp>
 #include <scitbx/array_family/flex_types.h>
 #include <scitbx/array_family/shared.h>
-#include <scitbx/math/basic_statistics.h>
 #include <cctbx/miller.h>
 #include <cctbx/uctbx.h>
+#include <omptbx/omp_or_stubs.h>
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
+#include <vector>
 
 /*
 
 This file contains an implmentation of calc_avg_I from
 postrefine/mod_util.py, which averages observed intensities,
-does outlier rejection and computes various statistics.
+does outlier rejection and computes various statistics, and a fused
+partiality kernel for postrefine/mod_partiality.py.
 
 */
 
@@ -50,7 +55,35 @@ namespace prime {
     scitbx::af::shared<double> I_avg_even_l;
     scitbx::af::shared<double> I_avg_odd_l;
     std::string txt_obs_out;
-    std::string txt_reject_out;
+    // rejected observations: frame id, original miller index, I and sigI
+    scitbx::af::shared<int> reject_frame_id;
+    shared_miller reject_miller_index_ori;
+    scitbx::af::shared<double> reject_I;
+    scitbx::af::shared<double> reject_sigI;
+
+    void extend(const average_result_store& other) {
+      miller_index.extend(other.miller_index.begin(), other.miller_index.end());
+      I_avg.extend(other.I_avg.begin(), other.I_avg.end());
+      sigI_avg.extend(other.sigI_avg.begin(), other.sigI_avg.end());
+      r_meas_w_top.extend(other.r_meas_w_top.begin(), other.r_meas_w_top.end());
+      r_meas_w_btm.extend(other.r_meas_w_btm.begin(), other.r_meas_w_btm.end());
+      r_meas_top.extend(other.r_meas_top.begin(), other.r_meas_top.end());
+      r_meas_btm.extend(other.r_meas_btm.begin(), other.r_meas_btm.end());
+      multiplicity.extend(other.multiplicity.begin(), other.multiplicity.end());
+      I_avg_even.extend(other.I_avg_even.begin(), other.I_avg_even.end());
+      I_avg_odd.extend(other.I_avg_odd.begin(), other.I_avg_odd.end());
+      I_avg_even_h.extend(other.I_avg_even_h.begin(), other.I_avg_even_h.end());
+      I_avg_odd_h.extend(other.I_avg_odd_h.begin(), other.I_avg_odd_h.end());
+      I_avg_even_k.extend(other.I_avg_even_k.begin(), other.I_avg_even_k.end());
+      I_avg_odd_k.extend(other.I_avg_odd_k.begin(), other.I_avg_odd_k.end());
+      I_avg_even_l.extend(other.I_avg_even_l.begin(), other.I_avg_even_l.end());
+      I_avg_odd_l.extend(other.I_avg_odd_l.begin(), other.I_avg_odd_l.end());
+      txt_obs_out += other.txt_obs_out;
+      reject_frame_id.extend(other.reject_frame_id.begin(), other.reject_frame_id.end());
+      reject_miller_index_ori.extend(other.reject_miller_index_ori.begin(), other.reject_miller_index_ori.end());
+      reject_I.extend(other.reject_I.begin(), other.reject_I.end());
+      reject_sigI.extend(other.reject_sigI.begin(), other.reject_sigI.end());
+    }
   };
 
   class averaging_engine {
@@ -68,13 +101,15 @@ namespace prime {
     const scitbx::af::shared<double> wavelength_set_;
     const scitbx::af::shared<double> sin_theta_over_lambda_sq_;
     const scitbx::af::shared<double> SE_;
-    const scitbx::af::shared<std::string> pickle_filename_set_;
+    const scitbx::af::shared<int> frame_id_set_;
+    const scitbx::af::shared<std::string> frame_files_;
     public:
     Average_Mode avg_mode_;
     double sigma_max_;
     bool flag_volume_correction_;
     int n_rejection_cycle_;
     bool flag_output_verbose_;
+    int n_threads_;
 
     public: averaging_engine(
       // main constructor, used for passing in arrays. other parmaters exposed
@@ -92,7 +127,8 @@ namespace prime {
       const scitbx::af::shared<double>& wavelength_set,
       const scitbx::af::shared<double>& sin_theta_over_lambda_sq,
       const scitbx::af::shared<double>& SE,
-      const scitbx::af::shared<std::string>& pickle_filename_set
+      const scitbx::af::shared<int>& frame_id_set,
+      const scitbx::af::shared<std::string>& frame_files
       ):
         group_no_(group_no),
         group_id_list_(group_id_list),
@@ -103,18 +139,20 @@ namespace prime {
         wavelength_set_(wavelength_set),
         sin_theta_over_lambda_sq_(sin_theta_over_lambda_sq),
         SE_(SE),
-        pickle_filename_set_(pickle_filename_set)
+        frame_id_set_(frame_id_set),
+        frame_files_(frame_files)
     {
       avg_mode_ = Average;
       sigma_max_ = 99.0;
       flag_volume_correction_ = true;
       n_rejection_cycle_ = 1;
       flag_output_verbose_ = false;
+      n_threads_ = 1;
     }
 
     void calc_avg_two_halves(
-      const scitbx::af::shared<double>& I_full_group,
-      const scitbx::af::shared<double>& SE_norm,
+      const std::vector<double>& I_full_group,
+      const std::vector<double>& SE_norm,
       const Average_Mode& avg_mode_,
       double& I_avg_even,
       double& I_avg_odd
@@ -181,10 +219,6 @@ namespace prime {
       (ascending) and that sort order applied to G, B, etc.
       */
 
-      average_result_store results;
-      std::ostringstream txt_obs_out;
-      std::ostringstream txt_reject_out;
-
       // convert to the full intensity and calculate mosaic spread (currently only logged)
       scitbx::af::shared<double> I_full;
       scitbx::af::shared<double> sigI_full;
@@ -207,167 +241,199 @@ namespace prime {
           sigI_full[x] *= (4.0/3.0) * (rs_set_[x]);
         }
 
-      // Iterate over each group of intensites. They will match a single miller_index each
-      int obs_ptr = 0; // this will track along the intensites array as each group is processed
+      // find the first observation of each group
+      std::vector<int> group_start(group_no_ + 1);
+      int obs_ptr = 0;
       for (int g = 0; g < group_no_; g++) {
+        SCITBX_ASSERT(obs_ptr < I_.size());
         SCITBX_ASSERT(group_id_list_[obs_ptr] == g); // this verifies that group_id_list is sorted
+        group_start[g] = obs_ptr;
+        while (obs_ptr < I_.size() && group_id_list_[obs_ptr] == g)
+          obs_ptr++;
+      }
+      group_start[group_no_] = obs_ptr;
+
+      // Groups are independent. Split them into contiguous chunks with about
+      // the same no. of observations, average each chunk in its own thread
+      // and concatenate the chunk results in group order.
+      int n_chunks = std::max(1, std::min(n_threads_, group_no_));
+      std::vector<int> chunk_start(n_chunks + 1);
+      chunk_start[0] = 0;
+      for (int c = 1; c < n_chunks; c++) {
+        int obs_target = int((double(obs_ptr) * c) / n_chunks);
+        chunk_start[c] = std::lower_bound(group_start.begin(),
+          group_start.begin() + group_no_, obs_target) - group_start.begin();
+        chunk_start[c] = std::max(chunk_start[c], chunk_start[c-1]);
+      }
+      chunk_start[n_chunks] = group_no_;
+      std::vector<average_result_store> chunk_results(n_chunks);
+      std::vector<std::string> chunk_errors(n_chunks);
+      #pragma omp parallel for schedule(static, 1) num_threads(n_chunks)
+      for (int c = 0; c < n_chunks; c++) {
+        // exceptions must not leave the parallel region
+        try {
+          average_groups(chunk_start[c], chunk_start[c+1], group_start,
+            I_full, sigI_full, mosaic_radian_set, chunk_results[c]);
+        }
+        catch (std::exception const& e) {
+          chunk_errors[c] = e.what();
+        }
+      }
+      for (int c = 0; c < n_chunks; c++) {
+        if (!chunk_errors[c].empty())
+          throw std::runtime_error(chunk_errors[c]);
+      }
+      average_result_store results;
+      for (int c = 0; c < n_chunks; c++)
+        results.extend(chunk_results[c]);
 
-        int obs_ptr_start = obs_ptr;
-
-        // gather intensites and errors for this group
-        double max_w = CONST_SE_MAX_WEIGHT;
-        double min_w = std::sqrt(CONST_SE_MIN_WEIGHT);
-        scitbx::af::shared<double> I_group;
-        scitbx::af::shared<double> sigI_group;
-        scitbx::af::shared<double> I_full_group;
-        scitbx::af::shared<double> sigI_full_group;
-        scitbx::af::shared<double> SE_group;
-        cctbx::miller::index<int> current_index;
-        shared_miller current_index_ori;
-        scitbx::af::shared<std::string>pickle_filename_set_group;
-        std::ostringstream txt_reject_out_group;
-
-        scitbx::af::shared<int> valid_ptrs;
-
-        bool found_one = false;
-        while (obs_ptr < I_.size()) {
-          if (group_id_list_[obs_ptr] != g) {
-            break; // found them all
-          }
+      return results;
+    }
 
-          if (found_one) {
-            SCITBX_ASSERT(current_index == miller_index_[obs_ptr]);
-          }
-          else {
-            found_one = true;
-            current_index = miller_index_[obs_ptr];
-          }
-          I_group.push_back(I_[obs_ptr]);
-          sigI_group.push_back(sigI_[obs_ptr]);
-          I_full_group.push_back(I_full[obs_ptr]);
-          sigI_full_group.push_back(sigI_full[obs_ptr]);
-          SE_group.push_back(SE_[obs_ptr]);
-          current_index_ori.push_back(miller_index_ori_[obs_ptr]);
-          pickle_filename_set_group.push_back(pickle_filename_set_[obs_ptr]);
-          valid_ptrs.push_back(obs_ptr);
-          obs_ptr++;
+    static double median_in_place(std::vector<double>& values) {
+      // median by partial sorting, values are reordered
+      std::size_t n = values.size();
+      std::size_t n_half = n / 2;
+      std::nth_element(values.begin(), values.begin() + n_half, values.end());
+      double median = values[n_half];
+      if (n % 2 == 0)
+        median = (median + *std::max_element(values.begin(), values.begin() + n_half)) / 2;
+      return median;
+    }
+
+    void average_groups(
+      // average groups g_start to g_end-1 and append to results
+      int g_start,
+      int g_end,
+      const std::vector<int>& group_start,
+      const scitbx::af::shared<double>& I_full,
+      const scitbx::af::shared<double>& sigI_full,
+      const scitbx::af::shared<double>& mosaic_radian_set,
+      average_result_store& results)
+    {
+      // All per-group work is done on positions of the observations in the
+      // input arrays (obs_ids). The buffers below are reused by all groups.
+      std::vector<int> obs_ids;
+      std::vector<double> I_work;
+      std::vector<double> I_full_group;
+      std::vector<double> SE_norm;
+      std::vector<double> I_full_axis;
+      std::vector<double> SE_norm_axis;
+      std::ostringstream txt_obs_out;
+      std::ostringstream txt_reject_out_group;
+      char buf[512];
+      const double max_w = CONST_SE_MAX_WEIGHT;
+      const double min_w = std::sqrt(CONST_SE_MIN_WEIGHT);
+
+      for (int g = g_start; g < g_end; g++) {
+        int obs_ptr_start = group_start[g];
+        int obs_ptr_end = group_start[g+1];
+        std::size_t n_reject_start = results.reject_frame_id.size();
+        cctbx::miller::index<int> current_index = miller_index_[obs_ptr_start];
+        obs_ids.clear();
+        for (int obs_ptr = obs_ptr_start; obs_ptr < obs_ptr_end; obs_ptr++) {
+          SCITBX_ASSERT(current_index == miller_index_[obs_ptr]);
+          obs_ids.push_back(obs_ptr);
+        }
+        if (flag_output_verbose_) {
+          txt_reject_out_group.str("");
+          I_work.assign(I_full.begin() + obs_ptr_start, I_full.begin() + obs_ptr_end);
+          double mean_I, std_I;
+          calc_mean_std(I_work, mean_I, std_I);
+          double median_I = median_in_place(I_work);
+          sprintf(buf, "Reflection: %d,%d,%d\nmeanI    medI  sigI_est sigI_true delta_sigI   n_refl\n",current_index[0],current_index[1],current_index[2]);
+          txt_obs_out << buf;
+          sprintf(buf, "%6.2f %6.2f %8.2f %8.0f\n", mean_I, median_I, std_I, double(obs_ids.size()));
+          txt_obs_out << buf;
         }
-        SCITBX_ASSERT(found_one);
-
-        // log
-        char buf[512];
-        sprintf(buf, "Reflection: %d,%d,%d\nmeanI    medI  sigI_est sigI_true delta_sigI   n_refl\n",current_index[0],current_index[1],current_index[2]);
-        txt_obs_out << buf;
-        scitbx::af::shared<double> I_full_group_copy;
-        for (int i = 0; i < I_full_group.size(); i++)
-          I_full_group_copy.push_back(I_full_group[i]);
-        scitbx::math::basic_statistics<double> basic_stat(I_full_group_copy.const_ref());
-        scitbx::math::median_functor mf;
-
-        double median_I = mf(I_full_group_copy.ref());
-        double mean_I = basic_stat.mean;
-        double std_I = 0;
-        //if (I_full_group.size() > 1)
-        std_I = basic_stat.biased_standard_deviation; // based on what I think numpy is doing compared to basic_statistics
-
-        sprintf(buf, "%6.2f %6.2f %8.2f %8.0f\n", mean_I, median_I, std_I, double(I_full_group.size()));
-        txt_obs_out << buf;
 
         //reject outliers
-        if (I_full_group.size() > 2) {
+        if (obs_ids.size() > 2) {
           for (int i_rejection = 0; i_rejection < n_rejection_cycle_; i_rejection++) {
-            scitbx::af::shared<double> I_full_group_copy;
-            for (int i = 0; i < I_full_group.size(); i++)
-              I_full_group_copy.push_back(I_full_group[i]);
-            scitbx::math::basic_statistics<double> basic_stat(I_full_group_copy.const_ref());
-            scitbx::math::median_functor mf;
-
-            scitbx::af::shared<double> I_group_filtered;
-            scitbx::af::shared<double> sigI_group_filtered;
-            scitbx::af::shared<double> I_full_group_filtered;
-            scitbx::af::shared<double> sigI_full_group_filtered;
-            scitbx::af::shared<double> SE_group_filtered;
-            shared_miller current_index_ori_filtered;
-            scitbx::af::shared<std::string> pickle_filename_set_group_filtered;
-
-            scitbx::af::shared<int> valid_ptrs_filtered;
-
-            double median_I = mf(I_full_group_copy.ref());
-            double mean_I = basic_stat.mean;
-            double std_I = basic_stat.biased_standard_deviation; // based on what I think numpy is doing compared to basic_statistics
-
-            for (int i = 0; i < I_full_group.size(); i++) {
-              double I_full_as_sigma = (I_full_group[i] - median_I) / std_I;
+            I_work.clear();
+            for (std::size_t i = 0; i < obs_ids.size(); i++)
+              I_work.push_back(I_full[obs_ids[i]]);
+            double mean_I, std_I;
+            calc_mean_std(I_work, mean_I, std_I);
+            double median_I = median_in_place(I_work);
+
+            // compact obs_ids in place, keeping the order of the observations
+            std::size_t n_keep = 0;
+            for (std::size_t i = 0; i < obs_ids.size(); i++) {
+              int obs_id = obs_ids[i];
+              double I_full_as_sigma = (I_full[obs_id] - median_I) / std_I;
               if (std::abs(I_full_as_sigma) > sigma_max_) {
-                char buf[512];
-                sprintf(buf, "%s %3.0f %3.0f %3.0f %10.2f %10.2f\n", pickle_filename_set_group[i].c_str(),
-                  double(current_index_ori[i][0]), double(current_index_ori[i][1]), double(current_index_ori[i][2]), I_group[i], sigI_group[i]);
-                txt_reject_out_group << buf;
+                results.reject_frame_id.push_back(frame_id_set_[obs_id]);
+                results.reject_miller_index_ori.push_back(miller_index_ori_[obs_id]);
+                results.reject_I.push_back(I_[obs_id]);
+                results.reject_sigI.push_back(sigI_[obs_id]);
+                if (flag_output_verbose_) {
+                  const cctbx::miller::index<int>& index_ori = miller_index_ori_[obs_id];
+                  sprintf(buf, "%s %3.0f %3.0f %3.0f %10.2f %10.2f\n", frame_files_[frame_id_set_[obs_id]].c_str(),
+                    double(index_ori[0]), double(index_ori[1]), double(index_ori[2]), I_[obs_id], sigI_[obs_id]);
+                  txt_reject_out_group << buf;
+                }
               }
               else {
-                I_group_filtered.push_back(I_group[i]);
-                sigI_group_filtered.push_back(sigI_group[i]);
-                I_full_group_filtered.push_back(I_full_group[i]);
-                sigI_full_group_filtered.push_back(sigI_full_group[i]);
-                SE_group_filtered.push_back(SE_group[i]);
-                current_index_ori_filtered.push_back(current_index_ori[i]);
-                pickle_filename_set_group_filtered.push_back(pickle_filename_set_group[i]);
-                valid_ptrs_filtered.push_back(valid_ptrs[i]);
+                obs_ids[n_keep++] = obs_id;
               }
             }
-            I_group = I_group_filtered;
-            sigI_group = sigI_group_filtered;
-            I_full_group = I_full_group_filtered;
-            sigI_full_group = sigI_full_group_filtered;
-            SE_group = SE_group_filtered;
-            current_index_ori = current_index_ori_filtered;
-            pickle_filename_set_group = pickle_filename_set_group_filtered;
-            valid_ptrs = valid_ptrs_filtered;
-
-            char buf[512];
-            sprintf(buf, "%6.2f %6.2f %8.2f %8.0f\n", mean_I, median_I, std_I, double(I_full_group.size()));
-            txt_obs_out << buf;
+            obs_ids.resize(n_keep);
+
+            if (flag_output_verbose_) {
+              sprintf(buf, "%6.2f %6.2f %8.2f %8.0f\n", mean_I, median_I, std_I, double(obs_ids.size()));
+              txt_obs_out << buf;
+            }
 
-            if (I_full_group.size() <= 3)
+            if (obs_ids.size() <= 3)
               break;
           }
-          if (I_full_group.size() == 0) {
+          if (obs_ids.size() == 0) {
             printf("miller_index (%d, %d, %d) rejected at calc_avg", current_index[0], current_index[1], current_index[2]);
+            // rejections of a fully rejected group are not reported
+            results.reject_frame_id.resize(n_reject_start);
+            results.reject_miller_index_ori.resize(n_reject_start);
+            results.reject_I.resize(n_reject_start);
+            results.reject_sigI.resize(n_reject_start);
             continue;
           }
         }
+        int multiplicity = obs_ids.size();
+        I_full_group.clear();
+        for (int i = 0; i < multiplicity; i++)
+          I_full_group.push_back(I_full[obs_ids[i]]);
+
         // normalize the SE
-        scitbx::af::shared<double> SE_norm;
-        double se_max = scitbx::af::max(SE_group.ref());
-        double se_min = scitbx::af::min(SE_group.ref());
-        double SE_norm_val;
-        if (SE_group.size() == 1 || ((se_max-se_min) < 0.1) || avg_mode_ == Average) {
-          SE_norm_val = 1;
-          for (int i = 0; i < SE_group.size(); i++) {
-            SE_norm.push_back(SE_norm_val);
-          }
+        double se_max = SE_[obs_ids[0]];
+        double se_min = SE_[obs_ids[0]];
+        for (int i = 1; i < multiplicity; i++) {
+          se_max = std::max(se_max, SE_[obs_ids[i]]);
+          se_min = std::min(se_min, SE_[obs_ids[i]]);
+        }
+        SE_norm.clear();
+        if (multiplicity == 1 || ((se_max-se_min) < 0.1) || avg_mode_ == Average) {
+          SE_norm.assign(multiplicity, 1.0);
         }
         else {
           double m = (max_w - min_w)/(se_min-se_max);
           double b = max_w - (m*se_min);
-
-          for (int i = 0; i < SE_group.size(); i++) {
-            SE_norm.push_back( (m*SE_group[i]) + b);
-          }
+          for (int i = 0; i < multiplicity; i++)
+            SE_norm.push_back((m*SE_[obs_ids[i]]) + b);
         }
 
-        double SE_norm_sum = scitbx::af::sum(SE_norm.const_ref());
-        SCITBX_ASSERT(SE_norm_sum != 0);
-        scitbx::af::shared<double> avg_tmp;
-        for (int i = 0; i < SE_norm.size(); i++) {
-          avg_tmp.push_back(SE_norm[i] * I_full_group[i]);
+        double SE_norm_sum = 0;
+        double I_weighted_sum = 0;
+        double sigI_full_sum = 0;
+        for (int i = 0; i < multiplicity; i++) {
+          SE_norm_sum += SE_norm[i];
+          I_weighted_sum += SE_norm[i] * I_full_group[i];
+          sigI_full_sum += sigI_full[obs_ids[i]];
         }
-
-        double I_avg = scitbx::af::sum(avg_tmp.const_ref())/SE_norm_sum;
-        double sigI_avg = scitbx::af::mean(sigI_full_group.const_ref());
+        SCITBX_ASSERT(SE_norm_sum != 0);
+        double I_avg = I_weighted_sum/SE_norm_sum;
+        double sigI_avg = sigI_full_sum/multiplicity;
 
         //Rmeas, Rmeas_w, multiplicity
-        int multiplicity = I_full_group.size();
         double r_meas_w_top = 0;
         double r_meas_w_btm = 0;
         double r_meas_top = 0;
@@ -375,10 +441,6 @@ namespace prime {
         double r_meas = 0;
         double r_meas_w = 0;
         if (multiplicity > 1) {
-          double n_obs = (double)multiplicity;
-          double r_meas_w_top_sum = 0;
-          double r_meas_top_sum = 0;
-
           for (int i = 0; i < multiplicity; i++) {
             r_meas_w_top += std::pow(((I_full_group[i] - I_avg)*SE_norm[i]),2);
             r_meas_w_btm += std::pow(I_full_group[i]*SE_norm[i],2);
@@ -402,36 +464,24 @@ namespace prime {
 
         calc_avg_two_halves(I_full_group, SE_norm, avg_mode_, I_avg_even, I_avg_odd);
 
-        //select reflections on h axis
-        scitbx::af::shared<double> I_full_group_h;
-        scitbx::af::shared<double> SE_norm_h;
-        scitbx::af::shared<double> I_full_group_k;
-        scitbx::af::shared<double> SE_norm_k;
-        scitbx::af::shared<double> I_full_group_l;
-        scitbx::af::shared<double> SE_norm_l;
-        for (int i = 0; i < I_full_group.size(); i++) {
-          if (current_index_ori[i][0] == 0) {
-            I_full_group_h.push_back(I_full_group[i]);
-            SE_norm_h.push_back(SE_norm[i]);
-          }
-
-          if (current_index_ori[i][1] == 0) {
-            I_full_group_k.push_back(I_full_group[i]);
-            SE_norm_k.push_back(SE_norm[i]);
-          }
-
-          if (current_index_ori[i][2] == 0) {
-            I_full_group_l.push_back(I_full_group[i]);
-            SE_norm_l.push_back(SE_norm[i]);
+        //select reflections on h, k and l axes
+        for (int axis = 0; axis < 3; axis++) {
+          I_full_axis.clear();
+          SE_norm_axis.clear();
+          for (int i = 0; i < multiplicity; i++) {
+            if (miller_index_ori_[obs_ids[i]][axis] == 0) {
+              I_full_axis.push_back(I_full_group[i]);
+              SE_norm_axis.push_back(SE_norm[i]);
+            }
           }
+          if (axis == 0)
+            calc_avg_two_halves(I_full_axis, SE_norm_axis, avg_mode_, I_avg_even_h, I_avg_odd_h);
+          else if (axis == 1)
+            calc_avg_two_halves(I_full_axis, SE_norm_axis, avg_mode_, I_avg_even_k, I_avg_odd_k);
+          else
+            calc_avg_two_halves(I_full_axis, SE_norm_axis, avg_mode_, I_avg_even_l, I_avg_odd_l);
         }
 
-
-        calc_avg_two_halves(I_full_group_h, SE_norm_h, avg_mode_, I_avg_even_h, I_avg_odd_h);
-        calc_avg_two_halves(I_full_group_k, SE_norm_k, avg_mode_, I_avg_even_k, I_avg_odd_k);
-        calc_avg_two_halves(I_full_group_l, SE_norm_l, avg_mode_, I_avg_even_l, I_avg_odd_l);
-
-
         // save the results for this group
         results.miller_index.push_back(current_index);
         results.I_avg.push_back(I_avg);
@@ -452,30 +502,41 @@ namespace prime {
 
         if (flag_output_verbose_) {
           txt_obs_out << "    I_o        sigI_o    G      B     Eoc      rs    lambda rocking(deg) W     I_full     sigI_full\n";
-          for (int i = 0; i < I_full_group.size(); i++) {
-            char buf[512];
+          for (int i = 0; i < multiplicity; i++) {
+            int obs_id = obs_ids[i];
             sprintf(buf, "%10.2f %10.2f %6.2f %6.2f %6.2f %8.5f %8.5f %8.5f %6.2f %10.2f %10.2f\n",
-              I_group[i],sigI_group[i],1/G_[valid_ptrs[i]],B_[valid_ptrs[i]],p_set_[valid_ptrs[i]],rs_set_[valid_ptrs[i]],
-              wavelength_set_[valid_ptrs[i]],mosaic_radian_set[valid_ptrs[i]]*180/scitbx::constants::pi,SE_norm[i],
-              I_full_group[i],sigI_full[i]);
+              I_[obs_id],sigI_[obs_id],1/G_[obs_id],B_[obs_id],p_set_[obs_id],rs_set_[obs_id],
+              wavelength_set_[obs_id],mosaic_radian_set[obs_id]*180/scitbx::constants::pi,SE_norm[i],
+              I_full[obs_id],sigI_full[obs_id]);
             txt_obs_out << buf;
           }
-          char buf[512];
           sprintf(buf, "Merged I, sigI: %6.2f, %6.2f\n",I_avg,sigI_avg);
           txt_obs_out << buf;
           sprintf(buf, "Rmeas: %6.2f Qw: %6.2f\n",r_meas,r_meas_w);
           txt_obs_out << buf;
-          sprintf(buf, "No. total observed: %4.0f No. after rejection: %4.0f\n", double(obs_ptr-obs_ptr_start), double(I_full_group.size()));
+          sprintf(buf, "No. total observed: %4.0f No. after rejection: %4.0f\n", double(obs_ptr_end-obs_ptr_start), double(multiplicity));
           txt_obs_out << buf;
           txt_obs_out << "List of rejected observations:\n";
           txt_obs_out << txt_reject_out_group.str();
         }
-        txt_reject_out << txt_reject_out_group.str();
       }
       results.txt_obs_out = txt_obs_out.str();
-      results.txt_reject_out = txt_reject_out.str();
+    }
 
-      return results;
+    static void calc_mean_std(
+      const std::vector<double>& values,
+      double& mean,
+      double& std)
+    {
+      // mean and biased standard deviation (as numpy.std)
+      double sum = 0;
+      for (std::size_t i = 0; i < values.size(); i++)
+        sum += values[i];
+      mean = sum / values.size();
+      double sum_sq_dev = 0;
+      for (std::size_t i = 0; i < values.size(); i++)
+        sum_sq_dev += (values[i] - mean) * (values[i] - mean);
+      std = std::sqrt(sum_sq_dev / values.size());
     }
   };
 
@@ -484,6 +545,125 @@ const double averaging_engine::CONST_SE_MIN_WEIGHT = 0.17;
 const double averaging_engine::CONST_SE_MAX_WEIGHT = 1.0;
 const double averaging_engine::CONST_SIG_I_FACTOR = 1.5;
 
+  /*
+  Fused partiality kernel, computes for each reflection the spot radius rs,
+  the distance rh of the reciprocal lattice point to the Ewald sphere, the
+  partiality of the given model and the distance delta_xy between the
+  predicted and the calculated spot position in one loop.
+
+  Reference implementation: partiality_handler.calc_partiality_set_py in
+  postrefine/mod_partiality.py.
+  */
+  static const int N_LOGNORMAL_SIGMA = 50;
+
+  boost::python::tuple
+  calc_partiality_set(
+    const scitbx::af::shared<double>& A_star,
+    const shared_miller& miller_indices,
+    double ry,
+    double rz,
+    double r0,
+    double re,
+    double nu,
+    const scitbx::af::shared<double>& bragg_angle_set,
+    const scitbx::af::shared<double>& alpha_angle_set,
+    double wavelength,
+    const scitbx::af::shared<double>& spot_pred_x_mm_set,
+    const scitbx::af::shared<double>& spot_pred_y_mm_set,
+    double detector_distance_mm,
+    const std::string& partiality_model,
+    bool flag_beam_divergence)
+  {
+    const double pi = 3.14159265358979323846;
+    const std::size_t n_refl = miller_indices.size();
+    if (A_star.size() != 9 || bragg_angle_set.size() != n_refl
+        || alpha_angle_set.size() != n_refl
+        || spot_pred_x_mm_set.size() != n_refl
+        || spot_pred_y_mm_set.size() != n_refl) {
+      throw std::invalid_argument("calc_partiality_set: array size mismatch");
+    }
+    int model;
+    if (partiality_model == "Lorentzian") model = 0;
+    else if (partiality_model == "Voigt") model = 1;
+    else if (partiality_model == "Lognormal") model = 2;
+    else throw std::invalid_argument(
+      "calc_partiality_set: unknown partiality model " + partiality_model);
+    // voigt: nu is clamped to [0,1]
+    const double nu_voigt = std::min(std::max(nu, 0.), 1.);
+    const double c_gauss = std::sqrt(std::log(2.) / pi);
+    // lognormal: sigma is the grid point with the nearest FWHM to rs
+    const double zero = std::fabs(nu);
+    double fwhm_grid[N_LOGNORMAL_SIGMA];
+    for (int i = 0; i < N_LOGNORMAL_SIGMA; i++) {
+      double t = (i / 100.) * std::sqrt(std::log(4.));
+      fwhm_grid[i] = zero * (std::exp(t) - std::exp(-1 * t));
+    }
+    const double one_over_lambda = 1. / wavelength;
+    scitbx::af::shared<double> partiality_set(n_refl);
+    scitbx::af::shared<double> delta_xy_set(n_refl);
+    scitbx::af::shared<double> rs_set(n_refl);
+    scitbx::af::shared<double> rh_set(n_refl);
+    for (std::size_t i = 0; i < n_refl; i++) {
+      // rs
+      double rs = r0 + (re * std::tan(bragg_angle_set[i]));
+      if (flag_beam_divergence) {
+        double ry_cos = ry * std::cos(alpha_angle_set[i]);
+        double rz_sin = rz * std::sin(alpha_angle_set[i]);
+        rs += std::sqrt((ry_cos * ry_cos) + (rz_sin * rz_sin));
+      }
+      // rh from sd = A_star * hkl + S0
+      const cctbx::miller::index<int>& hkl = miller_indices[i];
+      double sd[3];
+      for (int j = 0; j < 3; j++) {
+        sd[j] = (A_star[3 * j] * hkl[0]) + (A_star[3 * j + 1] * hkl[1])
+          + (A_star[3 * j + 2] * hkl[2]);
+      }
+      sd[2] -= one_over_lambda;
+      double rh = std::sqrt((sd[0] * sd[0]) + (sd[1] * sd[1]) + (sd[2] * sd[2]))
+        - one_over_lambda;
+      // partiality
+      double p;
+      if (model == 0) {
+        p = (rs * rs) / ((2 * (rh * rh)) + (rs * rs));
+      } else if (model == 1) {
+        double u_sq = (rh / rs) * (rh / rs);
+        double abs_rs = std::fabs(rs);
+        double f1 = nu_voigt * c_gauss * std::exp(-4 * std::log(2.) * u_sq)
+          * (1 / abs_rs);
+        double f2 = (1 - nu_voigt) / (pi * abs_rs * (1 + (4 * u_sq)));
+        double f3 = ((nu_voigt * c_gauss) / abs_rs)
+          + ((1 - nu_voigt) / (pi * abs_rs));
+        p = (f1 + f2) / f3;
+      } else {
+        int i_sig = 0;
+        double d_min = std::fabs(rs - fwhm_grid[0]);
+        for (int j = 1; j < N_LOGNORMAL_SIGMA; j++) {
+          double d = std::fabs(rs - fwhm_grid[j]);
+          if (d < d_min) {
+            d_min = d;
+            i_sig = j;
+          }
+        }
+        double sig = i_sig / 100.;
+        double x0 = std::log(zero) + (sig * sig);
+        double g = 1 / (sig * std::sqrt(2 * pi) * std::exp(x0 - ((sig * sig) / 2)));
+        double X = zero - rh;
+        double f1 = 1 / (X * sig * std::sqrt(2 * pi));
+        double f2 = std::exp(-1 * std::pow(std::log(X) - x0, 2) / (2 * (sig * sig)));
+        p = f1 * f2 / g;
+      }
+      // delta_xy of the spot projected on the detector
+      double d_ratio = -detector_distance_mm / sd[2];
+      double dx = spot_pred_x_mm_set[i] - (sd[0] * d_ratio);
+      double dy = spot_pred_y_mm_set[i] - (sd[1] * d_ratio);
+      partiality_set[i] = p;
+      delta_xy_set[i] = std::sqrt((dx * dx) + (dy * dy));
+      rs_set[i] = rs;
+      rh_set[i] = rh;
+    }
+    return boost::python::make_tuple(partiality_set, delta_xy_set, rs_set, rh_set);
+  }
+
 namespace boost_python { namespace {
   void
   init_module() {
@@ -504,13 +684,14 @@ namespace boost_python { namespace {
         const scitbx::af::shared<double>&,
         const scitbx::af::shared<double>&,
         const scitbx::af::shared<double>&,
+        const scitbx::af::shared<int>&,
         const scitbx::af::shared<std::string>&
         >(
         (arg("group_no"),arg("group_id_list"),
         arg("miller_list"),arg("miller_list_ori"),arg("I"),arg("sigI"),
         arg("G"),arg("B"),arg("p_set"),arg("rs_set"),
         arg("wavelength_set"),arg("sin_theta_over_lambda_sq"),arg("SE"),
-        arg("pickle_filename_set")
+        arg("frame_id_set"),arg("frame_files")
         )))
       .def("calc_avg_I", &averaging_engine::calc_avg_I)
       .add_property("avg_mode",
@@ -528,6 +709,9 @@ namespace boost_python { namespace {
       .add_property("flag_output_verbose",
         make_getter(&averaging_engine::flag_output_verbose_, rbv()),
         make_setter(&averaging_engine::flag_output_verbose_, dcp()))
+      .add_property("n_threads",
+        make_getter(&averaging_engine::n_threads_, rbv()),
+        make_setter(&averaging_engine::n_threads_, dcp()))
       ;
 
     class_<average_result_store>("average_result_store",init<>())
@@ -582,14 +766,33 @@ namespace boost_python { namespace {
       .add_property("txt_obs_out",
         make_getter(&average_result_store::txt_obs_out, rbv()),
         make_setter(&average_result_store::txt_obs_out, dcp()))
-      .add_property("txt_reject_out",
-        make_getter(&average_result_store::txt_reject_out, rbv()),
-        make_setter(&average_result_store::txt_reject_out, dcp()))
+      .add_property("reject_frame_id",
+        make_getter(&average_result_store::reject_frame_id, rbv()),
+        make_setter(&average_result_store::reject_frame_id, dcp()))
+      .add_property("reject_miller_index_ori",
+        make_getter(&average_result_store::reject_miller_index_ori, rbv()),
+        make_setter(&average_result_store::reject_miller_index_ori, dcp()))
+      .add_property("reject_I",
+        make_getter(&average_result_store::reject_I, rbv()),
+        make_setter(&average_result_store::reject_I, dcp()))
+      .add_property("reject_sigI",
+        make_getter(&average_result_store::reject_sigI, rbv()),
+        make_setter(&average_result_store::reject_sigI, dcp()))
     ;
   };
 
   using namespace boost::python;
 
+  void export_partiality()
+  {
+    def("calc_partiality_set", &calc_partiality_set,
+      (arg("A_star"),arg("miller_indices"),arg("ry"),arg("rz"),arg("r0"),
+      arg("re"),arg("nu"),arg("bragg_angle_set"),arg("alpha_angle_set"),
+      arg("wavelength"),arg("spot_pred_x_mm_set"),arg("spot_pred_y_mm_set"),
+      arg("detector_distance_mm"),arg("partiality_model"),
+      arg("flag_beam_divergence")));
+  }
+
   void export_average_mode()
   {
     enum_<Average_Mode>("Average_Mode")
@@ -604,6 +807,7 @@ BOOST_PYTHON_MODULE(prime_ext)
 {
   prime::boost_python::init_module();
   prime::boost_python::export_average_mode();
+  prime::boost_python::export_partiality();
 
 }
 
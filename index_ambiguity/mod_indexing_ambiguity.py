@@ -2,44 +2,39 @@ from __future__ import absolute_import, division, print_function
 from six.moves import cPickle as pickle
 from prime.postrefine import postref_handler
 from .mod_lbfgs import lbfgs_handler
+from .mod_twin_operators import get_twin_operator_cache, get_run_twin_operator_cache
 import numpy as np
 from cctbx import sgtbx
 import random
 from cctbx.array_family import flex
-from prime.postrefine.mod_input import read_frame
 from six.moves import range
 from six.moves import zip
 
 
+# change of basis operators by hkl string
+_change_of_basis_ops = {}
+
+
+def get_change_of_basis_op(op_hkl):
+    if op_hkl not in _change_of_basis_ops:
+        _change_of_basis_ops[op_hkl] = sgtbx.change_of_basis_op(op_hkl)
+    return _change_of_basis_ops[op_hkl]
+
+
 class indamb_handler(object):
     """handle indexing ambiguity main."""
 
     def __init__(self):
         """Constructor."""
 
-    def generate_twin_operators(self, obs_in, flag_all=False):
-        # generate only true merohedral twin operators
-        from mmtbx.scaling.twin_analyses import twin_laws
-
-        TL = twin_laws(miller_array=obs_in)
-        operators = []
-        if flag_all:
-            operators = TL.operators
-        else:
-            if TL.m > 0:
-                operators = TL.operators
-        return operators
-
-    def generate_reindex_sets(self, obs_in):
-        ops = self.generate_twin_operators(obs_in)
+    def generate_reindex_sets(self, obs_in, twin_operator_cache=None):
+        if twin_operator_cache is None:
+            twin_operator_cache = get_twin_operator_cache()
         alternates = {"h,k,l": obs_in}
-        for op in ops:
-            hkl = obs_in.indices()
-            cb_op = sgtbx.change_of_basis_op(op.operator.r().as_hkl())
-            hklrev = cb_op.apply(hkl)
-            alternates[op.operator.r().as_hkl()] = obs_in.customized_copy(
-                indices=hklrev
-            ).map_to_asu()
+        hkl = obs_in.indices()
+        for op_hkl in twin_operator_cache.get_operators(obs_in):
+            hklrev = get_change_of_basis_op(op_hkl).apply(hkl)
+            alternates[op_hkl] = obs_in.customized_copy(indices=hklrev).map_to_asu()
         return alternates
 
     def generate_forced_reindex_sets(self, obs_in, assigned_basis):
@@ -50,13 +45,10 @@ class indamb_handler(object):
         return alternates
 
     def get_observations(self, pickle_filename, iparams):
-        main_obs_pickle = read_frame(pickle_filename)
         prh = postref_handler()
         avg_mode = "average"
         try:
-            inputs, txt_org = prh.organize_input(
-                main_obs_pickle, iparams, avg_mode, pickle_filename=pickle_filename
-            )
+            inputs, txt_org = prh.read_input(pickle_filename, iparams, avg_mode)
             main_obs = inputs[0]
         except Exception:
             print("Error reading input pickle.")
@@ -69,7 +61,9 @@ class indamb_handler(object):
                 main_asu, iparams.indexing_ambiguity.assigned_basis
             )
         else:
-            alternates = self.generate_reindex_sets(main_asu)
+            alternates = self.generate_reindex_sets(
+                main_asu, twin_operator_cache=get_run_twin_operator_cache(iparams)
+            )
         return alternates
 
     def calc_cc(self, frame_no, pickle_filename, iparams, miller_array_ref):
@@ -96,34 +90,6 @@ class indamb_handler(object):
             )
             return "h,k,l", txt_out
 
-    def calc_r(self, frame_no, pickle_filename, index_basis, main_obs, obs_results):
-        # get main observation
-        img_filename_only = ""
-        pickle_filepaths = pickle_filename.split("/")
-        img_filename_only = pickle_filepaths[len(pickle_filepaths) - 1]
-        txt_out = " {0:40} ==> ".format(img_filename_only + " " + index_basis)
-        # calculate cc with other observations
-        n_frames = len(obs_results)
-        r_set = np.zeros((1, n_frames))
-        n_refl_common_set = np.zeros((1, n_frames))
-        n_frame_common = 0
-        for j in range(frame_no + 1, n_frames):
-            obs_asu = obs_results[j]
-            corr = main_obs.correlation(obs_asu, assert_is_similar_symmetry=False)
-            c_main, c_other = main_obs.common_sets(
-                obs_asu, assert_is_similar_symmetry=False
-            )
-            if len(c_main.indices()) > 5:
-                r_set[0, j] = corr.coefficient()
-                n_refl_common_set[0, j] = len(c_main.indices())
-                n_frame_common += 1
-        txt_out += " <CC>:%6.2f <N_refl_common>: %6.1f N_frame_common: %6.0f" % (
-            np.mean(r_set),
-            np.mean(n_refl_common_set),
-            n_frame_common,
-        )
-        return r_set, txt_out
-
     def optimize(self, r_matrix, flag_plot=False):
         xinp = flex.double([random.random() for i in range(len(r_matrix) * 2)])
         xinp_copy = xinp[:]
@@ -7,102 +7,169 @@ Author      : Uervirojnangkoorn, M.
 Created     : 8/17/2016
 Description : Handy class to do K-means clustering.
 """
-import random
 import numpy as np
-import matplotlib.pyplot as plt
-from random import randint
 
 
 class kmeans_handler(object):
     """From a given N-dimensional array, find K clusters.
 
-    Algorithms taken from Stanford CS221 pseudo-python code.
-    See http://stanford.edu/~cpiech/cs221/handouts/kmeans.html
+    Lloyd's algorithm with k-means++ seeding. n_restarts independent runs
+    are done together as one batch of arrays (restart x point x centroid)
+    and the run with the lowest inertia (sum of squared distances to the
+    nearest centroid) is kept. A run stops when the centroids move less than
+    tol times the mean variance of the features.
     """
 
-    def __init__(self):
+    def __init__(self, n_restarts=10, max_iters=300, tol=1e-4, seed=None):
         """Constructor."""
-        self.MAX_ITERS = 1000
+        self.n_restarts = n_restarts
+        self.MAX_ITERS = max_iters
+        self.tol = tol
+        self.random_state = np.random.RandomState(seed)
 
-    def run(self, dataset, k, flag_plot=False):
-        # define color for plotting
-        colors = ["#%06X" % randint(0, 0xFFFFFF) for i in range(k)]
-        # initialize controids randomly
-        n_data, n_features = dataset.shape
-        centroids = np.array([random.random() for i in range(k * n_features)]).reshape(
-            (k, n_features)
+    def get_sq_distances(self, dataset, centroids):
+        """Return squared distances (restart x point x centroid) of dataset
+        to centroids (restart x centroid x feature)."""
+        sq_dist = (
+            (dataset ** 2).sum(axis=1)[None, :, None]
+            - 2 * np.einsum("nd,rkd->rnk", dataset, centroids)
+            + (centroids ** 2).sum(axis=2)[:, None, :]
         )
-        scale = np.max(dataset, axis=0)
-        centroids = centroids * scale
-        if flag_plot:
-            plt.scatter(dataset[:, 0], dataset[:, 1], s=10, marker="x", c="b")
-            plt.scatter(centroids[:, 0], centroids[:, 1], s=20, marker="o", c="k")
-            plt.title("Initial step (k=%3.0f)" % (k))
-            plt.show()
-        # initialize book keeping vars
-        n_iters = 0
-        old_centroids = None
-        # run the k-means algorithm
-        while not self.should_stop(old_centroids, centroids, n_iters):
-            # save old centroids for convergenence test. book keeping.
-            old_centroids = centroids[:]
-            n_iters += 1
-            # assign labels to each datapoint based on centroids
-            labels = self.get_labels(dataset, centroids)
-            # assign centroids based on datapoint labels
-            centroids = self.get_centroids(dataset, labels, k)
-            if flag_plot:
-                for i in range(k):
-                    s = dataset[labels == i]
-                    plt.scatter(s[:, 0], s[:, 1], s=10, marker="x", c=colors[i])
-                    plt.scatter(
-                        centroids[i, 0], centroids[i, 1], s=20, marker="o", c="k"
-                    )
-                plt.title("Cycle %3.0f (k=%3.0f)" % (n_iters, k))
-                plt.show()
-        return centroids, labels
+        return np.maximum(sq_dist, 0)
+
+    def init_centroids(self, dataset, k, n_restarts):
+        """Return k-means++ seeds (restart x centroid x feature)."""
+        n_data, n_features = dataset.shape
+        centroids = np.zeros((n_restarts, k, n_features))
+        centroids[:, 0] = dataset[self.random_state.randint(n_data, size=n_restarts)]
+        min_sq_dist = self.get_sq_distances(dataset, centroids[:, :1])[:, :, 0]
+        for i in range(1, k):
+            # draw the next seed with probability proportional to D^2
+            cum_sq_dist = np.cumsum(min_sq_dist, axis=1)
+            draws = self.random_state.random_sample(n_restarts) * cum_sq_dist[:, -1]
+            i_seeds = np.minimum((cum_sq_dist < draws[:, None]).sum(axis=1), n_data - 1)
+            centroids[:, i] = dataset[i_seeds]
+            min_sq_dist = np.minimum(
+                min_sq_dist,
+                self.get_sq_distances(dataset, centroids[:, i : i + 1])[:, :, 0],
+            )
+        return centroids
 
-    def should_stop(self, old_centroids, centroids, n_iters):
-        if n_iters > self.MAX_ITERS:
-            return True
-        return np.all(old_centroids == centroids)
+    def get_centroids(self, dataset, labels, k, old_centroids):
+        """Return mean of each cluster (restart x centroid x feature). An
+        empty cluster takes the point that is furthest from its centroid."""
+        n_restarts = labels.shape[0]
+        n_data, n_features = dataset.shape
+        group_ids = (labels + k * np.arange(n_restarts)[:, None]).ravel()
+        counts = np.bincount(group_ids, minlength=n_restarts * k)
+        centroids = np.zeros((n_restarts * k, n_features))
+        for i in range(n_features):
+            centroids[:, i] = np.bincount(
+                group_ids,
+                weights=np.tile(dataset[:, i], n_restarts),
+                minlength=n_restarts * k,
+            )
+        centroids = centroids / np.maximum(counts, 1)[:, None]
+        centroids = centroids.reshape((n_restarts, k, n_features))
+        for i_restart, i_cluster in zip(*np.nonzero(counts.reshape((-1, k)) == 0)):
+            sq_dist = (
+                (dataset - old_centroids[i_restart, labels[i_restart]]) ** 2
+            ).sum(axis=1)
+            centroids[i_restart, i_cluster] = dataset[np.argmax(sq_dist)]
+        return centroids
 
     def get_labels(self, dataset, centroids):
         # For each element in the dataset, choose the closest centroid.
         # Make that centroid the element's label.
-        n_data, n_features = dataset.shape
-        n_centroids = len(centroids)
-        dist = np.zeros((n_data, n_centroids))
-        for c, i in zip(centroids, range(n_centroids)):
-            dist[:, i] = np.sqrt(((dataset - c) ** 2).sum(axis=1))
-        labels = np.argmin(dist, axis=1)
-        return labels
+        return np.argmin(self.get_sq_distances(dataset, centroids[None])[0], axis=1)
 
-    def get_centroids(self, dataset, labels, k):
-        # For each label group, calculate a new geometric mean as a new centroid.
-        # For empty group, assign a new random centroid.
+    def run(self, dataset, k, flag_plot=False):
+        dataset = np.asarray(dataset, dtype=np.float64)
         n_data, n_features = dataset.shape
-        centroids = np.zeros((k, n_features))
-        for i in range(k):
-            s = dataset[labels == i]
-            if len(s) > 0:
-                centroids[i] = np.power(np.sqrt(np.prod(s, axis=0) ** 2), 1 / len(s))
-            else:
-                scale = np.max(dataset, axis=0)
-                centroids[i] = (
-                    np.array([random.random() for i in range(n_features)]) * scale
-                )
-        return centroids
+        k = min(k, n_data)
+        tol = self.tol * np.mean(np.var(dataset, axis=0))
+        centroids = self.init_centroids(dataset, k, self.n_restarts)
+        init_centroids = centroids.copy()
+        flag_active = np.ones(self.n_restarts, dtype=bool)
+        n_iters = 0
+        while n_iters < self.MAX_ITERS and flag_active.any():
+            n_iters += 1
+            sq_dist = self.get_sq_distances(dataset, centroids[flag_active])
+            labels = np.argmin(sq_dist, axis=2)
+            new_centroids = self.get_centroids(
+                dataset, labels, k, centroids[flag_active]
+            )
+            shift = ((new_centroids - centroids[flag_active]) ** 2).sum(axis=(1, 2))
+            centroids[flag_active] = new_centroids
+            i_active = np.flatnonzero(flag_active)
+            flag_active[i_active[shift <= tol]] = False
+        # keep the restart with the lowest inertia
+        sq_dist = self.get_sq_distances(dataset, centroids)
+        inertia = sq_dist.min(axis=2).sum(axis=1)
+        i_best = np.argmin(inertia)
+        centroids = centroids[i_best]
+        labels = np.argmin(sq_dist[i_best], axis=1)
+        self.inertia = inertia[i_best]
+        self.n_iters = n_iters
+        if flag_plot:
+            import matplotlib.pyplot as plt
+
+            colors = ["C%d" % (i % 10) for i in range(k)]
+            plt.subplot(2, 1, 1)
+            plt.scatter(dataset[:, 0], dataset[:, 1], s=10, marker="x", c="b")
+            plt.scatter(
+                init_centroids[i_best, :, 0],
+                init_centroids[i_best, :, 1],
+                s=20,
+                marker="o",
+                c="k",
+            )
+            plt.title("Initial step (k=%3.0f)" % (k))
+            plt.subplot(2, 1, 2)
+            for i in range(k):
+                s = dataset[labels == i]
+                plt.scatter(s[:, 0], s[:, 1], s=10, marker="x", c=colors[i])
+            plt.scatter(centroids[:, 0], centroids[:, 1], s=20, marker="o", c="k")
+            plt.title("Cycle %3.0f (k=%3.0f)" % (n_iters, k))
+            plt.show()
+        return centroids, labels
 
 
 if __name__ == "__main__":
-    # unit test
-    points = np.vstack(
-        [
-            np.random.multivariate_normal(mean, 0.03 * np.diag([1, 1]), 20)
-            for mean in [(1, 1), (2, 4), (3, 2)]
-        ]
-    )
-    k = 3
-    kmh = kmeans_handler()
-    centroids, labels = kmh.run(points, k, flag_plot=True)
+    import sys, time
+
+    if "benchmark" in sys.argv[1:]:
+        # time-to-solution on 10^5 points embedded in 2D (as x_set)
+        means = [(0.1, 0.1), (0.9, 0.1), (0.1, 0.9), (0.9, 0.9)]
+        points = np.vstack(
+            [
+                np.random.multivariate_normal(mean, 0.01 * np.diag([1, 1]), 25000)
+                for mean in means
+            ]
+        )
+        kmh = kmeans_handler()
+        t_start = time.time()
+        centroids, labels = kmh.run(points, len(means))
+        print(
+            "%d points, k=%d, %d restarts: %.2f s (%d iterations, inertia %.2f)"
+            % (
+                len(points),
+                len(means),
+                kmh.n_restarts,
+                time.time() - t_start,
+                kmh.n_iters,
+                kmh.inertia,
+            )
+        )
+        print(centroids)
+    else:
+        # unit test
+        points = np.vstack(
+            [
+                np.random.multivariate_normal(mean, 0.03 * np.diag([1, 1]), 20)
+                for mean in [(1, 1), (2, 4), (3, 2)]
+            ]
+        )
+        k = 3
+        kmh = kmeans_handler()
+        centroids, labels = kmh.run(points, k, flag_plot=True)
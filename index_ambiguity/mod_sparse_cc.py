@@ -0,0 +1,197 @@
+"""
+Description : All-pairs frame correlations (Brehm & Diederichs R matrix) from
+              sparse matrix products.
+
+Frames are packed as rows of a frame-by-reflection matrix over all distinct
+miller indices of the frames (CSR if scipy is available, a dense array
+otherwise). With X holding the intensities (centred on the mean of each
+frame) and M the 0/1 observation mask, the number of common reflections
+(M.M'), the sums (X.M'), the sums of squares (X^2.M') and the cross products
+(X.X') of all pairs give the Pearson CC of every pair on its common
+reflections, as miller.array.correlation does one pair at a time.
+"""
+from __future__ import absolute_import, division, print_function
+import os, shutil, tempfile
+import numpy as np
+from prime.postrefine.mod_hkl import pack_miller_indices
+from six.moves import range
+from six.moves import zip
+
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
+
+def get_frame_arrays(obs_list):
+    """Return CSR arrays (data, columns, indptr, n_columns) of the frame
+    matrix of obs_list (miller arrays with unique indices): one row per
+    frame, one column per distinct miller index, data are intensities
+    centred on the mean of each frame."""
+    n_frames = len(obs_list)
+    keys_set = [pack_miller_indices(obs.indices()) for obs in obs_list]
+    n_refl = np.array([len(keys) for keys in keys_set], dtype=np.int64)
+    indptr = np.zeros(n_frames + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(n_refl)
+    if indptr[-1] > 0:
+        unique_keys, columns = np.unique(np.concatenate(keys_set), return_inverse=True)
+        data = np.concatenate([obs.data().as_numpy_array() for obs in obs_list])
+    else:
+        unique_keys = columns = np.zeros(0, dtype=np.int64)
+        data = np.zeros(0)
+    columns = columns.reshape(-1).astype(np.int64)
+    frame_ids = np.repeat(np.arange(n_frames), n_refl)
+    mean_I = np.bincount(frame_ids, weights=data, minlength=n_frames) / np.maximum(
+        n_refl, 1
+    )
+    return data - mean_I[frame_ids], columns, indptr, len(unique_keys)
+
+
+def get_frame_matrix(data, columns, indptr, n_columns):
+    """Return (X, M) from the CSR arrays of get_frame_arrays: X holds the
+    centred intensities, M is 1 where a frame has the reflection."""
+    shape = (len(indptr) - 1, n_columns)
+    if sparse is not None:
+        X = sparse.csr_matrix((data, columns, indptr), shape=shape)
+        M = sparse.csr_matrix((np.ones(len(data)), columns, indptr), shape=shape)
+    else:
+        frame_ids = np.repeat(np.arange(shape[0]), np.diff(indptr))
+        X = np.zeros(shape)
+        X[frame_ids, columns] = data
+        M = np.zeros(shape)
+        M[frame_ids, columns] = 1
+    return X, M
+
+
+def _dot(A, B):
+    AB = A.dot(B)
+    return AB.toarray() if sparse is not None and sparse.issparse(AB) else AB
+
+
+def calc_cc_rows(X, M, i_st, i_en, n_refl_min=5):
+    """Return rows i_st to i_en of the CC and common-reflection matrices
+    (see calc_cc_matrix)."""
+    n_frames = X.shape[0]
+    X_sq = X.multiply(X).tocsr() if sparse is not None else X * X
+    X_b, M_b, X_sq_b = X[i_st:i_en], M[i_st:i_en], X_sq[i_st:i_en]
+    n = _dot(M_b, M.T)
+    sum_x = _dot(X_b, M.T)
+    sum_y = _dot(M_b, X.T)
+    sum_xx = _dot(X_sq_b, M.T)
+    sum_yy = _dot(M_b, X_sq.T)
+    sum_xy = _dot(X_b, X.T)
+    numerator = n * sum_xy - sum_x * sum_y
+    denominator_sq = (n * sum_xx - sum_x ** 2) * (n * sum_yy - sum_y ** 2)
+    # upper triangle with enough common reflections
+    i_sel = (np.arange(i_st, i_en)[:, None] < np.arange(n_frames)[None, :]) & (
+        n > n_refl_min
+    )
+    cc_rows = np.zeros(n.shape)
+    n_refl_common_rows = np.zeros(n.shape)
+    n_refl_common_rows[i_sel] = n[i_sel]
+    i_sel &= denominator_sq > 0
+    cc_rows[i_sel] = numerator[i_sel] / np.sqrt(denominator_sq[i_sel])
+    return cc_rows, n_refl_common_rows
+
+
+def _open_staged(stage_dir, name, dtype, shape, mode="r"):
+    return np.memmap(
+        os.path.join(stage_dir, name + ".bin"), dtype=dtype, mode=mode, shape=shape
+    )
+
+
+def calc_cc_rows_mproc(args):
+    """Compute rows i_st to i_en from the staged frame matrix and write them
+    to the staged output matrices."""
+    stage_dir, n_frames, n_columns, n_nonzero, i_st, i_en, n_refl_min = args
+    X, M = get_frame_matrix(
+        _open_staged(stage_dir, "data", np.float64, (n_nonzero,)),
+        _open_staged(stage_dir, "columns", np.int64, (n_nonzero,)),
+        _open_staged(stage_dir, "indptr", np.int64, (n_frames + 1,)),
+        n_columns,
+    )
+    cc_rows, n_refl_common_rows = calc_cc_rows(X, M, i_st, i_en, n_refl_min)
+    for name, rows in (("cc", cc_rows), ("n_refl_common", n_refl_common_rows)):
+        out = _open_staged(stage_dir, name, np.float64, (n_frames, n_frames), "r+")
+        out[i_st:i_en] = rows
+        out.flush()
+        del out
+    return i_st
+
+
+def calc_cc_matrix(obs_list, n_refl_min=5, block_size=1024, n_processors=1):
+    """Return (cc_matrix, n_refl_common_matrix) of all pairs in obs_list.
+
+    Only pairs i < j are filled (upper triangle) and pairs with n_refl_min
+    or fewer common reflections are left at 0. Rows are computed block_size
+    at a time to bound the memory of the products.
+    With n_processors > 1 (and scipy), the frame matrix is staged once to
+    memory-mapped files and the row blocks are computed in parallel, each
+    task writing its rows to a memory-mapped output matrix.
+    """
+    n_frames = len(obs_list)
+    data, columns, indptr, n_columns = get_frame_arrays(obs_list)
+    if n_processors <= 1 or sparse is None or n_frames <= 1 or len(data) == 0:
+        cc_matrix = np.zeros((n_frames, n_frames))
+        n_refl_common_matrix = np.zeros((n_frames, n_frames))
+        X, M = get_frame_matrix(data, columns, indptr, n_columns)
+        for i_st in range(0, n_frames, block_size):
+            i_en = min(i_st + block_size, n_frames)
+            cc_matrix[i_st:i_en], n_refl_common_matrix[i_st:i_en] = calc_cc_rows(
+                X, M, i_st, i_en, n_refl_min
+            )
+        return cc_matrix, n_refl_common_matrix
+    from libtbx.easy_mp import parallel_map
+
+    stage_dir = tempfile.mkdtemp(prefix="prime_cc_")
+    try:
+        for name, values in (("data", data), ("columns", columns), ("indptr", indptr)):
+            values.tofile(os.path.join(stage_dir, name + ".bin"))
+        for name in ("cc", "n_refl_common"):
+            _open_staged(
+                stage_dir, name, np.float64, (n_frames, n_frames), "w+"
+            ).flush()
+        # enough blocks to keep all processors busy
+        block_size = max(1, min(block_size, -(-n_frames // (n_processors * 4))))
+        parallel_map(
+            iterable=[
+                (
+                    stage_dir,
+                    n_frames,
+                    n_columns,
+                    len(data),
+                    i_st,
+                    min(i_st + block_size, n_frames),
+                    n_refl_min,
+                )
+                for i_st in range(0, n_frames, block_size)
+            ],
+            func=calc_cc_rows_mproc,
+            processes=n_processors,
+        )
+        cc_matrix = np.array(
+            _open_staged(stage_dir, "cc", np.float64, (n_frames, n_frames))
+        )
+        n_refl_common_matrix = np.array(
+            _open_staged(stage_dir, "n_refl_common", np.float64, (n_frames, n_frames))
+        )
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    return cc_matrix, n_refl_common_matrix
+
+
+def calc_r_matrix(obs_list, names, n_refl_min=5, n_processors=1):
+    """Return R matrix of obs_list (see calc_cc_matrix) and a summary line
+    per frame (names are shown as the frame labels)."""
+    r_matrix, n_refl_common_matrix = calc_cc_matrix(
+        obs_list, n_refl_min=n_refl_min, n_processors=n_processors
+    )
+    txt_out = ""
+    for name, r_set, n_refl_common_set in zip(names, r_matrix, n_refl_common_matrix):
+        txt_out += " {0:40} ==> ".format(name)
+        txt_out += " <CC>:%6.2f <N_refl_common>: %6.1f N_frame_common: %6.0f\n" % (
+            np.mean(r_set),
+            np.mean(n_refl_common_set),
+            np.count_nonzero(n_refl_common_set),
+        )
+    return r_matrix, txt_out
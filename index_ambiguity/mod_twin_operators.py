@@ -0,0 +1,105 @@
+"""
+Description : Cache of twin operators by space group and unit cell.
+
+The twin laws of a frame (mmtbx.scaling.twin_analyses.twin_laws) only depend
+on its space group and, within the tolerance of the lattice symmetry search,
+on its unit cell. Operators are cached as hkl strings keyed by the hall
+symbol, the unit cell rounded to CELL_LENGTH_TOLERANCE and
+CELL_ANGLE_TOLERANCE and flag_all. With a cache file (in the run folder)
+they are shared by all processes and later runs.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+from six.moves import cPickle as pickle
+
+TWIN_OPERATOR_CACHE_FILENAME = "twin_operators.pickle"
+# rounding of unit cell lengths (A) and angles (degrees) in cache keys
+CELL_LENGTH_TOLERANCE = 1.0
+CELL_ANGLE_TOLERANCE = 1.0
+
+# caches opened by this process, by cache file
+_twin_operator_caches = {}
+
+
+def get_twin_operator_cache(cache_filename=None):
+    """Return the (per-process) twin operator cache of cache_filename (in
+    memory only if None)."""
+    if cache_filename not in _twin_operator_caches:
+        _twin_operator_caches[cache_filename] = twin_operator_cache_handler(
+            cache_filename
+        )
+    return _twin_operator_caches[cache_filename]
+
+
+def get_run_twin_operator_cache(iparams):
+    """Return twin operator cache kept in the index_ambiguity folder of the
+    run."""
+    return get_twin_operator_cache(
+        os.path.join(iparams.run_no, "index_ambiguity", TWIN_OPERATOR_CACHE_FILENAME)
+    )
+
+
+def calc_twin_operators(obs_in, flag_all=False):
+    """Return twin operators of obs_in as hkl strings (only true merohedral
+    operators unless flag_all)."""
+    from mmtbx.scaling.twin_analyses import twin_laws
+
+    TL = twin_laws(miller_array=obs_in)
+    operators = []
+    if flag_all or TL.m > 0:
+        operators = [op.operator.r().as_hkl() for op in TL.operators]
+    return operators
+
+
+class twin_operator_cache_handler(object):
+    """Twin operators (hkl strings) by space group and rounded unit cell."""
+
+    def __init__(self, cache_filename=None):
+        self.cache_filename = cache_filename
+        self.operators = {}
+        self.load()
+
+    def get_key(self, obs_in, flag_all):
+        a, b, c, alpha, beta, gamma = obs_in.unit_cell().parameters()
+        return (
+            obs_in.space_group_info().type().hall_symbol(),
+            tuple(int(round(x / CELL_LENGTH_TOLERANCE)) for x in (a, b, c)),
+            tuple(int(round(x / CELL_ANGLE_TOLERANCE)) for x in (alpha, beta, gamma)),
+            flag_all,
+        )
+
+    def load(self):
+        if self.cache_filename is None or not os.path.isfile(self.cache_filename):
+            return
+        try:
+            with open(self.cache_filename, "rb") as f:
+                self.operators.update(pickle.load(f))
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    def save(self):
+        if self.cache_filename is None:
+            return
+        # merge with entries from other processes, write then rename
+        operators = self.operators
+        self.operators = {}
+        self.load()
+        self.operators.update(operators)
+        tmp_filename = self.cache_filename + ".%d.tmp" % (os.getpid())
+        try:
+            with open(tmp_filename, "wb") as f:
+                pickle.dump(self.operators, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, self.cache_filename)
+        except (IOError, OSError):
+            pass
+
+    def get_operators(self, obs_in, flag_all=False):
+        """Return twin operators of obs_in as hkl strings."""
+        key = self.get_key(obs_in, flag_all)
+        if key not in self.operators:
+            # may have been added by another process
+            self.load()
+        if key not in self.operators:
+            self.operators[key] = calc_twin_operators(obs_in, flag_all=flag_all)
+            self.save()
+        return self.operators[key]
@@ -39,32 +39,6 @@ class isoform_cluster_handler(object):
         )
         return i_best, txt_out
 
-    def calc_r(self, frame_no, pickle_filename, main_obs, obs_results):
-        # get main observation
-        img_filename_only = ntpath.basename(pickle_filename)
-        txt_out = " {0:40} ==> ".format(img_filename_only)
-        # calculate cc with other observations
-        n_frames = len(obs_results)
-        r_set = np.zeros((1, n_frames))
-        n_refl_common_set = np.zeros((1, n_frames))
-        n_frame_common = 0
-        for j in range(frame_no + 1, n_frames):
-            obs_asu = obs_results[j]
-            corr = main_obs.correlation(obs_asu, assert_is_similar_symmetry=False)
-            c_main, c_other = main_obs.common_sets(
-                obs_asu, assert_is_similar_symmetry=False
-            )
-            if len(c_main.indices()) > 5:
-                r_set[0, j] = corr.coefficient()
-                n_refl_common_set[0, j] = len(c_main.indices())
-                n_frame_common += 1
-        txt_out += " <CC>:%6.2f <N_refl_common>: %6.1f N_frame_common: %6.0f" % (
-            np.mean(r_set),
-            np.mean(n_refl_common_set),
-            n_frame_common,
-        )
-        return r_set, main_obs, txt_out
-
     def optimize(self, r_matrix, flag_plot=False):
         xinp = flex.double([random.random() for i in range(len(r_matrix) * 2)])
         xinp_copy = xinp[:]
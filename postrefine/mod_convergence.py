@@ -0,0 +1,153 @@
+"""
+Description : Skipping of converged frames between post-refinement cycles.
+
+After each cycle, the shift of the refined parameters of every frame (from
+its result of the cycle before) and the change of its CC are kept with the
+reference set it was refined against. In the next cycle a frame is not
+refined again if both were under postref.skip_converged.param_tol and cc_tol
+and the reference intensities of its reflections changed (relative rms) by
+less than reference_tol since. Its previous result is reused as is, or with
+observations and partialities recomputed from the refined parameters
+("refresh") if its rejected reflections or the anomalous flag of its
+observations changed.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from .mod_hkl import miller_index_lookup
+from six.moves import zip
+
+# floors of the denominators of the relative parameter shifts, in the order of
+# postref_results.refined_params (G, B, rotx, roty, ry, rz, r0, re, voigt_nu,
+# a, b, c, alpha, beta, gamma)
+PARAM_SHIFT_FLOORS = np.array(
+    [0.01, 1, 1e-3, 1e-3, 1e-4, 1e-4, 1e-4, 1e-4, 1e-3, 1, 1, 1, 1, 1, 1]
+)
+
+
+def calc_param_shift(pres, pres_prev):
+    """Return the largest relative shift of the refined parameters of pres
+    from those of pres_prev. rotx and roty are already the rotation from the
+    orientation of pres_prev."""
+    x = np.array(list(pres.refined_params), dtype=np.float64)
+    x_prev = np.array(list(pres_prev.refined_params), dtype=np.float64)
+    delta = np.abs(x - x_prev)
+    delta[2:4] = np.abs(x[2:4])
+    scale = np.abs(x_prev)
+    scale[2:4] = 0
+    return np.max(delta / np.maximum(scale, PARAM_SHIFT_FLOORS))
+
+
+def is_same_rejections(rejections, rejections_prev):
+    if rejections is None or rejections_prev is None:
+        return rejections is None and rejections_prev is None
+    return np.array_equal(rejections, rejections_prev)
+
+
+class convergence_handler(object):
+    """Keep the convergence of all frames over post-refinement cycles and
+    choose the frames that are skipped."""
+
+    def __init__(self, iparams):
+        self.iparams = iparams
+        # frame index -> (param_shift, cc_shift, i_iter of the reference,
+        # rejections, avg_mode) of its last refinement
+        self.frame_states = {}
+        # i_iter -> (miller_index_lookup, intensities) of the reference
+        self.references = {}
+
+    def set_reference(self, i_iter, miller_array_ref):
+        """Keep the reference set used in cycle i_iter."""
+        miller_array_ref = miller_array_ref.generate_bijvoet_mates()
+        self.references[i_iter] = (
+            miller_index_lookup(miller_array_ref.indices()),
+            miller_array_ref.data().as_numpy_array(),
+        )
+
+    def get_rejections(self, pickle_filename):
+        if not self.iparams.rejections:
+            return None
+        return self.iparams.rejections.get(pickle_filename)
+
+    def calc_reference_change(self, pres, i_iter_prev, i_iter):
+        """Return relative rms change of the reference intensities of the
+        reflections of pres from cycle i_iter_prev to i_iter."""
+        miller_indices = pres.observations.indices()
+        lookup_prev, I_prev = self.references[i_iter_prev]
+        lookup, I = self.references[i_iter]
+        positions_prev = lookup_prev.get_positions(miller_indices)
+        positions = lookup.get_positions(miller_indices)
+        i_sel = (positions_prev >= 0) & (positions >= 0)
+        if not i_sel.any():
+            return np.inf
+        I_prev_sel = I_prev[positions_prev[i_sel]]
+        I_sel = I[positions[i_sel]]
+        rms_prev = np.sqrt(np.mean(I_prev_sel ** 2))
+        if rms_prev == 0:
+            return np.inf
+        return np.sqrt(np.mean((I_sel - I_prev_sel) ** 2)) / rms_prev
+
+    def get_skip_modes(self, i_iter, pres_set, frame_files, avg_mode):
+        """Return for each frame None (refine), "reuse" or "refresh" in cycle
+        i_iter (set_reference must have been called for it)."""
+        params = self.iparams.postref.skip_converged
+        skip_modes = [None] * len(frame_files)
+        for i_frame, (pres, pickle_filename) in enumerate(zip(pres_set, frame_files)):
+            if pres is None or i_frame not in self.frame_states:
+                continue
+            param_shift, cc_shift, i_iter_ref, rejections, avg_mode_prev = self.frame_states[
+                i_frame
+            ]
+            # (nan shifts are not converged)
+            if not (
+                param_shift <= params.param_tol
+                and cc_shift <= params.cc_tol
+                and self.calc_reference_change(pres, i_iter_ref, i_iter)
+                <= params.reference_tol
+            ):
+                continue
+            if not is_same_rejections(
+                self.get_rejections(pickle_filename), rejections
+            ) or (self.iparams.flag_weak_anomalous and avg_mode != avg_mode_prev):
+                skip_modes[i_frame] = "refresh"
+            else:
+                skip_modes[i_frame] = "reuse"
+        return skip_modes
+
+    def update(
+        self, i_iter, pres_set_prev, pres_set, frame_files, skip_modes, avg_mode
+    ):
+        """Keep the convergence of the frames after cycle i_iter."""
+        if skip_modes is None:
+            skip_modes = [None] * len(frame_files)
+        for i_frame, (pres_prev, pres, pickle_filename, skip_mode) in enumerate(
+            zip(pres_set_prev, pres_set, frame_files, skip_modes)
+        ):
+            if pres is None:
+                self.frame_states.pop(i_frame, None)
+            elif skip_mode is None:
+                if pres_prev is None:
+                    self.frame_states.pop(i_frame, None)
+                else:
+                    self.frame_states[i_frame] = (
+                        calc_param_shift(pres, pres_prev),
+                        abs(pres.CC_final - pres_prev.CC_final),
+                        i_iter,
+                        self.get_rejections(pickle_filename),
+                        avg_mode,
+                    )
+            elif skip_mode == "refresh":
+                param_shift, cc_shift, i_iter_ref, rejections, avg_mode_prev = self.frame_states[
+                    i_frame
+                ]
+                self.frame_states[i_frame] = (
+                    param_shift,
+                    cc_shift,
+                    i_iter_ref,
+                    self.get_rejections(pickle_filename),
+                    avg_mode,
+                )
+        # only keep the reference sets that frames were refined against
+        i_iter_refs = set(state[2] for state in self.frame_states.values())
+        for i_iter_ref in list(self.references):
+            if i_iter_ref not in i_iter_refs:
+                del self.references[i_iter_ref]
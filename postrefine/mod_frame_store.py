@@ -0,0 +1,228 @@
+"""
+Description : Columnar, memory-mapped store of cctbx.xfel integration results.
+
+A frame store is a directory with one flat binary file per column. The
+observation columns (miller_index, I, sigI, mapped_predictions) hold the
+observations of all frames back to back, offsets.bin gives the first row of
+each frame, and the per-frame columns hold wavelength, distance, beam centre,
+pixel size, unit cell and crystal orientation. Frames in a store are
+addressed as store_path:ind#no, the same way as members of a tar file.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import numpy as np
+from six.moves import cPickle as pickle
+from six.moves import range
+
+FRAME_STORE_INDEX = "frame_store.pickle"
+FRAME_STORE_VERSION = 1
+
+# column name: (dtype, no. of components per row)
+OBSERVATION_COLUMNS = {
+    "miller_index": (np.int32, 3),
+    "I": (np.float64, 1),
+    "sigI": (np.float64, 1),
+    "mapped_predictions": (np.float64, 2),
+}
+FRAME_COLUMNS = {
+    "wavelength": (np.float64, 1),
+    "distance": (np.float64, 1),
+    "xbeam": (np.float64, 1),
+    "ybeam": (np.float64, 1),
+    "pixel_size": (np.float64, 1),
+    "unit_cell": (np.float64, 6),
+    "orientation": (np.float64, 9),
+}
+
+# frame stores opened by this process
+_frame_stores = {}
+
+
+def is_frame_store(path):
+    return os.path.isfile(os.path.join(path, FRAME_STORE_INDEX))
+
+
+def get_frame_store(store_path):
+    """Return the (per-process) opened frame store at store_path."""
+    store_path = os.path.abspath(store_path)
+    if store_path not in _frame_stores:
+        _frame_stores[store_path] = frame_store_handler(store_path)
+    return _frame_stores[store_path]
+
+
+class frame_store_handler(object):
+    """Read-only access to a frame store.
+
+    All column arrays are np.memmap objects, slices taken from them by
+    get_columns are views into the mapped files (no copy).
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, FRAME_STORE_INDEX), "rb") as f:
+            self.index = pickle.load(f)
+        n_frames = len(self.index["frame_files"])
+        n_obs = self.index["n_observations"]
+        self.offsets = self._memmap("offsets", np.int64, 1, n_frames + 1)
+        self.columns = {}
+        for name, (dtype, n_comp) in OBSERVATION_COLUMNS.items():
+            self.columns[name] = self._memmap(name, dtype, n_comp, n_obs)
+        for name, (dtype, n_comp) in FRAME_COLUMNS.items():
+            self.columns[name] = self._memmap(name, dtype, n_comp, n_frames)
+
+    def _memmap(self, name, dtype, n_comp, n_rows):
+        shape = (n_rows,) if n_comp == 1 else (n_rows, n_comp)
+        if n_rows == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(
+            os.path.join(self.store_path, name + ".bin"),
+            dtype=dtype,
+            mode="r",
+            shape=shape,
+        )
+
+    def get_size(self):
+        return len(self.index["frame_files"])
+
+    def get_frame_names(self):
+        return [self.store_path + ":ind" + str(i) for i in range(self.get_size())]
+
+    def get_original_filename(self, i_frame):
+        return self.index["frame_files"][i_frame]
+
+    def get_columns(self, i_frame):
+        """Return zero-copy slices of all columns for frame i_frame."""
+        i_st, i_en = self.offsets[i_frame], self.offsets[i_frame + 1]
+        columns = {}
+        for name in OBSERVATION_COLUMNS:
+            columns[name] = self.columns[name][i_st:i_en]
+        for name in FRAME_COLUMNS:
+            columns[name] = self.columns[name][i_frame]
+        return columns
+
+    def get_frame(self, i_frame):
+        """Return frame i_frame as a cctbx.xfel integration dictionary."""
+        from cctbx import crystal, miller
+        from cctbx.array_family import flex
+        from cctbx.crystal_orientation import crystal_orientation, basis_type
+
+        columns = self.get_columns(i_frame)
+        crystal_symmetry = crystal.symmetry(
+            unit_cell=tuple(columns["unit_cell"]),
+            space_group_symbol=self.index["space_group"][i_frame],
+        )
+        miller_set = miller.set(
+            crystal_symmetry=crystal_symmetry,
+            # (n,3) int32 column to flex.miller_index in one conversion
+            indices=flex.miller_index(
+                flex.vec3_double(
+                    np.ascontiguousarray(columns["miller_index"], dtype=np.float64)
+                ).iround()
+            ),
+            anomalous_flag=self.index["anomalous_flag"][i_frame],
+        )
+        observations = miller_set.array(
+            data=flex.double(np.ascontiguousarray(columns["I"])),
+            sigmas=flex.double(np.ascontiguousarray(columns["sigI"])),
+        ).set_observation_type_xray_intensity()
+        frame = {
+            "observations": [observations],
+            "mapped_predictions": [
+                flex.vec2_double(np.ascontiguousarray(columns["mapped_predictions"]))
+            ],
+            "wavelength": float(columns["wavelength"]),
+            "distance": float(columns["distance"]),
+            "xbeam": float(columns["xbeam"]),
+            "ybeam": float(columns["ybeam"]),
+            "current_orientation": [
+                crystal_orientation(tuple(columns["orientation"]), basis_type.direct)
+            ],
+        }
+        if not np.isnan(columns["pixel_size"]):
+            frame["pixel_size"] = float(columns["pixel_size"])
+        if self.index["identified_isoform"][i_frame] is not None:
+            frame["identified_isoform"] = self.index["identified_isoform"][i_frame]
+        return frame
+
+
+def build_frame_store(frame_files, store_path):
+    """Convert integration pickles (or tar members) in frame_files to a frame
+    store at store_path.
+
+    Observations are streamed to disk frame by frame so that the memory
+    use does not depend on the size of the dataset.
+    """
+    from .mod_input import read_frame
+
+    os.makedirs(store_path)
+    obs_files = dict(
+        (name, open(os.path.join(store_path, name + ".bin"), "wb"))
+        for name in OBSERVATION_COLUMNS
+    )
+    frame_values = dict((name, []) for name in FRAME_COLUMNS)
+    index = {
+        "version": FRAME_STORE_VERSION,
+        "frame_files": [],
+        "space_group": [],
+        "anomalous_flag": [],
+        "identified_isoform": [],
+    }
+    offsets = [0]
+    txt_out = ""
+    try:
+        for frame_file in frame_files:
+            observations_pickle = read_frame(frame_file)
+            if observations_pickle is None or "observations" not in observations_pickle:
+                txt_out += " {0:40} ==> skipped (empty or not a cctbx.xfel pickle)\n".format(
+                    os.path.basename(frame_file)
+                )
+                continue
+            observations = observations_pickle["observations"][0]
+            columns = {
+                "miller_index": np.array(observations.indices(), dtype=np.int32),
+                "I": observations.data().as_numpy_array(),
+                "sigI": observations.sigmas().as_numpy_array(),
+                "mapped_predictions": np.array(
+                    observations_pickle["mapped_predictions"][0], dtype=np.float64
+                ),
+            }
+            for name, (dtype, n_comp) in OBSERVATION_COLUMNS.items():
+                columns[name].astype(dtype).tofile(obs_files[name])
+            offsets.append(offsets[-1] + observations.size())
+            frame_values["wavelength"].append(observations_pickle["wavelength"])
+            frame_values["distance"].append(observations_pickle["distance"])
+            frame_values["xbeam"].append(observations_pickle["xbeam"])
+            frame_values["ybeam"].append(observations_pickle["ybeam"])
+            frame_values["pixel_size"].append(
+                observations_pickle.get("pixel_size", np.nan)
+            )
+            frame_values["unit_cell"].append(observations.unit_cell().parameters())
+            frame_values["orientation"].append(
+                observations_pickle["current_orientation"][0].direct_matrix()
+            )
+            index["frame_files"].append(frame_file)
+            index["space_group"].append(
+                "Hall: " + observations.space_group_info().type().hall_symbol()
+            )
+            index["anomalous_flag"].append(observations.anomalous_flag())
+            index["identified_isoform"].append(
+                observations_pickle.get("identified_isoform", None)
+            )
+    finally:
+        for f in obs_files.values():
+            f.close()
+    for name, (dtype, n_comp) in FRAME_COLUMNS.items():
+        np.array(frame_values[name], dtype=dtype).tofile(
+            os.path.join(store_path, name + ".bin")
+        )
+    np.array(offsets, dtype=np.int64).tofile(os.path.join(store_path, "offsets.bin"))
+    index["n_observations"] = offsets[-1]
+    # the index is written last, an interrupted build is not a valid store
+    with open(os.path.join(store_path, FRAME_STORE_INDEX), "wb") as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    txt_out += "Frame store %s: %d frames, %d observations\n" % (
+        store_path,
+        len(index["frame_files"]),
+        index["n_observations"],
+    )
+    return txt_out
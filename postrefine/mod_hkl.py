@@ -0,0 +1,93 @@
+"""
+Description : Packing of miller indices to integer keys for fast set operations.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+# each of h, k, l is stored with an offset in 21 bits
+HKL_BITS = 21
+HKL_OFFSET = 1 << (HKL_BITS - 1)
+
+
+def miller_indices_as_numpy(miller_indices):
+    """Return miller indices (flex.miller_index, list of tuples or array) as an
+    (n,3) int64 numpy array."""
+    if hasattr(miller_indices, "as_vec3_double"):
+        miller_indices = miller_indices.as_vec3_double().as_double().as_numpy_array()
+    return np.asarray(miller_indices, dtype=np.int64).reshape(-1, 3)
+
+
+def pack_miller_indices(miller_indices):
+    """Return int64 keys of miller indices, one key per (h,k,l)."""
+    hkl = miller_indices_as_numpy(miller_indices) + HKL_OFFSET
+    return (hkl[:, 0] << (2 * HKL_BITS)) | (hkl[:, 1] << HKL_BITS) | hkl[:, 2]
+
+
+def unpack_miller_indices(keys):
+    """Return (n,3) int64 array of miller indices from keys."""
+    keys = np.asarray(keys, dtype=np.int64)
+    mask = (1 << HKL_BITS) - 1
+    hkl = np.empty((len(keys), 3), dtype=np.int64)
+    hkl[:, 0] = (keys >> (2 * HKL_BITS)) & mask
+    hkl[:, 1] = (keys >> HKL_BITS) & mask
+    hkl[:, 2] = keys & mask
+    return hkl - HKL_OFFSET
+
+
+def get_rejection_selection(miller_indices, rejected_keys):
+    """Return numpy bool array, False for miller indices in rejected_keys
+    (sorted int64 keys as stored in iparams.rejections)."""
+    return ~np.isin(pack_miller_indices(miller_indices), rejected_keys)
+
+
+def search_sorted_keys(keys_sorted, keys):
+    """Return (rows, obs_rows): positions in keys_sorted (sorted, unique) of
+    the keys found there and their positions in keys, in the order of keys."""
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(keys_sorted) == 0 or len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows = np.searchsorted(keys_sorted, keys)
+    rows[rows == len(keys_sorted)] = 0
+    obs_rows = np.flatnonzero(keys_sorted[rows] == keys)
+    return rows[obs_rows], obs_rows
+
+
+class miller_index_lookup(object):
+    """Index of unique miller indices by packed key.
+
+    Build once from a reference set and use lookup() to match any number of
+    frames against it (as miller.match_multi_indices, without rebuilding the
+    index for every call).
+    """
+
+    def __init__(self, miller_indices_unique):
+        keys = pack_miller_indices(miller_indices_unique)
+        self.order = np.argsort(keys, kind="mergesort")
+        self.keys_sorted = keys[self.order]
+
+    def size(self):
+        return len(self.keys_sorted)
+
+    def lookup(self, miller_indices):
+        """Return (ref_rows, obs_rows) numpy int64 arrays of matching pairs,
+        in the order of miller_indices."""
+        rows, obs_rows = search_sorted_keys(
+            self.keys_sorted, pack_miller_indices(miller_indices)
+        )
+        return self.order[rows], obs_rows
+
+    def get_positions(self, miller_indices):
+        """Return for each of miller_indices its row in the reference or -1."""
+        ref_rows, obs_rows = self.lookup(miller_indices)
+        positions = np.full(
+            len(miller_indices_as_numpy(miller_indices)), -1, dtype=np.int64
+        )
+        positions[obs_rows] = ref_rows
+        return positions
+
+
+def match_miller_indices(miller_indices_unique, miller_indices):
+    """Return for each of miller_indices its position in miller_indices_unique
+    or -1 if it is not there (as miller.match_multi_indices, as a numpy
+    int64 array)."""
+    return miller_index_lookup(miller_indices_unique).get_positions(miller_indices)
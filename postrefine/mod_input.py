@@ -30,6 +30,7 @@ import iotbx.phil
 from libtbx.utils import Usage, Sorry
 import sys, os, shutil, glob, tarfile
 from six.moves import cPickle as pickle
+from .mod_frame_store import is_frame_store, get_frame_store
 
 master_phil = iotbx.phil.parse(
     """
@@ -95,6 +96,39 @@ postref
     .type = float
     .help = Percent increase in residual (xy) allowed during microcycle.
     .alias = Residual XY threshold
+  solver = *lbfgs lm
+    .type = choice
+    .help = Minimizer of the per-frame refinement: L-BFGS on the sum of \
+            squared residuals (lbfgs) or Levenberg-Marquardt on the residual \
+            vector with bounds on the mosaicity parameters (lm).
+    .expert_level = 2
+  flag_analytic_gradient = False
+    .type = bool
+    .help = Use analytic derivatives of the residuals for the L-BFGS gradient \
+            (or the Levenberg-Marquardt Jacobian) instead of finite differences \
+            (kept for the ry, rz, r0, re and nu derivatives of the Lognormal \
+            model, whose sigma is looked up on a grid).
+    .expert_level = 2
+  skip_converged
+    .help = Reuse the result of the previous cycle for frames that converged: \
+            their refined parameters and CC changed less than param_tol and \
+            cc_tol in their last refinement and the reference intensities \
+            of their reflections changed less than reference_tol since.
+    .expert_level = 2
+  {
+    flag_on = False
+      .type = bool
+      .help = Set to True to skip converged frames.
+    param_tol = 0.01
+      .type = float
+      .help = Maximum relative shift of the refined parameters.
+    cc_tol = 0.005
+      .type = float
+      .help = Maximum change of CC.
+    reference_tol = 0.01
+      .type = float
+      .help = Maximum relative rms change of the reference intensities.
+  }
   scale
     .help = Scale factors
     .style = grid:auto
@@ -399,6 +433,13 @@ n_processors = 32
   .help = No. of processing units
   .optional = True
   .alias = No. processors
+flag_worker_pool = False
+  .type = bool
+  .help = Set to True to run prime.postrefine on long-lived worker processes. \
+          Each worker keeps a fixed set of frames with their prepared \
+          observations and post-refinement results, and only receives the \
+          reference set and parameters once per cycle.
+  .expert_level = 1
 gamma_e = 0.003
   .type = float
   .help = Initial spread of the energy spectrum (1/Angstrom).
@@ -486,6 +527,20 @@ isoform_cluster
     .help = No. of frames used in Auto solution mode. The rest of the frame data will be determined against this merged dataset.
     .alias = No. of selected frames
 }
+input_cache
+  .help = "Cache of prepared observations (see postref_handler.organize_input) reused by all stages and cycles."
+  .expert_level = 1
+{
+  flag_on = False
+    .type = bool
+    .help = Turn this flag on to cache prepared observations.
+  max_memory_mb = 1024
+    .type = float
+    .help = Maximum memory (MB) used by the in-memory cache in each process. Least recently used entries are evicted first.
+  spill_dir = None
+    .type = path
+    .help = Directory used to keep cached observations on disk. Entries written here are shared between processes and reused in later runs.
+}
 rejections = None
   .type = str
   .help = Dict of integration filenames and their rejected miller indices.
@@ -644,8 +699,12 @@ def process_input(argv=None, flag_mkdir=True):
 def read_pickles(data):
     frame_files = []
     tar_files = []
+    store_files = []
     for p in data:
         is_tar = False
+        if is_frame_store(p):
+            store_files.extend(get_frame_store(p).get_frame_names())
+            continue
         if p.find("tar") >= 0:
             is_tar = True
         if os.path.isdir(p) == False:
@@ -659,22 +718,96 @@ def read_pickles(data):
         else:
             file_list = glob.glob(os.path.join(p, "*"))
         frame_files.extend(file_list)
-    if len(frame_files) == 0:
+    if len(frame_files) == 0 and len(store_files) == 0:
         raise InvalidData(
             "Error: no integration results found in the specified data parameter."
         )
     if not is_tar:
-        return frame_files
+        return store_files + frame_files
     # take care of tar files
     for tar_filename in frame_files:
-        tarf = tarfile.open(name=tar_filename, mode="r")
-        for myindex in xrange(len(tarf.getmembers())):
+        if tar_filename.endswith(TAR_INDEX_EXT):
+            continue
+        for myindex in range(len(get_tar_index(tar_filename)["members"])):
             tar_files.append(tar_filename + ":ind" + str(myindex))
-    return tar_files
+    return store_files + tar_files
+
+
+TAR_INDEX_EXT = ".idx"
+# tar indices and open tar files of this process, keyed by tar filename
+_tar_indices = {}
+_tar_handles = {}
+_tar_handles_pid = None
+
+
+def build_tar_index(tar_filename):
+    """Return index of a tar file as a dictionary with
+    members: list of (name, offset, size) of the payload of each member
+    seekable: True if payloads can be read directly from the tar file
+    (False for compressed tar files)."""
+    try:
+        tarf = tarfile.open(name=tar_filename, mode="r:")
+        seekable = True
+    except tarfile.ReadError:
+        tarf = tarfile.open(name=tar_filename, mode="r")
+        seekable = False
+    members = [
+        (member.name, member.offset_data, member.size) for member in tarf.getmembers()
+    ]
+    tarf.close()
+    return {"members": members, "seekable": seekable}
+
+
+def get_tar_index(tar_filename):
+    """Return the tar index, from memory, from tar_filename + TAR_INDEX_EXT if
+    it is newer than the tar file, or build (and persist) a new one."""
+    if tar_filename in _tar_indices:
+        return _tar_indices[tar_filename]
+    index_filename = tar_filename + TAR_INDEX_EXT
+    tar_index = None
+    if os.path.isfile(index_filename) and os.path.getmtime(
+        index_filename
+    ) >= os.path.getmtime(tar_filename):
+        try:
+            with open(index_filename, "rb") as f:
+                tar_index = pickle.load(f)
+        except Exception:
+            tar_index = None
+    if tar_index is None:
+        tar_index = build_tar_index(tar_filename)
+        try:
+            with open(index_filename, "wb") as f:
+                pickle.dump(tar_index, f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError):
+            # read-only location, keep the index in memory only
+            pass
+    _tar_indices[tar_filename] = tar_index
+    return tar_index
+
+
+def read_tar_member(tar_filename, member_index):
+    """Unpickle member member_index of tar_filename. Uncompressed tar files
+    are read by seeking to the payload on one file handle per process."""
+    global _tar_handles_pid
+    tar_index = get_tar_index(tar_filename)
+    if not tar_index["seekable"]:
+        tarf = tarfile.open(name=tar_filename, mode="r")
+        tar_member = tarf.extractfile(member=tarf.getmembers()[member_index])
+        return pickle.load(tar_member)
+    if _tar_handles_pid != os.getpid():
+        # forked worker, do not share file offsets with the parent process
+        _tar_handles.clear()
+        _tar_handles_pid = os.getpid()
+    if tar_filename not in _tar_handles:
+        _tar_handles[tar_filename] = open(tar_filename, "rb")
+    name, offset, size = tar_index["members"][member_index]
+    f = _tar_handles[tar_filename]
+    f.seek(offset)
+    return pickle.loads(f.read(size))
 
 
 def read_frame(frame_file):
-    """A frame_file can be .pickle or .tar:ind#no.
+    """A frame_file can be .pickle, .tar:ind#no or frame_store:ind#no.
 
     Read accordingly and return integration pickle
     """
@@ -682,11 +815,14 @@ def read_frame(frame_file):
     try:
         if frame_file.endswith(".pickle"):
             observations_pickle = pickle.load(open(frame_file, "rb"))
+        elif os.path.isdir(frame_file.split(":ind")[0]):
+            store_path, store_index = frame_file.split(":ind")
+            observations_pickle = get_frame_store(store_path).get_frame(
+                int(store_index)
+            )
         else:
             tar_filename, tar_index = frame_file.split(":ind")
-            tarf = tarfile.open(name=tar_filename, mode="r")
-            tar_member = tarf.extractfile(member=tarf.getmembers()[int(tar_index)])
-            observations_pickle = pickle.load(tar_member)
+            observations_pickle = read_tar_member(tar_filename, int(tar_index))
     except Exception:
         print("Warning: unable to read %s" % (frame_file))
         pass
@@ -0,0 +1,160 @@
+"""
+Description : Content-addressed cache of prepared observations (results of
+              postref_handler.organize_input).
+
+A cache key is computed from the frame path, the modification time of the file
+(or of the tar file / frame store that contains it) and the values of the
+input parameters that organize_input reads. Entries are kept pickled in an
+LRU ordered dictionary bounded by max_memory_mb and, if spill_dir is given,
+also written to disk so that other processes and later runs can reuse them.
+"""
+from __future__ import absolute_import, division, print_function
+import os, hashlib
+import numpy as np
+from collections import OrderedDict
+from six.moves import cPickle as pickle
+from .mod_frame_store import FRAME_STORE_INDEX
+
+# one cache per process
+_input_cache = None
+
+
+def get_input_cache(iparams):
+    """Return the input cache of this process or None if caching is off."""
+    if _input_cache is None:
+        if not iparams.input_cache.flag_on:
+            return None
+        set_input_cache(iparams)
+    return _input_cache
+
+
+def set_input_cache(iparams):
+    """Turn on the input cache of this process (regardless of
+    input_cache.flag_on) and return it."""
+    global _input_cache
+    _input_cache = input_cache_handler(
+        max_memory_mb=iparams.input_cache.max_memory_mb,
+        spill_dir=iparams.input_cache.spill_dir,
+    )
+    return _input_cache
+
+
+def get_frame_mtime(pickle_filename):
+    """Return modification time of the file that holds the frame."""
+    container = pickle_filename.split(":ind")[0]
+    if os.path.isdir(container):
+        container = os.path.join(container, FRAME_STORE_INDEX)
+    return os.path.getmtime(container)
+
+
+def get_target_anomalous_flag(iparams, avg_mode):
+    """Return anomalous flag of the observations prepared by organize_input,
+    the only use it has of avg_mode."""
+    if iparams.flag_weak_anomalous and avg_mode != "final":
+        return False
+    return iparams.target_anomalous_flag
+
+
+def get_params_fingerprint(iparams, avg_mode, pickle_filename):
+    """Return values of all input parameters used by organize_input (avg_mode
+    only through the anomalous flag, so that scaling and all post-refinement
+    cycles share entries)."""
+    rejections = None
+    if iparams.rejections and pickle_filename in iparams.rejections:
+        rejections = hashlib.sha1(
+            np.ascontiguousarray(iparams.rejections[pickle_filename]).tobytes()
+        ).hexdigest()
+    return (
+        get_target_anomalous_flag(iparams, avg_mode),
+        iparams.isoform_name,
+        str(iparams.target_space_group),
+        str(iparams.target_unit_cell),
+        iparams.target_crystal_system,
+        iparams.flag_override_unit_cell,
+        iparams.pixel_size_mm,
+        iparams.flag_LP_correction,
+        iparams.polarization_horizontal_fraction,
+        iparams.merge.d_min,
+        iparams.merge.d_max,
+        iparams.merge.sigma_min,
+        iparams.icering.flag_on,
+        iparams.icering.d_upper,
+        iparams.icering.d_lower,
+        iparams.flag_replace_sigI,
+        rejections,
+    )
+
+
+class input_cache_handler(object):
+    """LRU cache of pickled organize_input results, optionally backed by disk."""
+
+    def __init__(self, max_memory_mb=1024, spill_dir=None):
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.spill_dir = spill_dir
+        if self.spill_dir is not None and not os.path.isdir(self.spill_dir):
+            try:
+                os.makedirs(self.spill_dir)
+            except OSError:
+                # created by another process
+                pass
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get_key(self, pickle_filename, iparams, avg_mode):
+        fingerprint = (
+            pickle_filename,
+            get_frame_mtime(pickle_filename),
+            get_params_fingerprint(iparams, avg_mode, pickle_filename),
+        )
+        return hashlib.sha1(repr(fingerprint).encode("utf-8")).hexdigest()
+
+    def _get_spill_filename(self, key):
+        return os.path.join(self.spill_dir, key + ".pickle")
+
+    def _add(self, key, data):
+        self.entries[key] = data
+        self.n_bytes += len(data)
+        while self.n_bytes > self.max_memory_bytes and self.entries:
+            dummy, data_evicted = self.entries.popitem(last=False)
+            self.n_bytes -= len(data_evicted)
+
+    def get(self, key):
+        """Return cached result for key or None."""
+        data = self.entries.pop(key, None)
+        if data is not None:
+            # move to the most recently used end
+            self.entries[key] = data
+        elif self.spill_dir is not None and os.path.isfile(
+            self._get_spill_filename(key)
+        ):
+            try:
+                with open(self._get_spill_filename(key), "rb") as f:
+                    data = f.read()
+            except (IOError, OSError):
+                data = None
+            if data is not None:
+                self._add(key, data)
+        if data is None:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        return pickle.loads(data)
+
+    def put(self, key, result):
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        if key in self.entries:
+            self.n_bytes -= len(self.entries.pop(key))
+        self._add(key, data)
+        if self.spill_dir is not None:
+            spill_filename = self._get_spill_filename(key)
+            if not os.path.isfile(spill_filename):
+                # write then rename so readers never see a partial entry
+                tmp_filename = spill_filename + ".%d.tmp" % (os.getpid())
+                try:
+                    with open(tmp_filename, "wb") as f:
+                        f.write(data)
+                    os.rename(tmp_filename, spill_filename)
+                except (IOError, OSError):
+                    pass
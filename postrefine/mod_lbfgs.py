@@ -12,7 +12,7 @@ class lbfgs_handler(object):
     def __init__(
         self,
         current_x=None,
-        args=None,
+        context=None,
         min_iterations=0,
         max_iterations=None,
         max_calls=1000,
@@ -20,7 +20,7 @@ class lbfgs_handler(object):
     ):
         self.n = current_x.size()
         self.x = current_x
-        self.args = args
+        self.context = context
         self.minimizer = lbfgs.run(
             target_evaluator=self,
             termination_params=lbfgs.termination_parameters(
@@ -39,11 +39,20 @@ class lbfgs_handler(object):
                 ignore_search_direction_not_descent=False,
             ),
         )
+        self.n_iterations = self.minimizer.iter()
+        self.n_calls = self.minimizer.nfun()
 
     def compute_functional_and_gradients(self):
         lp_h = lbfgs_partiality_handler()
+        if self.context.iparams.postref.flag_analytic_gradient:
+            fvec, jacobian = lp_h.func_and_jacobian(self.x, self.context)
+            if fvec is not None:
+                # gradient of sum(fvec^2) by the chain rule
+                self.f = flex.sum(fvec * fvec)
+                self.g = flex.double([2 * flex.sum(fvec * dfvec) for dfvec in jacobian])
+                return self.f, self.g
         # calculate sum_sqr of the function
-        fvec = lp_h.func(self.x, self.args)
+        fvec = lp_h.func(self.x, self.context)
         self.f = flex.sum(fvec * fvec)
         # calculate gradient for each parameter
         DELTA = 1.0e-7
@@ -52,7 +61,7 @@ class lbfgs_handler(object):
             templist = list(self.x)
             templist[x] += DELTA
             dvalues = flex.double(templist)
-            dfvec = lp_h.func(dvalues, self.args)
+            dfvec = lp_h.func(dvalues, self.context)
             df = flex.sum(dfvec * dfvec)
             # calculate by finite_difference
             self.g.append((df - self.f) / DELTA)
@@ -1,7 +1,9 @@
 from __future__ import absolute_import, division, print_function
 from cctbx.array_family import flex
 from cctbx.uctbx import unit_cell
+from scitbx.matrix import col
 from .mod_partiality import partiality_handler
+import copy
 
 """
 lbfgs_partiality_handler
@@ -9,6 +11,121 @@ calculate the minimization function according to given arguments and return sum(
 """
 
 
+class refinement_context(object):
+    """Observations of one frame and all quantities derived from them that
+    stay constant during post-refinement.
+
+    Built once per frame and passed to lbfgs_partiality_handler in place of
+    the args tuple. select() returns the context of a subset of reflections
+    and for_mode() a (shallow) copy set up for one refinement mode.
+    """
+
+    # per-reflection arrays, subsets are taken with select()
+    REFLECTION_ATTRS = (
+        "I_r",
+        "I_o",
+        "sigI_o",
+        "miller_indices",
+        "hkl",
+        "alpha_angle_set",
+        "spot_pred_x_mm_set",
+        "spot_pred_y_mm_set",
+        "two_theta",
+        "tan_two_theta",
+        "sin_theta_over_lambda_sq",
+        "cos_sq_alpha",
+        "sin_sq_alpha",
+        "partiality_init",
+        "rs_init",
+    )
+
+    def __init__(
+        self,
+        I_r,
+        miller_array_o,
+        wavelength,
+        alpha_angle_set,
+        crystal_init_orientation,
+        spot_pred_x_mm_set,
+        spot_pred_y_mm_set,
+        detector_distance_mm,
+        iparams,
+        miller_array_iso=None,
+    ):
+        self.I_r = I_r
+        self.miller_array_o = miller_array_o
+        self.wavelength = wavelength
+        self.alpha_angle_set = alpha_angle_set
+        self.crystal_init_orientation = crystal_init_orientation
+        self.spot_pred_x_mm_set = spot_pred_x_mm_set
+        self.spot_pred_y_mm_set = spot_pred_y_mm_set
+        self.detector_distance_mm = detector_distance_mm
+        self.iparams = iparams
+        self.miller_array_iso = miller_array_iso
+        self.refine_mode = None
+        self.const_params = None
+        self.b0 = None
+        # partiality and rs with the initial parameters, if precomputed (see
+        # leastsqr_handler.calc_partiality_init_batch)
+        self.partiality_init = None
+        self.rs_init = None
+        # two_theta only depends on the (fixed) cell of the observations,
+        # also when the unit cell is refined.
+        two_theta = miller_array_o.two_theta(wavelength=wavelength)
+        self.two_theta = two_theta.data()
+        self.tan_two_theta = flex.tan(self.two_theta)
+        self.sin_theta_over_lambda_sq = two_theta.sin_theta_over_lambda_sq().data()
+        self.I_o = miller_array_o.data()
+        self.sigI_o = miller_array_o.sigmas()
+        self.miller_indices = miller_array_o.indices()
+        self.hkl = self.miller_indices.as_vec3_double()
+        if iparams.flag_beam_divergence:
+            self.cos_sq_alpha = flex.cos(alpha_angle_set) ** 2
+            self.sin_sq_alpha = flex.sin(alpha_angle_set) ** 2
+        else:
+            self.cos_sq_alpha = None
+            self.sin_sq_alpha = None
+        self.cs = miller_array_o.crystal_symmetry().space_group().crystal_system()
+        self.S0 = -1 * col((0, 0, 1.0 / wavelength))
+        self._set_frame_flags()
+
+    def _set_frame_flags(self):
+        self.size = len(self.I_o)
+        self.flag_refine_b = (
+            self.size > 0 and self.miller_array_o.d_min() < self.iparams.b_refine_d_min
+        )
+        # hack for dials integration - spot_pred_x_mm_set is s1
+        self.flag_dials = sum(self.spot_pred_y_mm_set) == 0
+
+    def select(self, selection):
+        """Return the context of the reflections in selection."""
+        context = copy.copy(self)
+        context.miller_array_o = self.miller_array_o.select(selection)
+        for attr in self.REFLECTION_ATTRS:
+            values = getattr(self, attr)
+            if values is not None:
+                setattr(context, attr, values.select(selection))
+        context._set_frame_flags()
+        return context
+
+    def for_mode(self, refine_mode, const_params, b0):
+        """Return a copy of this context that refines refine_mode with the
+        remaining parameters fixed to const_params."""
+        context = copy.copy(self)
+        context.refine_mode = refine_mode
+        context.const_params = const_params
+        context.b0 = b0
+        return context
+
+    def calc_spot_radius_set(self, ry, rz, r0, re):
+        rs_set = r0 + (re * self.tan_two_theta)
+        if self.iparams.flag_beam_divergence:
+            rs_set += (
+                ((ry ** 2) * self.cos_sq_alpha) + ((rz ** 2) * self.sin_sq_alpha)
+            ) ** (1 / 2)
+        return rs_set
+
+
 class lbfgs_partiality_handler(object):
     """lbfgs_handler optimizes set of parameters (params) by fitting data[0] to
     data [1] using given function (func)."""
@@ -48,34 +165,12 @@ class lbfgs_partiality_handler(object):
             xopt = flex.double([params[0], params[0], params[0], 90, 90, 90])
         return xopt
 
-    def func(self, params, args):
-        I_r = args[0]
-        miller_array_o = args[1]
-        wavelength = args[2]
-        alpha_angle_set = args[3]
-        crystal_init_orientation = args[4]
-        spot_pred_x_mm_set = args[5]
-        spot_pred_y_mm_set = args[6]
-        detector_distance_mm = args[7]
-        refine_mode = args[8]
-        const_params = args[9]
-        b0 = args[10]
-        miller_array_iso = args[11]
-        iparams = args[12]
-        partiality_model = iparams.partiality_model
-        flag_volume_correction = iparams.flag_volume_correction
-        flag_beam_divergence = iparams.flag_beam_divergence
-        b_refine_d_min = iparams.b_refine_d_min
-        I_o = miller_array_o.data()
-        sigI_o = miller_array_o.sigmas()
-        miller_indices_original = miller_array_o.indices()
-        sin_theta_over_lambda_sq = (
-            miller_array_o.two_theta(wavelength=wavelength)
-            .sin_theta_over_lambda_sq()
-            .data()
-        )
-        two_theta_flex = miller_array_o.two_theta(wavelength=wavelength).data()
-        cs = miller_array_o.crystal_symmetry().space_group().crystal_system()
+    def get_params(self, params, context):
+        """Return all 15 parameters (G, B, rotx, roty, ry, rz, r0, re, nu, a,
+        b, c, alpha, beta, gamma) from the refined params and
+        context.const_params."""
+        refine_mode = context.refine_mode
+        const_params = context.const_params
         if refine_mode == "scale_factor":
             G, B = params
             rotx, roty, ry, rz, r0, re, nu, a, b, c, alpha, beta, gamma = const_params
@@ -86,66 +181,221 @@ class lbfgs_partiality_handler(object):
             ry, rz, r0, re, nu = params
             G, B, rotx, roty, a, b, c, alpha, beta, gamma = const_params
         elif refine_mode == "unit_cell":
-            a, b, c, alpha, beta, gamma = self.prep_output(params, cs)
+            a, b, c, alpha, beta, gamma = self.prep_output(params, context.cs)
             G, B, rotx, roty, ry, rz, r0, re, nu = const_params
         elif refine_mode == "allparams":
-            a, b, c, alpha, beta, gamma = self.prep_output(params[7:], cs)
+            a, b, c, alpha, beta, gamma = self.prep_output(params[7:], context.cs)
             rotx, roty, ry, rz, r0, re, nu = params[0:7]
             G, B = const_params
+        return G, B, rotx, roty, ry, rz, r0, re, nu, a, b, c, alpha, beta, gamma
+
+    def calc_delta_xy(self, sd_array, context):
+        if context.flag_dials:
+            diff_xy = context.spot_pred_x_mm_set - sd_array
+        else:
+            sd_x, sd_y, sd_z = sd_array.parts()
+            d_ratio = -context.detector_distance_mm / sd_z
+            diff_xy = flex.vec3_double(
+                context.spot_pred_x_mm_set - (sd_x * d_ratio),
+                context.spot_pred_y_mm_set - (sd_y * d_ratio),
+                flex.double(len(d_ratio), 0),
+            )
+        return diff_xy
+
+    def func(self, params, context):
+        """Return residuals of the refinement set up in context (a
+        refinement_context) at params."""
+        iparams = context.iparams
+        G, B, rotx, roty, ry, rz, r0, re, nu, a, b, c, alpha, beta, gamma = self.get_params(
+            params, context
+        )
         try:
             uc = unit_cell((a, b, c, alpha, beta, gamma))
         except Exception:
             return None
-        G, B, rotx, roty, ry, rz, r0, re, nu, a, b, c, alpha, beta, gamma = flex.double(
-            [G, B, rotx, roty, ry, rz, r0, re, nu, a, b, c, alpha, beta, gamma]
-        )
         ph = partiality_handler()
-        p_calc_flex, delta_xy_flex, rs_set, dummy = ph.calc_partiality_anisotropy_set(
-            uc,
-            rotx,
-            roty,
-            miller_indices_original,
-            ry,
-            rz,
-            r0,
-            re,
-            nu,
-            two_theta_flex,
-            alpha_angle_set,
-            wavelength,
-            crystal_init_orientation,
-            spot_pred_x_mm_set,
-            spot_pred_y_mm_set,
-            detector_distance_mm,
-            partiality_model,
-            flag_beam_divergence,
+        A_star = ph.calc_reciprocal_matrix(
+            uc, rotx, roty, context.crystal_init_orientation
         )
-        if miller_array_o.d_min() < b_refine_d_min:
-            I_o_full = ph.calc_full_refl(
-                I_o,
-                sin_theta_over_lambda_sq,
-                G,
-                B,
-                p_calc_flex,
-                rs_set,
-                flag_volume_correction,
+        sd_array = A_star.elems * context.hkl + context.S0.elems
+        if context.refine_mode == "unit_cell":
+            return self.calc_delta_xy(sd_array, context).norms()
+        rs_set = context.calc_spot_radius_set(ry, rz, r0, re)
+        rh_set = sd_array.norms() - (1 / context.wavelength)
+        p_calc_flex = ph.calc_partiality(rh_set, rs_set, nu, iparams.partiality_model)
+        I_o_full = ph.calc_full_refl(
+            context.I_o,
+            context.sin_theta_over_lambda_sq,
+            G,
+            B if context.flag_refine_b else context.b0,
+            p_calc_flex,
+            rs_set,
+            iparams.flag_volume_correction,
+        )
+        error = (context.I_r - I_o_full) / context.sigI_o
+        return error
+
+    def func_and_jacobian(self, params, context):
+        """Return residuals (as in func) and their derivatives with respect to
+        each parameter in params as a list of flex.double.
+
+        The chain rule is applied analytically for every reflection. Only the
+        derivatives of the 3x3 reciprocal matrix with respect to the rotation
+        and unit-cell parameters are taken by central differences. The sigma
+        of the Lognormal partiality is the nearest point of a grid of rs and
+        nu, so for that model the derivatives with respect to ry, rz, r0, re
+        and nu are forward differences of func.
+        """
+        iparams = context.iparams
+        refine_mode = context.refine_mode
+        cs = context.cs
+        G, B, rotx, roty, ry, rz, r0, re, nu, a, b, c, alpha, beta, gamma = self.get_params(
+            params, context
+        )
+        if refine_mode == "scale_factor":
+            param_names = ["G", "B"]
+        elif refine_mode == "crystal_orientation":
+            param_names = ["rotx", "roty"]
+        elif refine_mode == "reflecting_range":
+            param_names = ["ry", "rz", "r0", "re", "nu"]
+        elif refine_mode == "unit_cell":
+            param_names = ["cell"] * len(params)
+        elif refine_mode == "allparams":
+            param_names = ["rotx", "roty", "ry", "rz", "r0", "re", "nu"] + ["cell"] * (
+                len(params) - 7
+            )
+        cell_params = list(self.prep_input((a, b, c, alpha, beta, gamma), cs))
+        ph = partiality_handler()
+
+        def calc_A_star(rotx, roty, cell_params):
+            uc = unit_cell(tuple(self.prep_output(flex.double(cell_params), cs)))
+            return ph.calc_reciprocal_matrix(
+                uc, rotx, roty, context.crystal_init_orientation
             )
+
+        try:
+            A_star = calc_A_star(rotx, roty, cell_params)
+        except Exception:
+            return None, None
+        hkl = context.hkl
+        sd_array = A_star.elems * hkl + context.S0.elems
+        sd_norms = sd_array.norms()
+        # residuals and their derivatives with respect to the spot position
+        # (unit_cell mode) or to the partiality
+        if refine_mode == "unit_cell":
+            diff_xy = self.calc_delta_xy(sd_array, context)
+            error = diff_xy.norms()
+            error_safe = error.deep_copy()
+            error_safe.set_selected(error_safe == 0, 1)
+            sd_x, sd_y, sd_z = sd_array.parts()
         else:
+            rs_set = context.calc_spot_radius_set(ry, rz, r0, re)
+            drs_dry = flex.double(context.size, 0)
+            drs_drz = flex.double(context.size, 0)
+            if iparams.flag_beam_divergence:
+                rs_div = (
+                    ((ry ** 2) * context.cos_sq_alpha)
+                    + ((rz ** 2) * context.sin_sq_alpha)
+                ) ** (1 / 2)
+                rs_div.set_selected(rs_div == 0, 1)
+                drs_dry = ry * context.cos_sq_alpha / rs_div
+                drs_drz = rz * context.sin_sq_alpha / rs_div
+            rh_set = sd_norms - (1 / context.wavelength)
+            p_calc_flex, dp_drh, dp_drs, dp_dnu = ph.calc_partiality_derivatives(
+                rh_set, rs_set, nu, iparams.partiality_model
+            )
             I_o_full = ph.calc_full_refl(
-                I_o,
-                sin_theta_over_lambda_sq,
+                context.I_o,
+                context.sin_theta_over_lambda_sq,
                 G,
-                b0,
+                B if context.flag_refine_b else context.b0,
                 p_calc_flex,
                 rs_set,
-                flag_volume_correction,
+                iparams.flag_volume_correction,
             )
-        if refine_mode == "unit_cell":
-            error = delta_xy_flex
-        else:
-            error = (I_r - I_o_full) / sigI_o
-        """
-    import math
-    print refine_mode, 'G:%.4g B:%.4g rotx:%.4g roty:%.4g r0:%.4g re:%.4g nu:%6.4f a:%.4g b:%.4g c:%.4g fpr:%.4g fxy:%.4g n_refl=%5.0f'%(G, B, rotx*180/math.pi, roty*180/math.pi, r0, re, nu, a, b, c, flex.sum(((I_r - I_o_full)/sigI_o)**2), flex.sum(delta_xy_flex**2), len(I_o_full))
-    """
-        return error
+            error = (context.I_r - I_o_full) / context.sigI_o
+            de_dp = I_o_full / (p_calc_flex * context.sigI_o)
+        # derivatives of A* by central differences
+        DELTA = 1.0e-6
+        i_cell = 0
+        # the Lognormal sigma is a step function of rs and nu
+        flag_fd_rs = iparams.partiality_model == "Lognormal"
+        jacobian = []
+        for i_param, param_name in enumerate(param_names):
+            if flag_fd_rs and param_name in ("ry", "rz", "r0", "re", "nu"):
+                dfvec = self.calc_jacobian_column_fd(params, context, i_param, error)
+                if dfvec is None:
+                    return None, None
+                jacobian.append(dfvec)
+            elif param_name in ("rotx", "roty", "cell"):
+                if param_name == "rotx":
+                    A_plus = calc_A_star(rotx + DELTA, roty, cell_params)
+                    A_minus = calc_A_star(rotx - DELTA, roty, cell_params)
+                    delta = DELTA
+                elif param_name == "roty":
+                    A_plus = calc_A_star(rotx, roty + DELTA, cell_params)
+                    A_minus = calc_A_star(rotx, roty - DELTA, cell_params)
+                    delta = DELTA
+                else:
+                    delta = DELTA * max(1, abs(cell_params[i_cell]))
+                    cell_params_plus = cell_params[:]
+                    cell_params_plus[i_cell] += delta
+                    cell_params_minus = cell_params[:]
+                    cell_params_minus[i_cell] -= delta
+                    A_plus = calc_A_star(rotx, roty, cell_params_plus)
+                    A_minus = calc_A_star(rotx, roty, cell_params_minus)
+                    i_cell += 1
+                dA_star = (A_plus - A_minus) * (1 / (2 * delta))
+                dsd_array = dA_star.elems * hkl
+                if refine_mode == "unit_cell":
+                    if context.flag_dials:
+                        d_diff_xy = -1 * dsd_array
+                    else:
+                        dsd_x, dsd_y, dsd_z = dsd_array.parts()
+                        d_diff_xy = flex.vec3_double(
+                            context.detector_distance_mm
+                            * ((dsd_x * sd_z) - (sd_x * dsd_z))
+                            / (sd_z ** 2),
+                            context.detector_distance_mm
+                            * ((dsd_y * sd_z) - (sd_y * dsd_z))
+                            / (sd_z ** 2),
+                            flex.double(len(dsd_x), 0),
+                        )
+                    jacobian.append(diff_xy.dot(d_diff_xy) / error_safe)
+                else:
+                    drh = sd_array.dot(dsd_array) / sd_norms
+                    jacobian.append(de_dp * dp_drh * drh)
+            elif param_name == "G":
+                jacobian.append(I_o_full / (G * context.sigI_o))
+            elif param_name == "B":
+                if context.flag_refine_b:
+                    jacobian.append(
+                        -2
+                        * context.sin_theta_over_lambda_sq
+                        * I_o_full
+                        / context.sigI_o
+                    )
+                else:
+                    jacobian.append(flex.double(context.size, 0))
+            elif param_name == "r0":
+                jacobian.append(de_dp * dp_drs)
+            elif param_name == "re":
+                jacobian.append(de_dp * dp_drs * context.tan_two_theta)
+            elif param_name == "ry":
+                jacobian.append(de_dp * dp_drs * drs_dry)
+            elif param_name == "rz":
+                jacobian.append(de_dp * dp_drs * drs_drz)
+            elif param_name == "nu":
+                jacobian.append(de_dp * dp_dnu)
+        return error, jacobian
+
+    def calc_jacobian_column_fd(self, params, context, i_param, error, delta=1.0e-7):
+        """Return derivatives of the residuals error (at params) with respect
+        to params[i_param] by forward differences of func, with the step of
+        lbfgs_handler (None if func fails)."""
+        params_delta = flex.double(list(params))
+        params_delta[i_param] += delta
+        error_delta = self.func(params_delta, context)
+        if error_delta is None:
+            return None
+        return (error_delta - error) / delta
@@ -14,19 +14,23 @@ gamma_y, gamma_z: parameters to model anisotropy of crystal mosaicity
 gamma_e: spectral dispersion
 unit-cell parameters: a,b,c,alpha,beta,gamma.
 
-The class implements Leveberg-Marquardt algorithms to scale the refined parameters
-using the lamda updates. The unit-cell parameters are refined with restraints based
-on the 7 crystal systems (6 conditions).
+The parameters are refined with L-BFGS or, with postref.solver=lm, with the
+Leveberg-Marquardt algorithm (mod_lm) using the lamda updates. The unit-cell
+parameters are refined with restraints based on the 7 crystal systems
+(6 conditions).
 """
 from __future__ import absolute_import, division, print_function
 import math
+import numpy as np
 from cctbx.array_family import flex
 from scitbx.matrix import sqr
 from cctbx.uctbx import unit_cell
 from cctbx.crystal_orientation import crystal_orientation
 from .mod_lbfgs import lbfgs_handler
-from .mod_lbfgs_partiality import lbfgs_partiality_handler
+from .mod_lm import lm_handler
+from .mod_lbfgs_partiality import lbfgs_partiality_handler, refinement_context
 from .mod_partiality import partiality_handler
+from .mod_hkl import miller_indices_as_numpy
 from six.moves import range
 
 
@@ -70,154 +74,103 @@ class leastsqr_handler(object):
 
     def __init__(self):
         """Intialitze parameters."""
+        self.n_iterations = 0
+        self.n_calls = 0
+
+    def run_solver(self, xinp, context):
+        """Minimize the residuals of context from xinp with the solver chosen
+        by postref.solver and add up its iterations and function calls."""
+        if context.iparams.postref.solver == "lm":
+            lh = lm_handler(current_x=xinp, context=context)
+        else:
+            lh = lbfgs_handler(current_x=xinp, context=context)
+        self.n_iterations += lh.n_iterations
+        self.n_calls += lh.n_calls
+        return lh
 
     def get_filtered_data(
-        self,
-        filter_mode,
-        filter_params,
-        observations_in,
-        alpha_angle_in,
-        spot_pred_x_mm_in,
-        spot_pred_y_mm_in,
-        I_ref_in,
-        partiality_in=False,
+        self, filter_mode, filter_params, context, partiality_in=False
     ):
         if filter_mode == "resolution":
-            i_sel = observations_in.resolution_filter_selection(
+            i_sel = context.miller_array_o.resolution_filter_selection(
                 d_min=filter_params[0], d_max=filter_params[1]
             )
         elif filter_mode == "sigma":
-            i_sel = (observations_in.data() / observations_in.sigmas()) > filter_params[
-                0
-            ]
+            i_sel = (context.I_o / context.sigI_o) > filter_params[0]
         elif filter_mode == "partiality":
             i_sel = partiality_in > filter_params[0]
-        observations_out = observations_in.select(i_sel)
-        alpha_angle_out = alpha_angle_in.select(i_sel)
-        spot_pred_x_mm_out = spot_pred_x_mm_in.select(i_sel)
-        spot_pred_y_mm_out = spot_pred_y_mm_in.select(i_sel)
-        I_ref_out = I_ref_in.select(i_sel)
-        return (
-            observations_out,
-            alpha_angle_out,
-            spot_pred_x_mm_out,
-            spot_pred_y_mm_out,
-            I_ref_out,
-        )
+        return context.select(i_sel)
 
-    def optimize_scalefactors(
-        self,
-        I_r_flex,
-        observations_original,
-        wavelength,
-        crystal_init_orientation,
-        alpha_angle,
-        spot_pred_x_mm,
-        spot_pred_y_mm,
-        iparams,
-        pres_in,
-        observations_non_polar,
-        detector_distance_mm,
-        const_params,
-    ):
+    def optimize_scalefactors(self, context, pres_in, const_params):
         ph = partiality_handler()
+        iparams = context.iparams
         pr_d_min = iparams.postref.scale.d_min
         pr_d_max = iparams.postref.scale.d_max
         pr_sigma_min = iparams.postref.scale.sigma_min
-        pr_partiality_min = iparams.postref.scale.partiality_min
         # filter by resolution
-        observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.get_filtered_data(
-            "resolution",
-            [pr_d_min, pr_d_max],
-            observations_original,
-            alpha_angle,
-            spot_pred_x_mm,
-            spot_pred_y_mm,
-            I_r_flex,
+        context_sel = self.get_filtered_data(
+            "resolution", [pr_d_min, pr_d_max], context
         )
         # filter by sigma
-        observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.get_filtered_data(
-            "sigma",
-            [pr_sigma_min],
-            observations_original_sel,
-            alpha_angle_sel,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            I_ref_sel,
-        )
-        I_r_true = I_ref_sel[:]
-        I_o_true = observations_original_sel.data()[:]
+        context_sel = self.get_filtered_data("sigma", [pr_sigma_min], context_sel)
         if pres_in is not None:
             G, B, b0 = pres_in.G, pres_in.B, pres_in.B
         else:
             G, B, b0 = (1, 0, 0)
-        refine_mode = "scale_factor"
         xinp = flex.double([G, B])
-        args = (
-            I_r_true,
-            observations_original_sel,
-            wavelength,
-            alpha_angle_sel,
-            crystal_init_orientation,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            detector_distance_mm,
-            refine_mode,
-            const_params,
-            b0,
-            None,
-            iparams,
+        lh = self.run_solver(
+            xinp, context_sel.for_mode("scale_factor", const_params, b0)
         )
-        lh = lbfgs_handler(current_x=xinp, args=args)
         G_fin, B_fin = (lh.x[0], lh.x[1])
         rotx, roty, ry, rz, r0, re, voigt_nu, a, b, c, alpha, beta, gamma = const_params
-        two_theta = observations_original.two_theta(wavelength=wavelength)
-        sin_theta_over_lambda_sq = two_theta.sin_theta_over_lambda_sq().data()
-        uc = unit_cell((a, b, c, alpha, beta, gamma))
-        ph = partiality_handler()
-        partiality_init, delta_xy_init, rs_init, dummy = ph.calc_partiality_anisotropy_set(
-            uc,
-            rotx,
-            roty,
-            observations_original.indices(),
-            ry,
-            rz,
-            r0,
-            re,
-            voigt_nu,
-            two_theta.data(),
-            alpha_angle,
-            wavelength,
-            crystal_init_orientation,
-            spot_pred_x_mm,
-            spot_pred_y_mm,
-            detector_distance_mm,
-            iparams.partiality_model,
-            iparams.flag_beam_divergence,
-        )
+        if context.partiality_init is not None:
+            partiality_init, rs_init = context.partiality_init, context.rs_init
+        else:
+            uc = unit_cell((a, b, c, alpha, beta, gamma))
+            partiality_init, delta_xy_init, rs_init, dummy = ph.calc_partiality_anisotropy_set(
+                uc,
+                rotx,
+                roty,
+                context.miller_indices,
+                ry,
+                rz,
+                r0,
+                re,
+                voigt_nu,
+                context.two_theta,
+                context.alpha_angle_set,
+                context.wavelength,
+                context.crystal_init_orientation,
+                context.spot_pred_x_mm_set,
+                context.spot_pred_y_mm_set,
+                context.detector_distance_mm,
+                iparams.partiality_model,
+                iparams.flag_beam_divergence,
+            )
         I_o_init = ph.calc_full_refl(
-            observations_original.data(),
-            sin_theta_over_lambda_sq,
+            context.I_o,
+            context.sin_theta_over_lambda_sq,
             G,
             B,
             partiality_init,
             rs_init,
         )
         I_o_fin = ph.calc_full_refl(
-            observations_original.data(),
-            sin_theta_over_lambda_sq,
+            context.I_o,
+            context.sin_theta_over_lambda_sq,
             G_fin,
             B_fin,
             partiality_init,
             rs_init,
         )
+        I_r_flex = context.I_r
         SE_of_the_estimate = standard_error_of_the_estimate(I_r_flex, I_o_fin, 2)
         R_sq = coefficient_of_determination(I_r_flex, I_o_fin) * 100
         CC_init = flex.linear_correlation(I_r_flex, I_o_init).coefficient()
         CC_final = flex.linear_correlation(I_r_flex, I_o_fin).coefficient()
-        err_init = (I_r_flex - I_o_init) / observations_original.sigmas()
+        err_init = (I_r_flex - I_o_init) / context.sigI_o
         R_init = math.sqrt(flex.sum(err_init ** 2))
-        err_final = (I_r_flex - I_o_fin) / observations_original.sigmas()
+        err_final = (I_r_flex - I_o_fin) / context.sigI_o
         R_final = math.sqrt(flex.sum(err_final ** 2))
         R_xy_init = 0
         R_xy_final = 0
@@ -239,20 +192,8 @@ class leastsqr_handler(object):
             ),
         )
 
-    def prepare_data_microcycle(
-        self,
-        refine_mode,
-        iparams,
-        observations_original,
-        alpha_angle,
-        spot_pred_x_mm,
-        spot_pred_y_mm,
-        I_r_flex,
-        init_params,
-        crystal_init_orientation,
-        wavelength,
-        detector_distance_mm,
-    ):
+    def prepare_data_microcycle(self, refine_mode, context, init_params):
+        iparams = context.iparams
         # prepare data
         if refine_mode == "crystal_orientation":
             pr_d_min = iparams.postref.crystal_orientation.d_min
@@ -279,70 +220,174 @@ class leastsqr_handler(object):
             pr_partiality_min = iparams.postref.allparams.partiality_min
             pr_uc_tol = iparams.postref.unit_cell.uc_tolerance
         # filter by resolution
-        observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.get_filtered_data(
-            "resolution",
-            [pr_d_min, pr_d_max],
-            observations_original,
-            alpha_angle,
-            spot_pred_x_mm,
-            spot_pred_y_mm,
-            I_r_flex,
+        context_sel = self.get_filtered_data(
+            "resolution", [pr_d_min, pr_d_max], context
         )
         # filter by sigma
-        observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.get_filtered_data(
-            "sigma",
-            [pr_sigma_min],
-            observations_original_sel,
-            alpha_angle_sel,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            I_ref_sel,
-        )
+        context_sel = self.get_filtered_data("sigma", [pr_sigma_min], context_sel)
         # extract refined parameters
         G, B, rotx, roty, ry, rz, r0, re, voigt_nu, a, b, c, alpha, beta, gamma = (
             init_params
         )
         # filter by partiality
-        two_theta = observations_original_sel.two_theta(wavelength=wavelength).data()
         uc = unit_cell((a, b, c, alpha, beta, gamma))
         ph = partiality_handler()
         partiality_init, delta_xy_init, rs_init, dummy = ph.calc_partiality_anisotropy_set(
             uc,
             rotx,
             roty,
-            observations_original_sel.indices(),
+            context_sel.miller_indices,
             ry,
             rz,
             r0,
             re,
             voigt_nu,
-            two_theta,
-            alpha_angle_sel,
-            wavelength,
-            crystal_init_orientation,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            detector_distance_mm,
+            context_sel.two_theta,
+            context_sel.alpha_angle_set,
+            context_sel.wavelength,
+            context_sel.crystal_init_orientation,
+            context_sel.spot_pred_x_mm_set,
+            context_sel.spot_pred_y_mm_set,
+            context_sel.detector_distance_mm,
             iparams.partiality_model,
             iparams.flag_beam_divergence,
         )
-        observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.get_filtered_data(
+        context_sel = self.get_filtered_data(
             "partiality",
             [pr_partiality_min],
-            observations_original_sel,
-            alpha_angle_sel,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            I_ref_sel,
+            context_sel,
             partiality_in=partiality_init,
         )
-        return (
-            observations_original_sel,
-            alpha_angle_sel,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            I_ref_sel,
+        return context_sel
+
+    def get_refinement_context(
+        self,
+        I_r_flex,
+        observations_original,
+        wavelength,
+        crystal_init_orientation,
+        alpha_angle,
+        spot_pred_x_mm,
+        spot_pred_y_mm,
+        iparams,
+        pres_in,
+        detector_distance_mm,
+    ):
+        """Return refinement_context of a frame (see optimize)."""
+        if pres_in is not None:
+            crystal_init_orientation = pres_in.crystal_orientation
+        # get miller array iso, if given.
+        miller_array_iso = None
+        return refinement_context(
+            I_r_flex,
+            observations_original,
+            wavelength,
+            alpha_angle,
+            crystal_init_orientation,
+            spot_pred_x_mm,
+            spot_pred_y_mm,
+            detector_distance_mm,
+            iparams,
+            miller_array_iso,
+        )
+
+    def prepare_data_init(self, context):
+        """Return reflections of context used to initialize the parameters
+        and the spot radius calculated from them."""
+        iparams = context.iparams
+        pr_d_min = iparams.postref.allparams.d_min
+        pr_d_max = iparams.postref.allparams.d_max
+        pr_sigma_min = iparams.postref.allparams.sigma_min
+        # filter by resolution
+        context_sel = self.get_filtered_data(
+            "resolution", [pr_d_min, pr_d_max], context
         )
+        # filter by sigma
+        context_sel = self.get_filtered_data("sigma", [pr_sigma_min], context_sel)
+        ph = partiality_handler()
+        spot_radius = ph.calc_spot_radius(
+            sqr(context.crystal_init_orientation.reciprocal_matrix()),
+            context_sel.miller_indices,
+            context.wavelength,
+        )
+        return context_sel, spot_radius
+
+    def get_init_params(self, context, spot_radius):
+        """Return initial (rotx, roty, ry, rz, r0, re, voigt_nu, a, b, c,
+        alpha, beta, gamma) of a frame without post-refinement results."""
+        iparams = context.iparams
+        lph = lbfgs_partiality_handler()
+        ry, rz, r0, re, voigt_nu, rotx, roty = (
+            0,
+            0,
+            spot_radius,
+            iparams.gamma_e,
+            iparams.voigt_nu,
+            0.0,
+            0.0,
+        )
+        # apply constrain on the unit cell using crystal system
+        uc_scale_inp = lph.prep_input(
+            context.miller_array_o.unit_cell().parameters(), context.cs
+        )
+        uc_scale_constrained = lph.prep_output(uc_scale_inp, context.cs)
+        a, b, c, alpha, beta, gamma = uc_scale_constrained
+        return (rotx, roty, ry, rz, r0, re, voigt_nu, a, b, c, alpha, beta, gamma)
+
+    def calc_partiality_init_batch(self, contexts):
+        """Set partiality_init and rs_init of contexts (frames without
+        post-refinement results) with their initial parameters, evaluated for
+        all frames in one partiality_handler.calc_partiality_batch call.
+        Frames whose initial parameters can not be set up are left out (and
+        initialized by optimize)."""
+        ph = partiality_handler()
+        contexts_batch = []
+        A_star_set = []
+        frame_params = []
+        for context in contexts:
+            try:
+                context_sel, spot_radius = self.prepare_data_init(context)
+                rotx, roty, ry, rz, r0, re, voigt_nu, a, b, c, alpha, beta, gamma = self.get_init_params(
+                    context, spot_radius
+                )
+                A_star = ph.calc_reciprocal_matrix(
+                    unit_cell((a, b, c, alpha, beta, gamma)),
+                    rotx,
+                    roty,
+                    context.crystal_init_orientation,
+                )
+            except Exception:
+                continue
+            contexts_batch.append(context)
+            A_star_set.append(A_star.elems)
+            frame_params.append((ry, rz, r0, re, voigt_nu, context.wavelength))
+        if not contexts_batch:
+            return
+        offsets = np.zeros(len(contexts_batch) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([context.size for context in contexts_batch])
+        iparams = contexts_batch[0].iparams
+        partiality_set, rs_set, dummy = ph.calc_partiality_batch(
+            A_star_set,
+            np.concatenate(
+                [
+                    miller_indices_as_numpy(context.miller_indices)
+                    for context in contexts_batch
+                ]
+            ),
+            offsets,
+            frame_params,
+            np.concatenate(
+                [context.two_theta.as_numpy_array() for context in contexts_batch]
+            ),
+            np.concatenate(
+                [context.alpha_angle_set.as_numpy_array() for context in contexts_batch]
+            ),
+            iparams.partiality_model,
+            iparams.flag_beam_divergence,
+        )
+        for context, i_st, i_en in zip(contexts_batch, offsets[:-1], offsets[1:]):
+            context.partiality_init = flex.double(partiality_set[i_st:i_en])
+            context.rs_init = flex.double(rs_set[i_st:i_en])
 
     def optimize(
         self,
@@ -357,7 +402,13 @@ class leastsqr_handler(object):
         pres_in,
         observations_non_polar,
         detector_distance_mm,
+        context=None,
     ):
+        """Post-refine a frame. context is the refinement_context of the
+        frame if already made by get_refinement_context. Iterations and
+        function calls of the solver are kept in n_iterations and n_calls."""
+        self.n_iterations = 0
+        self.n_calls = 0
         ph = partiality_handler()
         lph = lbfgs_partiality_handler()
         if iparams.postref.allparams.flag_on:
@@ -368,73 +419,11 @@ class leastsqr_handler(object):
                 refine_steps.append("reflecting_range")
             if iparams.postref.unit_cell.flag_on:
                 refine_steps.append("unit_cell")
-        # get miller array iso, if given.
         miller_array_iso = None
         # prepare data
-        pr_d_min = iparams.postref.allparams.d_min
-        pr_d_max = iparams.postref.allparams.d_max
-        pr_sigma_min = iparams.postref.allparams.sigma_min
         pr_partiality_min = iparams.postref.allparams.partiality_min
-        pr_uc_tol = iparams.postref.allparams.uc_tolerance
-        cs = observations_original.crystal_symmetry().space_group().crystal_system()
-        # filter by resolution
-        observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.get_filtered_data(
-            "resolution",
-            [pr_d_min, pr_d_max],
-            observations_original,
-            alpha_angle,
-            spot_pred_x_mm,
-            spot_pred_y_mm,
-            I_r_flex,
-        )
-        # filter by sigma
-        observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.get_filtered_data(
-            "sigma",
-            [pr_sigma_min],
-            observations_original_sel,
-            alpha_angle_sel,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            I_ref_sel,
-        )
-        # initialize values only in the first sub cycle and the first refine step.
-        spot_radius = ph.calc_spot_radius(
-            sqr(crystal_init_orientation.reciprocal_matrix()),
-            observations_original_sel.indices(),
-            wavelength,
-        )
-        if pres_in is None:
-            ry, rz, r0, re, voigt_nu, rotx, roty = (
-                0,
-                0,
-                spot_radius,
-                iparams.gamma_e,
-                iparams.voigt_nu,
-                0.0,
-                0.0,
-            )
-            # apply constrain on the unit cell using crystal system
-            uc_scale_inp = lph.prep_input(
-                observations_original.unit_cell().parameters(), cs
-            )
-            uc_scale_constrained = lph.prep_output(uc_scale_inp, cs)
-            a, b, c, alpha, beta, gamma = uc_scale_constrained
-            const_params_scale = (
-                rotx,
-                roty,
-                ry,
-                rz,
-                r0,
-                re,
-                voigt_nu,
-                a,
-                b,
-                c,
-                alpha,
-                beta,
-                gamma,
-            )
-            xopt_scalefactors, stats = self.optimize_scalefactors(
+        if context is None:
+            context = self.get_refinement_context(
                 I_r_flex,
                 observations_original,
                 wavelength,
@@ -444,9 +433,19 @@ class leastsqr_handler(object):
                 spot_pred_y_mm,
                 iparams,
                 pres_in,
-                observations_non_polar,
                 detector_distance_mm,
-                const_params_scale,
+            )
+        crystal_init_orientation = context.crystal_init_orientation
+        cs = context.cs
+        # initialize values only in the first sub cycle and the first refine step.
+        context_sel, spot_radius = self.prepare_data_init(context)
+        if pres_in is None:
+            const_params_scale = self.get_init_params(context, spot_radius)
+            rotx, roty, ry, rz, r0, re, voigt_nu, a, b, c, alpha, beta, gamma = (
+                const_params_scale
+            )
+            xopt_scalefactors, stats = self.optimize_scalefactors(
+                context, pres_in, const_params_scale
             )
             G, B = xopt_scalefactors
         else:
@@ -462,82 +461,51 @@ class leastsqr_handler(object):
                 0.0,
             )
             a, b, c, alpha, beta, gamma = pres_in.unit_cell.parameters()
-            crystal_init_orientation = pres_in.crystal_orientation
         # filter by partiality
-        two_theta = observations_original_sel.two_theta(wavelength=wavelength).data()
-        uc = unit_cell((a, b, c, alpha, beta, gamma))
-        partiality_init, delta_xy_init, rs_init, dummy = ph.calc_partiality_anisotropy_set(
-            uc,
-            rotx,
-            roty,
-            observations_original_sel.indices(),
-            ry,
-            rz,
-            r0,
-            re,
-            voigt_nu,
-            two_theta,
-            alpha_angle_sel,
-            wavelength,
-            crystal_init_orientation,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            detector_distance_mm,
-            iparams.partiality_model,
-            iparams.flag_beam_divergence,
-        )
-        observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.get_filtered_data(
+        if pres_in is None and context_sel.partiality_init is not None:
+            partiality_init = context_sel.partiality_init
+        else:
+            uc = unit_cell((a, b, c, alpha, beta, gamma))
+            partiality_init, delta_xy_init, rs_init, dummy = ph.calc_partiality_anisotropy_set(
+                uc,
+                rotx,
+                roty,
+                context_sel.miller_indices,
+                ry,
+                rz,
+                r0,
+                re,
+                voigt_nu,
+                context_sel.two_theta,
+                context_sel.alpha_angle_set,
+                wavelength,
+                crystal_init_orientation,
+                context_sel.spot_pred_x_mm_set,
+                context_sel.spot_pred_y_mm_set,
+                detector_distance_mm,
+                iparams.partiality_model,
+                iparams.flag_beam_divergence,
+            )
+        context_sel = self.get_filtered_data(
             "partiality",
             [pr_partiality_min],
-            observations_original_sel,
-            alpha_angle_sel,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            I_ref_sel,
+            context_sel,
             partiality_in=partiality_init,
         )
-        I_r_true = I_ref_sel[:]
-        I_o_true = observations_original_sel.data()[:]
         # calculate initial residual_xy error
         const_params_uc = (G, B, rotx, roty, ry, rz, r0, re, voigt_nu)
         xinp_uc = lph.prep_input((a, b, c, alpha, beta, gamma), cs)
-        args_uc = (
-            I_r_true,
-            observations_original_sel,
-            wavelength,
-            alpha_angle_sel,
-            crystal_init_orientation,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            detector_distance_mm,
-            "unit_cell",
-            const_params_uc,
-            B,
-            miller_array_iso,
-            iparams,
+        uc_params_err = lph.func(
+            xinp_uc, context_sel.for_mode("unit_cell", const_params_uc, B)
         )
-        uc_params_err = lph.func(xinp_uc, args_uc)
         init_residual_xy_err = flex.sum(uc_params_err ** 2)
         # calculate initial residual_pr error
         const_params_all = (G, B)
         xinp_all = flex.double([rotx, roty, ry, rz, r0, re, voigt_nu])
         xinp_all.extend(lph.prep_input((a, b, c, alpha, beta, gamma), cs))
-        args_all = (
-            I_r_true,
-            observations_original_sel,
-            wavelength,
-            alpha_angle_sel,
-            crystal_init_orientation,
-            spot_pred_x_mm_sel,
-            spot_pred_y_mm_sel,
-            detector_distance_mm,
-            "allparams",
-            const_params_all,
-            B,
-            miller_array_iso,
-            iparams,
+        all_params_err = lph.func(
+            xinp_all, context_sel.for_mode("allparams", const_params_all, B)
         )
-        all_params_err = lph.func(xinp_all, args_all)
         init_residual_err = flex.sum(all_params_err ** 2)
         # keep in list
         t_pr_list = [init_residual_err]
@@ -567,21 +535,9 @@ class leastsqr_handler(object):
                     beta,
                     gamma,
                 )
-                observations_original_sel, alpha_angle_sel, spot_pred_x_mm_sel, spot_pred_y_mm_sel, I_ref_sel = self.prepare_data_microcycle(
-                    refine_mode,
-                    iparams,
-                    observations_original,
-                    alpha_angle,
-                    spot_pred_x_mm,
-                    spot_pred_y_mm,
-                    I_r_flex,
-                    init_params,
-                    crystal_init_orientation,
-                    wavelength,
-                    detector_distance_mm,
+                context_sel = self.prepare_data_microcycle(
+                    refine_mode, context, init_params
                 )
-                I_r_true = I_ref_sel[:]
-                I_o_true = observations_original_sel.data()
                 if refine_mode == "crystal_orientation":
                     xinp = flex.double([rotx, roty])
                     const_params = (
@@ -609,22 +565,9 @@ class leastsqr_handler(object):
                     xinp = flex.double([rotx, roty, ry, rz, r0, re, voigt_nu])
                     xinp.extend(lph.prep_input((a, b, c, alpha, beta, gamma), cs))
                     const_params = (G, B)
-                args = (
-                    I_r_true,
-                    observations_original_sel,
-                    wavelength,
-                    alpha_angle_sel,
-                    crystal_init_orientation,
-                    spot_pred_x_mm_sel,
-                    spot_pred_y_mm_sel,
-                    detector_distance_mm,
-                    refine_mode,
-                    const_params,
-                    B,
-                    miller_array_iso,
-                    iparams,
+                lh = self.run_solver(
+                    xinp, context_sel.for_mode(refine_mode, const_params, B)
                 )
-                lh = lbfgs_handler(current_x=xinp, args=args)
                 xopt = flex.double(list(lh.x))
                 if (
                     refine_mode == "crystal_orientation"
@@ -644,22 +587,9 @@ class leastsqr_handler(object):
                         a, b, c, alpha, beta, gamma = lph.prep_output(xinp_uc, cs)
                     const_params_uc = (G, B, rotx, roty, ry, rz, r0, re, voigt_nu)
                     xinp_uc = lph.prep_input((a, b, c, alpha, beta, gamma), cs)
-                    args_uc = (
-                        I_r_true,
-                        observations_original_sel,
-                        wavelength,
-                        alpha_angle_sel,
-                        crystal_init_orientation,
-                        spot_pred_x_mm_sel,
-                        spot_pred_y_mm_sel,
-                        detector_distance_mm,
-                        "unit_cell",
-                        const_params_uc,
-                        B,
-                        miller_array_iso,
-                        iparams,
+                    uc_params_err = lph.func(
+                        xinp_uc, context_sel.for_mode("unit_cell", const_params_uc, B)
                     )
-                    uc_params_err = lph.func(xinp_uc, args_uc)
                     current_residual_xy_err = flex.sum(uc_params_err ** 2)
                 elif refine_mode == "unit_cell":
                     current_residual_xy_err = lh.f
@@ -669,22 +599,9 @@ class leastsqr_handler(object):
                     xinp = flex.double([rotx, roty, ry, rz, r0, re, voigt_nu])
                     xinp.extend(lph.prep_input((a, b, c, alpha, beta, gamma), cs))
                     const_params_all = (G, B)
-                    args_all = (
-                        I_r_true,
-                        observations_original_sel,
-                        wavelength,
-                        alpha_angle_sel,
-                        crystal_init_orientation,
-                        spot_pred_x_mm_sel,
-                        spot_pred_y_mm_sel,
-                        detector_distance_mm,
-                        "allparams",
-                        const_params_all,
-                        B,
-                        miller_array_iso,
-                        iparams,
+                    all_params_err = lph.func(
+                        xinp_all, context_sel.for_mode("allparams", const_params_all, B)
                     )
-                    all_params_err = lph.func(xinp_all, args_all)
                     current_residual_err = flex.sum(all_params_err ** 2)
                 flag_success = False
                 if refine_mode == "allparams":
@@ -784,12 +701,8 @@ class leastsqr_handler(object):
                 )
                 txt_out += tmp_txt_out
         # apply the refined parameters on the full (original) reflection set
-        two_theta = observations_original.two_theta(wavelength=wavelength).data()
-        sin_theta_over_lambda_sq = (
-            observations_original.two_theta(wavelength=wavelength)
-            .sin_theta_over_lambda_sq()
-            .data()
-        )
+        two_theta = context.two_theta
+        sin_theta_over_lambda_sq = context.sin_theta_over_lambda_sq
         if pres_in is None:
             partiality_init, delta_xy_init, rs_init, rh_init = ph.calc_partiality_anisotropy_set(
                 observations_original.unit_cell(),
@@ -921,21 +834,16 @@ class leastsqr_handler(object):
         CC_iso_init, CC_iso_final = (0, 0)
         if iparams.hklisoin is not None:
             if miller_array_iso is not None:
-                from cctbx import miller
+                from .mod_hkl import miller_index_lookup
 
-                matches = miller.match_multi_indices(
-                    miller_indices_unique=miller_array_iso.indices(),
-                    miller_indices=observations_non_polar.indices(),
+                i_iso, i_obs = miller_index_lookup(miller_array_iso.indices()).lookup(
+                    observations_non_polar.indices()
                 )
                 I_iso_match = flex.double(
-                    [miller_array_iso.data()[pair[0]] for pair in matches.pairs()]
-                )
-                I_o_init_match = flex.double(
-                    [I_o_init[pair[1]] for pair in matches.pairs()]
-                )
-                I_o_fin_match = flex.double(
-                    [I_o_fin[pair[1]] for pair in matches.pairs()]
+                    miller_array_iso.data().as_numpy_array()[i_iso]
                 )
+                I_o_init_match = flex.double(I_o_init.as_numpy_array()[i_obs])
+                I_o_fin_match = flex.double(I_o_fin.as_numpy_array()[i_obs])
                 CC_iso_init = flex.linear_correlation(
                     I_iso_match, I_o_init_match
                 ).coefficient()
@@ -957,5 +865,5 @@ class leastsqr_handler(object):
                 CC_iso_init,
                 CC_iso_final,
             ),
-            len(I_ref_sel),
+            context_sel.size,
         )
@@ -0,0 +1,154 @@
+"""
+Description : Levenberg-Marquardt (damped Gauss-Newton) solver for the
+              post-refinement of a frame.
+
+lm_handler works on the residual vector of lbfgs_partiality_handler.func and
+its Jacobian (func_and_jacobian if postref.flag_analytic_gradient, forward
+differences of func otherwise) instead of the sum of squares only. Each step
+solves (J'J + lambda * diag(J'J)) dx = -J'r; lambda is lowered after a step
+that decreases the sum of squares and raised otherwise. The mosaicity
+parameters are kept within their bounds: those held at a bound are left out
+of the step and the step is shortened to stay within the bounds.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from cctbx.array_family import flex
+from .mod_lbfgs_partiality import lbfgs_partiality_handler
+from six.moves import range
+
+# positions of (ry, rz, r0, re, nu) in the refined parameters of each mode
+MOSAICITY_PARAMS_START = {"reflecting_range": 0, "allparams": 2}
+# lower bound of nu (the zero of lognpdf) for the Lognormal model
+LOGNORMAL_NU_MIN = 1.0e-6
+
+
+def get_bounds(context, n_params):
+    """Return (lower, upper) numpy arrays of the bounds of the refined
+    parameters: ry, rz, r0 and re >= 0; 0 <= nu <= 1 for the Voigt model,
+    nu >= LOGNORMAL_NU_MIN for the Lognormal model (log of nu is taken) and
+    nu >= 0 otherwise."""
+    lower = np.full(n_params, -np.inf)
+    upper = np.full(n_params, np.inf)
+    if context.refine_mode in MOSAICITY_PARAMS_START:
+        i_st = MOSAICITY_PARAMS_START[context.refine_mode]
+        lower[i_st : i_st + 5] = 0
+        if context.iparams.partiality_model == "Voigt":
+            upper[i_st + 4] = 1
+        elif context.iparams.partiality_model == "Lognormal":
+            lower[i_st + 4] = LOGNORMAL_NU_MIN
+    return lower, upper
+
+
+class lm_handler(object):
+    """Minimize the sum of squared residuals of the refinement set up in
+    context, starting at current_x (same interface as lbfgs_handler)."""
+
+    def __init__(
+        self,
+        current_x=None,
+        context=None,
+        max_iterations=100,
+        ftol=1.0e-6,
+        xtol=1.0e-8,
+        lambda_init=1.0e-3,
+        lambda_max=1.0e10,
+    ):
+        self.context = context
+        self.lph = lbfgs_partiality_handler()
+        self.n_iterations = 0
+        self.n_calls = 0
+        x = np.array(list(current_x), dtype=np.float64)
+        lower, upper = get_bounds(context, len(x))
+        x = np.clip(x, lower, upper)
+        fvec, jacobian = self.compute_residuals_and_jacobian(x)
+        if fvec is None:
+            raise ValueError("residuals can not be calculated at the initial point")
+        f = np.dot(fvec, fvec)
+        lambda_ = lambda_init
+        while self.n_iterations < max_iterations:
+            self.n_iterations += 1
+            g = np.dot(jacobian.T, fvec)
+            # parameters at a bound that the gradient pushes outwards are
+            # kept fixed in this iteration
+            i_free = np.flatnonzero(
+                ~(((x <= lower) & (g > 0)) | ((x >= upper) & (g < 0)))
+            )
+            if len(i_free) == 0:
+                break
+            A = np.dot(jacobian[:, i_free].T, jacobian[:, i_free])
+            # scale damping by the curvature of each parameter (Marquardt)
+            diag_A = np.maximum(np.diag(A), 1.0e-12 * max(np.max(np.diag(A)), 1))
+            flag_accepted = False
+            while lambda_ <= lambda_max:
+                try:
+                    dx = np.linalg.solve(A + (lambda_ * np.diag(diag_A)), -g[i_free])
+                except np.linalg.LinAlgError:
+                    lambda_ *= 10
+                    continue
+                step = np.zeros(len(x))
+                step[i_free] = dx
+                # shorten the step to stay within the bounds
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    alpha = np.where(
+                        step < 0,
+                        (lower - x) / step,
+                        np.where(step > 0, (upper - x) / step, np.inf),
+                    )
+                x_new = np.clip(x + (min(1, alpha.min()) * step), lower, upper)
+                fvec_new = self.compute_residuals(x_new)
+                f_new = np.inf
+                if fvec_new is not None:
+                    f_new = np.dot(fvec_new, fvec_new)
+                if f_new < f:
+                    flag_accepted = True
+                    break
+                lambda_ *= 10
+            if not flag_accepted:
+                break
+            f_drop = f - f_new
+            x_step = np.abs(x_new - x).max()
+            x, f = x_new, f_new
+            lambda_ = max(lambda_ / 10, 1.0e-12)
+            if f_drop <= ftol * f or x_step <= xtol * (np.abs(x).max() + xtol):
+                break
+            fvec, jacobian = self.compute_residuals_and_jacobian(x)
+            if fvec is None:
+                break
+        self.x = flex.double(list(x))
+        self.f = f
+
+    def compute_residuals(self, x):
+        self.n_calls += 1
+        fvec = self.lph.func(flex.double(list(x)), self.context)
+        if fvec is None:
+            return None
+        return fvec.as_numpy_array()
+
+    def compute_residuals_and_jacobian(self, x):
+        """Return residuals at x and their Jacobian (n_refl x n_params) as
+        numpy arrays, (None, None) if the residuals can not be calculated."""
+        if self.context.iparams.postref.flag_analytic_gradient:
+            self.n_calls += 1
+            fvec, jacobian = self.lph.func_and_jacobian(
+                flex.double(list(x)), self.context
+            )
+            if fvec is None:
+                return None, None
+            return (
+                fvec.as_numpy_array(),
+                np.column_stack([dfvec.as_numpy_array() for dfvec in jacobian]),
+            )
+        fvec = self.compute_residuals(x)
+        if fvec is None:
+            return None, None
+        # forward differences as in lbfgs_handler
+        DELTA = 1.0e-7
+        jacobian = np.zeros((len(fvec), len(x)))
+        for i in range(len(x)):
+            x_delta = x.copy()
+            x_delta[i] += DELTA
+            dfvec = self.compute_residuals(x_delta)
+            if dfvec is None:
+                return None, None
+            jacobian[:, i] = (dfvec - fvec) / DELTA
+        return fvec, jacobian
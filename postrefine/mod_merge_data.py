@@ -1,7 +1,8 @@
 from __future__ import absolute_import, division, print_function
 from cctbx.array_family import flex
-from cctbx import miller
 import math
+import numpy as np
+from .mod_hkl import match_miller_indices, miller_index_lookup
 from six.moves import range
 
 
@@ -138,18 +139,13 @@ class merge_data_handler(object):
     def get_cciso(self, miller_array_iso):
         cciso, n_refl_cciso = (0, 0)
         if miller_array_iso:
-            matches_iso = miller.match_multi_indices(
-                miller_indices_unique=miller_array_iso.indices(),
-                miller_indices=self.miller_array_merge.indices(),
+            i_iso, i_merge = miller_index_lookup(miller_array_iso.indices()).lookup(
+                self.miller_array_merge.indices()
             )
-            I_iso = flex.double(
-                [miller_array_iso.data()[pair[0]] for pair in matches_iso.pairs()]
-            )
-            I_merge_match_iso = flex.double(
-                [self.I_merge[pair[1]] for pair in matches_iso.pairs()]
-            )
-            n_refl_cciso = len(matches_iso.pairs())
-            if len(matches_iso.pairs()) > 0:
+            I_iso = flex.double(miller_array_iso.data().as_numpy_array()[i_iso])
+            I_merge_match_iso = flex.double(self.I_merge.as_numpy_array()[i_merge])
+            n_refl_cciso = len(i_iso)
+            if n_refl_cciso > 0:
                 cciso = flex.linear_correlation(I_merge_match_iso, I_iso).coefficient()
         return cciso, n_refl_cciso
 
@@ -190,19 +186,264 @@ class merge_data_handler(object):
             self.miller_array_merge = self.miller_array_merge.select(selections)
 
     def reduce_by_miller_index(self, miller_indices):
-        sequences = list(range(self.get_size()))
-        matches = miller.match_multi_indices(
-            miller_indices_unique=miller_indices,
-            miller_indices=self.miller_indices_merge,
-        )
-        pair_1 = flex.int([pair[1] for pair in matches.pairs()])
-        sequences_bin = flex.size_t(
-            [sequences[pair_1[j]] for j in range(len(matches.pairs()))]
+        dummy, i_merge = miller_index_lookup(miller_indices).lookup(
+            self.miller_indices_merge
         )
-        self.reduce_by_selection(sequences_bin)
+        self.reduce_by_selection(flex.size_t(i_merge.tolist()))
 
     def reduce_to_cone_on_axis(self, axis_point_2, fraction_percent):
         miller_array_reduced = self.miller_array_merge.remove_cone(
             fraction_percent, axis_point_2=axis_point_2, negate=True
         )
         self.reduce_by_miller_index(miller_array_reduced.indices())
+
+
+def group_count(group_ids, n_groups):
+    return np.bincount(group_ids, minlength=n_groups)
+
+
+def group_sum(group_ids, values, n_groups):
+    return np.bincount(group_ids, weights=values, minlength=n_groups)
+
+
+def group_mean(group_ids, values, n_groups):
+    """Return mean of values in each group, 0 for empty groups."""
+    n = group_count(group_ids, n_groups)
+    return group_sum(group_ids, values, n_groups) / np.maximum(n, 1)
+
+
+def group_correlation(group_ids, x, y, n_groups, epsilon=1.0e-15):
+    """Return linear correlation coefficient of x and y in each group (as
+    flex.linear_correlation, 0 where it is not well defined)."""
+    dx = x - group_mean(group_ids, x, n_groups)[group_ids]
+    dy = y - group_mean(group_ids, y, n_groups)[group_ids]
+    numerator = group_sum(group_ids, dx * dy, n_groups)
+    denominator = np.sqrt(
+        group_sum(group_ids, dx * dx, n_groups)
+        * group_sum(group_ids, dy * dy, n_groups)
+    )
+    cc = np.zeros(n_groups)
+    i_sel = denominator >= epsilon
+    cc[i_sel] = numerator[i_sel] / denominator[i_sel]
+    return cc
+
+
+def get_binned_outlier_sequences(values, bin_ids, n_bins, cutoff):
+    """Return indices of values within cutoff standard deviations of the
+    median of their bin (1 to n_bins), ordered by bin and then by index.
+
+    Bins are segments of one stable sort, medians are read from a second
+    sort by value inside each bin. Bins with no spread are kept whole.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    bin_ids = np.asarray(bin_ids, dtype=np.int64)
+    n_groups = n_bins + 1
+    in_range = (bin_ids >= 1) & (bin_ids <= n_bins)
+    sequences = np.argsort(bin_ids, kind="mergesort")
+    sequences = sequences[in_range[sequences]]
+    if len(sequences) == 0:
+        return sequences
+    seq_bin_ids = bin_ids[sequences]
+    seq_values = values[sequences]
+    n = group_count(seq_bin_ids, n_groups)
+    mean = group_mean(seq_bin_ids, seq_values, n_groups)
+    std = np.sqrt(
+        group_mean(seq_bin_ids, (seq_values - mean[seq_bin_ids]) ** 2, n_groups)
+    )
+    sorted_values = seq_values[np.lexsort((seq_values, seq_bin_ids))]
+    starts = np.cumsum(n) - n
+    # empty bins are clipped, their medians are never used
+    i_lo = np.clip(starts + ((n - 1) // 2), 0, len(sorted_values) - 1)
+    i_hi = np.clip(starts + (n // 2), 0, len(sorted_values) - 1)
+    median = (sorted_values[i_lo] + sorted_values[i_hi]) / 2
+    seq_std = std[seq_bin_ids]
+    i_keep = seq_std == 0
+    i_spread = ~i_keep
+    i_keep[i_spread] = (
+        np.abs(
+            (seq_values[i_spread] - median[seq_bin_ids[i_spread]]) / seq_std[i_spread]
+        )
+        < cutoff
+    )
+    return sequences[i_keep]
+
+
+class merge_stats_handler(object):
+    """Merging statistics in resolution bins, for all merged reflections and
+    for those on cones around the reciprocal axes.
+
+    Each merged reflection is given a bin id (0 if its miller index is not
+    in the binned template) and a bitmask of the cones it lies on, all
+    per-bin values are then accumulated in one group-by pass instead of
+    selecting a copy of merge_data_handler for every bin and cone.
+    """
+
+    CONE_AXES = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+
+    def __init__(
+        self,
+        mdh,
+        miller_array_template_asu,
+        binner_template_asu,
+        n_bins,
+        percent_cone_fraction,
+        miller_array_iso=None,
+    ):
+        self.n_bins = n_bins
+        n_groups = n_bins + 1
+        # bin ids from the template
+        template_bin_ids = np.array(binner_template_asu.bin_indices(), dtype=np.int64)
+        self.n_template = group_count(template_bin_ids, n_groups)[:n_groups]
+        positions = match_miller_indices(
+            miller_array_template_asu.indices(), mdh.miller_indices_merge
+        )
+        bin_ids = np.zeros(len(positions), dtype=np.int64)
+        bin_ids[positions >= 0] = template_bin_ids[positions[positions >= 0]]
+        bin_ids[bin_ids > n_bins] = 0
+        # cone membership
+        cone_masks = np.zeros(len(positions), dtype=np.int64)
+        for i_axis, axis in enumerate(self.CONE_AXES):
+            miller_array_cone = mdh.miller_array_merge.remove_cone(
+                percent_cone_fraction, axis_point_2=axis, negate=True
+            )
+            i_cone = (
+                match_miller_indices(
+                    miller_array_cone.indices(), mdh.miller_indices_merge
+                )
+                >= 0
+            )
+            cone_masks[i_cone] |= 1 << i_axis
+        I_merge = mdh.I_merge.as_numpy_array()
+        sigI_merge = mdh.sigI_merge.as_numpy_array()
+        I_even = mdh.I_even.as_numpy_array()
+        I_odd = mdh.I_odd.as_numpy_array()
+        # all reflections
+        self.n_refl = group_count(bin_ids, n_groups)
+        self.multiplicity = group_sum(
+            bin_ids, mdh.multiplicities.as_numpy_array(), n_groups
+        ) / np.maximum(self.n_refl, 1)
+        sum_div = group_sum(bin_ids, mdh.r_meas_div.as_numpy_array(), n_groups)
+        sum_divisor = group_sum(bin_ids, mdh.r_meas_divisor.as_numpy_array(), n_groups)
+        self.r_meas = np.zeros(n_groups)
+        i_sel = sum_divisor != 0
+        self.r_meas[i_sel] = sum_div[i_sel] / sum_divisor[i_sel]
+        sum_abs_diff = group_sum(bin_ids, np.abs(I_even - I_odd), n_groups)
+        sum_halves = group_sum(bin_ids, I_even + I_odd, n_groups) * 0.5
+        self.r_split = np.zeros(n_groups)
+        i_sel = (self.n_refl > 0) & (sum_halves != 0)
+        self.r_split[i_sel] = (1 / math.sqrt(2)) * (
+            sum_abs_diff[i_sel] / sum_halves[i_sel]
+        )
+        self.cc12 = group_correlation(bin_ids, I_even, I_odd, n_groups)
+        self.mean_IoversigI = group_mean(bin_ids, I_merge / sigI_merge, n_groups)
+        self.mean_I = group_mean(bin_ids, I_merge, n_groups)
+        self.mean_sigI = group_mean(bin_ids, sigI_merge, n_groups)
+        # second moment of acentric reflections
+        i_acentric = (
+            mdh.miller_array_merge.centric_flags().data() == False
+        ).as_numpy_array()
+        acentric_ids = np.where(i_acentric, bin_ids, 0)
+        mean_I_acentric = group_mean(acentric_ids, I_merge, n_groups)
+        self.second_moment = np.zeros(n_groups)
+        i_sel = mean_I_acentric != 0
+        self.second_moment[i_sel] = group_mean(acentric_ids, I_merge ** 2, n_groups)[
+            i_sel
+        ] / (mean_I_acentric[i_sel] ** 2)
+        # CCiso
+        self.cciso = np.zeros(n_groups)
+        self.n_refl_cciso = np.zeros(n_groups, dtype=np.int64)
+        if miller_array_iso:
+            positions_iso = match_miller_indices(
+                miller_array_iso.indices(), mdh.miller_array_merge.indices()
+            )
+            i_iso = positions_iso >= 0
+            I_iso = miller_array_iso.data().as_numpy_array()[positions_iso[i_iso]]
+            self.n_refl_cciso = group_count(bin_ids[i_iso], n_groups)
+            self.cciso = group_correlation(
+                bin_ids[i_iso], I_merge[i_iso], I_iso, n_groups
+            )
+        # CCanom, Friedel mates have the same resolution (and bin)
+        self.flag_anomalous = mdh.miller_array_merge.anomalous_flag()
+        if self.flag_anomalous:
+            ma_anom_dif_even = mdh.miller_array_merge.customized_copy(
+                data=mdh.I_even
+            ).anomalous_differences()
+            ma_anom_dif_odd = mdh.miller_array_merge.customized_copy(
+                data=mdh.I_odd
+            ).anomalous_differences()
+            i_acentric = (
+                ma_anom_dif_even.centric_flags().data() == False
+            ).as_numpy_array()
+            positions_anom = match_miller_indices(
+                miller_array_template_asu.indices(), ma_anom_dif_even.indices()
+            )
+            anom_bin_ids = np.zeros(len(positions_anom), dtype=np.int64)
+            anom_bin_ids[positions_anom >= 0] = template_bin_ids[
+                positions_anom[positions_anom >= 0]
+            ]
+            anom_bin_ids[(anom_bin_ids > n_bins) | ~i_acentric] = 0
+            self.n_refl_anom = group_count(anom_bin_ids, n_groups)
+            self.cc_anom = group_correlation(
+                anom_bin_ids,
+                ma_anom_dif_even.data().as_numpy_array(),
+                ma_anom_dif_odd.data().as_numpy_array(),
+                n_groups,
+            )
+        # reflections on cones, binned and in total
+        self.n_refl_cone, self.cc12_cone, self.mean_I_cone = [], [], []
+        self.n_refl_cone_total, self.cc12_cone_total, self.mean_I_cone_total = (
+            [],
+            [],
+            [],
+        )
+        for i_axis in range(len(self.CONE_AXES)):
+            i_cone = (cone_masks & (1 << i_axis)) != 0
+            cone_ids = np.where(i_cone, bin_ids, 0)
+            self.n_refl_cone.append(group_count(cone_ids, n_groups))
+            self.cc12_cone.append(group_correlation(cone_ids, I_even, I_odd, n_groups))
+            self.mean_I_cone.append(group_mean(cone_ids, I_merge, n_groups))
+            cone_ids = i_cone.astype(np.int64)
+            self.n_refl_cone_total.append(int(np.sum(i_cone)))
+            self.cc12_cone_total.append(
+                group_correlation(cone_ids, I_even, I_odd, 2)[1]
+            )
+            self.mean_I_cone_total.append(group_mean(cone_ids, I_merge, 2)[1])
+
+    def get_bin_stats(self, i_bin):
+        """Return statistics of all reflections in bin i_bin (1 to n_bins) with
+        the values and types of the corresponding merge_data_handler
+        methods."""
+        n_refl = int(self.n_refl[i_bin])
+        n_refl_cciso = int(self.n_refl_cciso[i_bin])
+        return {
+            "n_refl": n_refl,
+            "n_template": int(self.n_template[i_bin]),
+            "completeness": (n_refl / int(self.n_template[i_bin])) * 100,
+            "multiplicity": float(self.multiplicity[i_bin]) if n_refl else 0,
+            "r_meas": float(self.r_meas[i_bin]),
+            "r_split": float(self.r_split[i_bin]),
+            "cc12": (float(self.cc12[i_bin]), n_refl) if n_refl else (0, 0),
+            "cciso": (float(self.cciso[i_bin]) if n_refl_cciso else 0, n_refl_cciso),
+            "cc_anom": (float(self.cc_anom[i_bin]), int(self.n_refl_anom[i_bin]))
+            if self.flag_anomalous
+            else (0, 0),
+            "mean_IoversigI": float(self.mean_IoversigI[i_bin]) if n_refl else 0,
+            "mean_I": float(self.mean_I[i_bin]) if n_refl else 0,
+            "mean_sigI": float(self.mean_sigI[i_bin]) if n_refl else 0,
+            "second_moment": float(self.second_moment[i_bin]) if n_refl else 0,
+        }
+
+    def get_cone_stats(self, i_axis, i_bin=None):
+        """Return (cc12, n_refl), mean_I of reflections on cone i_axis in bin
+        i_bin or in total if i_bin is None."""
+        if i_bin is None:
+            n_refl = self.n_refl_cone_total[i_axis]
+            cc12 = self.cc12_cone_total[i_axis]
+            mean_I = self.mean_I_cone_total[i_axis]
+        else:
+            n_refl = int(self.n_refl_cone[i_axis][i_bin])
+            cc12 = self.cc12_cone[i_axis][i_bin]
+            mean_I = self.mean_I_cone[i_axis][i_bin]
+        if n_refl == 0:
+            return (0, 0), 0
+        return (float(cc12), n_refl), float(mean_I)
@@ -4,6 +4,81 @@ from scitbx.matrix import sqr, col
 from cctbx.crystal_orientation import crystal_orientation, basis_type
 import math
 import numpy as np
+from .mod_hkl import miller_indices_as_numpy
+
+
+def as_numpy_array(values):
+    if hasattr(values, "as_numpy_array"):
+        return values.as_numpy_array()
+    return np.asarray(values, dtype=np.float64)
+
+
+def get_nearest_grid_index(grid, values):
+    """Return for each of values the index of the nearest point of grid
+    (non-decreasing), the first one on ties (as np.argmin(np.abs(values -
+    grid)) for each value)."""
+    n_grid = len(grid)
+    i_upper = np.clip(np.searchsorted(grid, values, side="left"), 1, n_grid - 1)
+    i_lower = i_upper - 1
+    # on flat runs of the grid searchsorted gives the first of equal points
+    i_lower = np.searchsorted(grid, grid[i_lower], side="left")
+    flag_lower = np.abs(values - grid[i_lower]) <= np.abs(values - grid[i_upper])
+    indices = np.where(flag_lower, i_lower, i_upper)
+    # nan and +-inf are as far from every point, argmin gives the first
+    indices[~np.isfinite(values)] = 0
+    return indices
+
+
+def get_lognpdf_sigma(FWHM, zero):
+    """Return sigma of the lognormal partiality for spot radii FWHM (the
+    point of a grid of sigmas nearest to the root for each FWHM)."""
+    # find sig from root of this function
+    sig_range = np.arange(50) / 100
+    t = sig_range * math.sqrt(math.log(4))
+    return sig_range[
+        get_nearest_grid_index(
+            zero * (np.exp(t) - np.exp(-1 * t)), as_numpy_array(FWHM)
+        )
+    ]
+
+
+def calc_lognpdf_array(x, FWHM, zero):
+    """Return lognormal partiality (numpy array) of x for spot radii FWHM."""
+    zero = np.abs(zero)
+    sig_set = get_lognpdf_sigma(FWHM, zero)
+    # calc x0
+    x0 = math.log(zero) + sig_set ** 2
+    g = 1 / (sig_set * math.sqrt(2 * math.pi) * np.exp(x0 - ((sig_set ** 2) / 2)))
+    # calc lognpdf
+    X = zero - as_numpy_array(x)
+    f1 = 1 / (X * sig_set * math.sqrt(2 * math.pi))
+    f2 = np.exp(-1 * (np.log(X) - x0) ** 2 / (2 * (sig_set ** 2)))
+    return f1 * f2 / g
+
+
+def get_frame_ids(offsets):
+    """Return frame index of each reflection of a batch of frames (the
+    reflections of frame i are offsets[i]:offsets[i+1])."""
+    offsets = np.asarray(offsets, dtype=np.int64)
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+# calc_partiality_set of the prime extension, None if it is not built
+_partiality_kernel = False
+
+
+def get_partiality_kernel():
+    """Return the C++ partiality kernel (prime_ext.calc_partiality_set) or
+    None if the extension is not available."""
+    global _partiality_kernel
+    if _partiality_kernel is False:
+        try:
+            from prime import calc_partiality_set
+
+            _partiality_kernel = calc_partiality_set
+        except ImportError:
+            _partiality_kernel = None
+    return _partiality_kernel
 
 
 class partiality_handler(object):
@@ -58,27 +133,91 @@ class partiality_handler(object):
         return svx
 
     def lognpdf(self, x, FWHM, zero):
-        # find sig from root of this function
-        zero = np.abs(zero)
-        sig_range = np.arange(50) / 100
-        t = sig_range * math.sqrt(math.log(4))
-        sig_set = np.array(
-            [
-                sig_range[
-                    np.argmin(np.abs((fwhm - (zero * (np.exp(t) - np.exp(-1 * t))))))
-                ]
-                for fwhm in FWHM
-            ]
-        )
-        # calc x0
-        x0 = math.log(zero) + sig_set ** 2
-        g = 1 / (sig_set * math.sqrt(2 * math.pi) * np.exp(x0 - ((sig_set ** 2) / 2)))
-        # calc lognpdf
-        X = zero - x
-        f1 = 1 / (X * sig_set * math.sqrt(2 * math.pi))
-        f2 = np.exp(-1 * (np.log(X) - x0) ** 2 / (2 * (sig_set ** 2)))
-        svx = flex.double(f1 * f2 / g)
-        return svx
+        return flex.double(calc_lognpdf_array(x, FWHM, zero))
+
+    def calc_partiality(self, rh_set, rs_set, nu, partiality_model):
+        if partiality_model == "Lorentzian":
+            partiality_set = (rs_set ** 2) / ((2 * (rh_set ** 2)) + (rs_set ** 2))
+        elif partiality_model == "Voigt":
+            partiality_set = self.voigt(rh_set, rs_set, nu)
+        elif partiality_model == "Lognormal":
+            partiality_set = self.lognpdf(rh_set, rs_set, nu)
+        return partiality_set
+
+    def calc_delta_xy(
+        self, sd_array, spot_pred_x_mm_set, spot_pred_y_mm_set, detector_distance_mm
+    ):
+        if sum(spot_pred_y_mm_set) == 0:
+            # hack for dials integration - spot_pred_x_mm_set is s1 * to be fixed *
+            delta_xy_set = (spot_pred_x_mm_set - sd_array).norms()
+        else:
+            d_ratio = -detector_distance_mm / sd_array.parts()[2]
+            calc_xy_array = flex.vec3_double(
+                sd_array.parts()[0] * d_ratio,
+                sd_array.parts()[1] * d_ratio,
+                flex.double([0] * len(d_ratio)),
+            )
+            pred_xy_array = flex.vec3_double(
+                spot_pred_x_mm_set, spot_pred_y_mm_set, flex.double([0] * len(d_ratio))
+            )
+            delta_xy_set = (pred_xy_array - calc_xy_array).norms()
+        return delta_xy_set
+
+    def calc_partiality_derivatives(self, rh_set, rs_set, nu, partiality_model):
+        """Return partiality and its derivatives with respect to rh, rs and nu.
+        The Lognormal sigma is looked up on a grid of rs and nu, its
+        derivatives with respect to rs and nu are None (see
+        func_and_jacobian)."""
+        if partiality_model == "Lorentzian":
+            denom = (2 * (rh_set ** 2)) + (rs_set ** 2)
+            partiality_set = (rs_set ** 2) / denom
+            dp_drh = -4 * rh_set * (rs_set ** 2) / (denom ** 2)
+            dp_drs = 4 * rs_set * (rh_set ** 2) / (denom ** 2)
+            dp_dnu = flex.double(len(rh_set), 0)
+        elif partiality_model == "Voigt":
+            # the voigt function only depends on u = rh/rs and nu
+            nu_c = min(max(nu, 0), 1)
+            c1 = math.sqrt(math.log(2) / math.pi)
+            u = rh_set / rs_set
+            E = flex.exp(-4 * math.log(2) * (u ** 2))
+            L = 1 / (math.pi * (1 + (4 * (u ** 2))))
+            num = (nu_c * c1 * E) + ((1 - nu_c) * L)
+            denom = (nu_c * c1) + ((1 - nu_c) / math.pi)
+            partiality_set = num / denom
+            dnum_du = (nu_c * c1 * E * (-8 * math.log(2) * u)) + (
+                (1 - nu_c) * (-8 * u) / (math.pi * ((1 + (4 * (u ** 2))) ** 2))
+            )
+            dp_du = dnum_du / denom
+            dp_drh = dp_du / rs_set
+            dp_drs = -dp_du * rh_set / (rs_set ** 2)
+            if nu < 0 or nu > 1:
+                dp_dnu = flex.double(len(rh_set), 0)
+            else:
+                dp_dnu = ((c1 * E) - L) / denom - (
+                    num * (c1 - (1 / math.pi)) / (denom ** 2)
+                )
+        elif partiality_model == "Lognormal":
+            # with sigma fixed at its grid point p = C exp(-(ln(X) - x0)^2 /
+            # (2 sigma^2)) / X with X = nu - rh
+            zero = abs(nu)
+            sig_set = get_lognpdf_sigma(rs_set, zero)
+            x0 = math.log(zero) + sig_set ** 2
+            X = zero - rh_set.as_numpy_array()
+            p = calc_lognpdf_array(rh_set, rs_set, nu)
+            partiality_set = flex.double(p)
+            dp_drh = flex.double(p * (1 + ((np.log(X) - x0) / (sig_set ** 2))) / X)
+            dp_drs = None
+            dp_dnu = None
+        return partiality_set, dp_drh, dp_drs, dp_dnu
+
+    def calc_reciprocal_matrix(self, my_uc, rotx, roty, crystal_init_orientation):
+        """Return reciprocal matrix of the crystal with unit cell my_uc, rotated
+        by rotx and roty from the initial orientation."""
+        O = sqr(my_uc.orthogonalization_matrix()).transpose()
+        R = sqr(crystal_init_orientation.crystal_rotation_matrix()).transpose()
+        CO = crystal_orientation(O * R, basis_type.direct)
+        CO_rotate = CO.rotate_thru((1, 0, 0), rotx).rotate_thru((0, 1, 0), roty)
+        return sqr(CO_rotate.reciprocal_matrix())
 
     def calc_partiality_anisotropy_set(
         self,
@@ -102,11 +241,105 @@ class partiality_handler(object):
         flag_beam_divergence,
     ):
         # use III.4 in Winkler et al 1979 (A35; P901) for set of miller indices
-        O = sqr(my_uc.orthogonalization_matrix()).transpose()
-        R = sqr(crystal_init_orientation.crystal_rotation_matrix()).transpose()
-        CO = crystal_orientation(O * R, basis_type.direct)
-        CO_rotate = CO.rotate_thru((1, 0, 0), rotx).rotate_thru((0, 1, 0), roty)
-        A_star = sqr(CO_rotate.reciprocal_matrix())
+        A_star = self.calc_reciprocal_matrix(
+            my_uc, rotx, roty, crystal_init_orientation
+        )
+        return self.calc_partiality_set(
+            A_star,
+            miller_indices,
+            ry,
+            rz,
+            r0,
+            re,
+            nu,
+            bragg_angle_set,
+            alpha_angle_set,
+            wavelength,
+            spot_pred_x_mm_set,
+            spot_pred_y_mm_set,
+            detector_distance_mm,
+            partiality_model,
+            flag_beam_divergence,
+        )
+
+    def calc_partiality_set(
+        self,
+        A_star,
+        miller_indices,
+        ry,
+        rz,
+        r0,
+        re,
+        nu,
+        bragg_angle_set,
+        alpha_angle_set,
+        wavelength,
+        spot_pred_x_mm_set,
+        spot_pred_y_mm_set,
+        detector_distance_mm,
+        partiality_model,
+        flag_beam_divergence,
+    ):
+        """Return (partiality, delta_xy, rs, rh) of miller_indices for the
+        reciprocal matrix A_star. Computed in one pass by the C++ kernel of
+        the prime extension when available (not for dials spot predictions),
+        else by calc_partiality_set_py."""
+        kernel = get_partiality_kernel()
+        if kernel is None or sum(spot_pred_y_mm_set) == 0:
+            return self.calc_partiality_set_py(
+                A_star,
+                miller_indices,
+                ry,
+                rz,
+                r0,
+                re,
+                nu,
+                bragg_angle_set,
+                alpha_angle_set,
+                wavelength,
+                spot_pred_x_mm_set,
+                spot_pred_y_mm_set,
+                detector_distance_mm,
+                partiality_model,
+                flag_beam_divergence,
+            )
+        return kernel(
+            flex.double(A_star.elems),
+            miller_indices,
+            ry,
+            rz,
+            r0,
+            re,
+            nu,
+            bragg_angle_set,
+            alpha_angle_set,
+            wavelength,
+            spot_pred_x_mm_set,
+            spot_pred_y_mm_set,
+            detector_distance_mm,
+            partiality_model,
+            bool(flag_beam_divergence),
+        )
+
+    def calc_partiality_set_py(
+        self,
+        A_star,
+        miller_indices,
+        ry,
+        rz,
+        r0,
+        re,
+        nu,
+        bragg_angle_set,
+        alpha_angle_set,
+        wavelength,
+        spot_pred_x_mm_set,
+        spot_pred_y_mm_set,
+        detector_distance_mm,
+        partiality_model,
+        flag_beam_divergence,
+    ):
+        """Reference implementation of calc_partiality_set."""
         S0 = -1 * col((0, 0, 1.0 / wavelength))
         # caculate rs
         rs_set = r0 + (re * flex.tan(bragg_angle_set))
@@ -119,26 +352,72 @@ class partiality_handler(object):
         x = A_star.elems * miller_indices.as_vec3_double()
         sd_array = x + S0.elems
         rh_set = sd_array.norms() - (1 / wavelength)
-        # calculate partiality
+        partiality_set = self.calc_partiality(rh_set, rs_set, nu, partiality_model)
+        delta_xy_set = self.calc_delta_xy(
+            sd_array, spot_pred_x_mm_set, spot_pred_y_mm_set, detector_distance_mm
+        )
+        return partiality_set, delta_xy_set, rs_set, rh_set
+
+    def calc_partiality_batch(
+        self,
+        A_star_set,
+        miller_indices,
+        offsets,
+        frame_params,
+        bragg_angle_set,
+        alpha_angle_set,
+        partiality_model,
+        flag_beam_divergence,
+    ):
+        """Return (partiality, rs, rh) numpy arrays of a batch of frames in one
+        vectorized pass (as calc_partiality_set for each frame).
+
+        The reflections of all frames are concatenated, those of frame i are
+        offsets[i]:offsets[i+1]. A_star_set holds the reciprocal matrix of
+        each frame (n_frames x 9, row-major) and frame_params the values of
+        ry, rz, r0, re, nu and wavelength of each frame (n_frames x 6).
+        """
+        frame_ids = get_frame_ids(offsets)
+        A_star = np.asarray(A_star_set, dtype=np.float64).reshape((-1, 3, 3))
+        ry, rz, r0, re, nu, wavelength = (
+            np.asarray(frame_params, dtype=np.float64).reshape((-1, 6))[frame_ids].T
+        )
+        bragg_angle_set = as_numpy_array(bragg_angle_set)
+        alpha_angle_set = as_numpy_array(alpha_angle_set)
+        # caculate rs
+        rs_set = r0 + (re * np.tan(bragg_angle_set))
+        if flag_beam_divergence:
+            rs_set += np.sqrt(
+                (ry * np.cos(alpha_angle_set)) ** 2
+                + (rz * np.sin(alpha_angle_set)) ** 2
+            )
+        # calculate rh
+        hkl = miller_indices_as_numpy(miller_indices).astype(np.float64)
+        sd_array = np.einsum("nij,nj->ni", A_star[frame_ids], hkl)
+        sd_array[:, 2] -= 1 / wavelength
+        rh_set = np.sqrt((sd_array ** 2).sum(axis=1)) - (1 / wavelength)
         if partiality_model == "Lorentzian":
             partiality_set = (rs_set ** 2) / ((2 * (rh_set ** 2)) + (rs_set ** 2))
         elif partiality_model == "Voigt":
-            partiality_set = self.voigt(rh_set, rs_set, nu)
-        elif partiality_model == "Lognormal":
-            partiality_set = self.lognpdf(rh_set, rs_set, nu)
-        # calculate delta_xy
-        if sum(spot_pred_y_mm_set) == 0:
-            # hack for dials integration - spot_pred_x_mm_set is s1 * to be fixed *
-            delta_xy_set = (spot_pred_x_mm_set - sd_array).norms()
-        else:
-            d_ratio = -detector_distance_mm / sd_array.parts()[2]
-            calc_xy_array = flex.vec3_double(
-                sd_array.parts()[0] * d_ratio,
-                sd_array.parts()[1] * d_ratio,
-                flex.double([0] * len(d_ratio)),
+            nu = np.clip(nu, 0, 1)
+            u_sq = (rh_set / rs_set) ** 2
+            f1 = (
+                nu
+                * math.sqrt(math.log(2) / math.pi)
+                * np.exp(-4 * math.log(2) * u_sq)
+                * (1 / np.abs(rs_set))
             )
-            pred_xy_array = flex.vec3_double(
-                spot_pred_x_mm_set, spot_pred_y_mm_set, flex.double([0] * len(d_ratio))
+            f2 = (1 - nu) / (math.pi * np.abs(rs_set) * (1 + (4 * u_sq)))
+            f3 = ((nu * math.sqrt(math.log(2) / math.pi)) / np.abs(rs_set)) + (
+                (1 - nu) / (math.pi * np.abs(rs_set))
             )
-            delta_xy_set = (pred_xy_array - calc_xy_array).norms()
-        return partiality_set, delta_xy_set, rs_set, rh_set
+            partiality_set = (f1 + f2) / f3
+        elif partiality_model == "Lognormal":
+            # the sigma grid depends on nu, one call per distinct value
+            partiality_set = np.zeros(len(rh_set))
+            for zero in np.unique(nu):
+                i_sel = nu == zero
+                partiality_set[i_sel] = calc_lognpdf_array(
+                    rh_set[i_sel], rs_set[i_sel], zero
+                )
+        return partiality_set, rs_set, rh_set
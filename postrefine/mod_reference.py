@@ -0,0 +1,148 @@
+"""
+Description : Reference intensities as sorted packed hkl keys for workers.
+
+A reference_handler holds the miller indices of the reference set as sorted
+int64 keys (see mod_hkl) and the intensities in the same order. After
+publish(), the two arrays live in one POSIX shared memory block and a
+pickled reference_handler only carries the name of the block, so passing it
+to every frame task costs a few bytes and workers attach zero-copy. Under
+MPI, share_reference_mpi places the arrays in a node-shared window instead.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from .mod_hkl import pack_miller_indices, search_sorted_keys
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8, references are pickled with their arrays
+    shared_memory = None
+
+# shared memory blocks attached by this process
+_attached_blocks = {}
+
+
+def get_reference_from_miller_array(miller_array):
+    keys = pack_miller_indices(miller_array.indices())
+    order = np.argsort(keys, kind="mergesort")
+    return reference_handler(keys[order], miller_array.data().as_numpy_array()[order])
+
+
+def _get_arrays(buf, size):
+    keys = np.ndarray((size,), dtype=np.int64, buffer=buf)
+    I = np.ndarray((size,), dtype=np.float64, buffer=buf, offset=size * 8)
+    return keys, I
+
+
+def _attach_block(shm_name, size):
+    if shm_name not in _attached_blocks:
+        # blocks of earlier cycles are closed once no array uses them
+        for name in list(_attached_blocks):
+            try:
+                _attached_blocks[name].close()
+                del _attached_blocks[name]
+            except BufferError:
+                pass
+        _attached_blocks[shm_name] = shared_memory.SharedMemory(name=shm_name)
+    return _get_arrays(_attached_blocks[shm_name].buf, size)
+
+
+class reference_handler(object):
+    """Reference intensities, matched to observations by packed hkl keys."""
+
+    def __init__(self, keys, I):
+        self.keys = keys
+        self.I = I
+        self.shm = None
+        self.shm_name = None
+        self.mpi_objects = None
+
+    def size(self):
+        return len(self.keys)
+
+    def publish(self):
+        """Move the arrays to shared memory (no-op if not available)."""
+        if shared_memory is None or self.shm is not None or self.size() == 0:
+            return self
+        self.shm = shared_memory.SharedMemory(create=True, size=self.size() * 16)
+        keys, I = _get_arrays(self.shm.buf, self.size())
+        keys[:] = self.keys
+        I[:] = self.I
+        self.keys, self.I = keys, I
+        self.shm_name = self.shm.name
+        return self
+
+    def release(self):
+        """Free the shared memory block or MPI window (collective on the
+        node for MPI)."""
+        if self.shm is not None:
+            self.keys, self.I = self.keys.copy(), self.I.copy()
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+            self.shm_name = None
+        if self.mpi_objects is not None:
+            self.keys, self.I = self.keys.copy(), self.I.copy()
+            win, node_comm = self.mpi_objects
+            win.Free()
+            node_comm.Free()
+            self.mpi_objects = None
+
+    def __getstate__(self):
+        if self.shm_name is not None:
+            return {"shm_name": self.shm_name, "size": self.size()}
+        return {"keys": np.asarray(self.keys), "I": np.asarray(self.I)}
+
+    def __setstate__(self, state):
+        self.shm = None
+        self.shm_name = None
+        self.mpi_objects = None
+        if "shm_name" in state:
+            self.keys, self.I = _attach_block(state["shm_name"], state["size"])
+        else:
+            self.keys, self.I = state["keys"], state["I"]
+
+    def match(self, miller_indices):
+        """Return positions (i_ref, i_obs) of miller_indices found in the
+        reference, in the order of miller_indices."""
+        return search_sorted_keys(self.keys, pack_miller_indices(miller_indices))
+
+    def correlation(self, miller_array, assert_is_similar_symmetry=False):
+        """Return flex.linear_correlation of the reference and miller_array
+        on common indices (as miller.array.correlation)."""
+        from cctbx.array_family import flex
+
+        i_ref, i_obs = self.match(miller_array.indices())
+        return flex.linear_correlation(
+            flex.double(np.ascontiguousarray(self.I[i_ref])),
+            flex.double(miller_array.data().as_numpy_array()[i_obs]),
+        )
+
+
+def share_reference_mpi(reference, comm):
+    """Collective: return the reference of rank 0 on all ranks of comm, with
+    the arrays in one MPI shared window per node. The data is sent once to
+    each node and the ranks on a node attach zero-copy. Call release() on
+    all ranks when done."""
+    from mpi4py import MPI
+
+    rank = comm.Get_rank()
+    size = comm.bcast(reference.size() if rank == 0 else None, root=0)
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    flag_leader = node_comm.Get_rank() == 0
+    win = MPI.Win.Allocate_shared(size * 16 if flag_leader else 0, 8, comm=node_comm)
+    buf, dummy = win.Shared_query(0)
+    keys, I = _get_arrays(buf, size)
+    # rank 0 leads its node and is rank 0 of the leaders
+    leader_comm = comm.Split(0 if flag_leader else MPI.UNDEFINED, key=rank)
+    if flag_leader:
+        if rank == 0:
+            keys[:] = reference.keys
+            I[:] = reference.I
+        leader_comm.Bcast(keys, root=0)
+        leader_comm.Bcast(I, root=0)
+        leader_comm.Free()
+    node_comm.Barrier()
+    shared_reference = reference_handler(keys, I)
+    shared_reference.mpi_objects = (win, node_comm)
+    return shared_reference
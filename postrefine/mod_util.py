@@ -6,13 +6,18 @@ from iotbx import mtz
 from libtbx.utils import Sorry
 import math, os
 import numpy as np
-from copy import deepcopy
 from six.moves import cPickle as pickle
 from collections import Counter
-from .mod_merge_data import merge_data_handler
+from .mod_merge_data import (
+    merge_data_handler,
+    merge_stats_handler,
+    get_binned_outlier_sequences,
+)
 from .mod_mx import mx_handler
 from .mod_leastsqr import good_unit_cell
+from .mod_hkl import pack_miller_indices, miller_index_lookup
 from six.moves import range
+from six.moves import zip
 
 
 class intensities_scaler(object):
@@ -41,8 +46,10 @@ class intensities_scaler(object):
         else:
             pickle.dump(stat_dict, open(fname, "wb"))
 
-    def calc_avg_I_cpp(self, prep_output, iparams, avg_mode):
-        group_no, group_id_list, miller_index, miller_indices_ori, I, sigI, G, B, p_set, rs_set, wavelength_set, sin_theta_over_lambda_sq, SE, uc_mean, wavelength_mean, pickle_filename_set, txt_out = (
+    def calc_avg_I_cpp(self, prep_output, iparams, avg_mode, n_threads=None):
+        """Average observations in prep_output with the C++ averaging engine
+        using n_threads threads (default iparams.n_processors)."""
+        group_no, group_id_list, miller_index, miller_indices_ori, I, sigI, G, B, p_set, rs_set, wavelength_set, sin_theta_over_lambda_sq, SE, uc_mean, wavelength_mean, frame_id_set, frame_files, txt_out = (
             prep_output
         )
         from prime import Average_Mode, averaging_engine
@@ -70,13 +77,15 @@ class intensities_scaler(object):
             wavelength_set,
             sin_theta_over_lambda_sq,
             SE,
-            pickle_filename_set,
+            frame_id_set,
+            flex.std_string(frame_files),
         )
         engine.avg_mode = avg_mode_cpp
         engine.sigma_max = sigma_max
         engine.flag_volume_correction = iparams.flag_volume_correction
         engine.n_rejection_cycle = iparams.n_rejection_cycle
         engine.flag_output_verbose = iparams.flag_output_verbose
+        engine.n_threads = iparams.n_processors if n_threads is None else n_threads
         results = engine.calc_avg_I()
         mdh = merge_data_handler()
         mdh.extend_data(
@@ -97,7 +106,63 @@ class intensities_scaler(object):
             uc_mean,
             wavelength_mean,
         )
-        return mdh, results.txt_obs_out, results.txt_reject_out
+        # rejected observations refer to their frames by index into the frame
+        # table (frame_files) of prep_output
+        reject_out = (
+            results.reject_frame_id,
+            results.reject_miller_index_ori,
+            results.reject_I,
+            results.reject_sigI,
+        )
+        return mdh, results.txt_obs_out, reject_out
+
+    def combine_rejections(self, reject_out_list):
+        """Concatenate rejections returned by calc_avg_I_cpp for batches of
+        the same frame table."""
+        frame_ids = flex.int()
+        miller_indices_ori = flex.miller_index()
+        I = flex.double()
+        sigI = flex.double()
+        for _frame_ids, _miller_indices_ori, _I, _sigI in reject_out_list:
+            frame_ids.extend(_frame_ids)
+            miller_indices_ori.extend(_miller_indices_ori)
+            I.extend(_I)
+            sigI.extend(_sigI)
+        return frame_ids, miller_indices_ori, I, sigI
+
+    def format_rejections(self, reject_out, frame_files):
+        """Return rejections as text, one observation per line (frame ids
+        index frame_files)."""
+        frame_ids, miller_indices_ori, I, sigI = reject_out
+        return "".join(
+            [
+                "%s %3.0f %3.0f %3.0f %10.2f %10.2f\n"
+                % (frame_files[frame_id], h, k, l, _I, _sigI)
+                for frame_id, (h, k, l), _I, _sigI in zip(
+                    frame_ids, miller_indices_ori, I, sigI
+                )
+            ]
+        )
+
+    def get_rejection_keys(self, reject_out, frame_files):
+        """Return dict of frame file and sorted packed keys of its rejected
+        miller indices (as used in iparams.rejections, frame ids index
+        frame_files)."""
+        frame_ids, miller_indices_ori, I, sigI = reject_out
+        if len(frame_ids) == 0:
+            return {}
+        keys = pack_miller_indices(miller_indices_ori)
+        frame_ids = frame_ids.as_numpy_array()
+        perm = np.argsort(frame_ids, kind="mergesort")
+        frame_ids_sorted = frame_ids[perm]
+        i_splits = np.flatnonzero(np.diff(frame_ids_sorted)) + 1
+        rejections = {}
+        for keys_frame, frame_id in zip(
+            np.split(keys[perm], i_splits),
+            frame_ids_sorted[np.concatenate(([0], i_splits))],
+        ):
+            rejections[frame_files[frame_id]] = np.unique(keys_frame)
+        return rejections
 
     def calc_mean_unit_cell(self, results):
         uc_array = [list(pres.uc_params) for pres in results if pres is not None]
@@ -186,7 +251,8 @@ class intensities_scaler(object):
         R_final_all = flex.double()
         R_xy_init_all = flex.double()
         R_xy_final_all = flex.double()
-        pickle_filename_all = flex.std_string()
+        frame_id_all = flex.int()
+        frame_files = []
         filtered_results = []
         cn_good_frame, cn_bad_frame_SE, cn_bad_frame_uc, cn_bad_frame_cc, cn_bad_frame_G, cn_bad_frame_re = (
             0,
@@ -254,9 +320,8 @@ class intensities_scaler(object):
                     SE_all.extend(flex.double([pres.SE] * data_size))
                     wavelength_all.extend(flex.double([pres.wavelength] * data_size))
                     detector_distance_set.append(pres.detector_distance_mm)
-                    pickle_filename_all.extend(
-                        flex.std_string([pres.pickle_filename] * data_size)
-                    )
+                    frame_id_all.extend(flex.int(data_size, len(frame_files)))
+                    frame_files.append(pres.pickle_filename)
                     crystal_orientation_dict[
                         pres.pickle_filename
                     ] = pres.crystal_orientation
@@ -310,21 +375,16 @@ class intensities_scaler(object):
         wavelength_all_sort = wavelength_all.select(perm)
         sin_sq_all_sort = sin_sq_all.select(perm)
         SE_all_sort = SE_all.select(perm)
-        pickle_filename_all_sort = pickle_filename_all.select(perm)
+        frame_id_all_sort = frame_id_all.select(perm)
         miller_array_uniq = (
             miller_array_all.merge_equivalents()
             .array()
             .complete_array(d_min=iparams.merge.d_min, d_max=iparams.merge.d_max)
         )
-        matches_uniq = miller.match_multi_indices(
-            miller_indices_unique=miller_array_uniq.indices(),
-            miller_indices=miller_indices_all_sort,
-        )
-        pair_0 = flex.int([pair[0] for pair in matches_uniq.pairs()])
-        pair_1 = flex.int([pair[1] for pair in matches_uniq.pairs()])
-        group_id_list = flex.int(
-            [pair_0[pair_1[i]] for i in range(len(matches_uniq.pairs()))]
+        pair_0, pair_1 = miller_index_lookup(miller_array_uniq.indices()).lookup(
+            miller_indices_all_sort
         )
+        group_id_list = flex.int(pair_0[pair_1].tolist())
         tally = Counter()
         for elem in group_id_list:
             tally[elem] += 1
@@ -507,7 +567,8 @@ class intensities_scaler(object):
             SE_all_sort,
             uc_mean,
             np.mean(wavelength_all),
-            pickle_filename_all_sort,
+            frame_id_all_sort,
+            frame_files,
             txt_out,
         )
 
@@ -544,31 +605,15 @@ class intensities_scaler(object):
         mdh.reduce_by_selection(i_sel_res)
         n_refl_out_resolutions = n_refl_all - mdh.get_size()
         # remove outliers
-        sequences = flex.int(range(mdh.get_size()))
-        good_sequences = []
         for i_rejection in range(iparams.n_rejection_cycle):
             binner_merge = mdh.miller_array_merge.setup_binner(n_bins=200)
-            for i_bin in range(1, 201):
-                i_binner = binner_merge.bin_indices() == i_bin
-                I_obs_bin = mdh.miller_array_merge.data().select(i_binner)
-                sequences_bin = sequences.select(i_binner)
-                if len(I_obs_bin) > 0:
-                    I_obs_bin = mdh.miller_array_merge.data().select(i_binner)
-                    try:
-                        i_filter = (
-                            flex.abs(
-                                (I_obs_bin - np.median(I_obs_bin)) / np.std(I_obs_bin)
-                            )
-                            < 10
-                        )
-                    except Exception as e:
-                        print(
-                            "Warning: outlier rejection by bins failed because of floating point."
-                        )
-                        print(e)
-                        i_filter = flex.bool([True] * len(I_obs_bin))
-                    good_sequences.extend(list(sequences_bin.select(i_filter)))
-        mdh.reduce_by_selection(flex.size_t(good_sequences))
+            good_sequences = get_binned_outlier_sequences(
+                mdh.miller_array_merge.data().as_numpy_array(),
+                binner_merge.bin_indices().as_numpy_array(),
+                200,
+                10,
+            )
+            mdh.reduce_by_selection(flex.size_t(good_sequences.tolist()))
         n_refl_outliers = n_refl_all - n_refl_out_resolutions - mdh.get_size()
         # get iso if given.
         mxh = mx_handler()
@@ -637,34 +682,29 @@ class intensities_scaler(object):
             binner_template_asu = miller_array_template_asu.setup_binner(
                 n_bins=iparams.n_bins
             )
-            binner_template_asu_indices = binner_template_asu.bin_indices()
-            # for stats on axis cones
-            mdh_astar = deepcopy(mdh)
-            mdh_bstar = deepcopy(mdh)
-            mdh_cstar = deepcopy(mdh)
-            mdh_astar.reduce_to_cone_on_axis((1, 0, 0), iparams.percent_cone_fraction)
-            mdh_bstar.reduce_to_cone_on_axis((0, 1, 0), iparams.percent_cone_fraction)
-            mdh_cstar.reduce_to_cone_on_axis((0, 0, 1), iparams.percent_cone_fraction)
+            # per-bin and per-cone statistics in one pass
+            msh = merge_stats_handler(
+                mdh,
+                miller_array_template_asu,
+                binner_template_asu,
+                iparams.n_bins,
+                iparams.percent_cone_fraction,
+                miller_array_iso=miller_array_iso,
+            )
+            second_moment = mdh.get_second_moment()
             # prepare text out for axis cones
             txt_out_cone = "Summary of CC1/2 on three crystal axes\n"
             txt_out_cone += "Bin Resolution Range           CC1/2                      <I>                          N_refl           \n"
             txt_out_cone += "                        a*      b*      c*  |      a*        b*       c*    |    a*      b*     c*      \n"
             txt_out_cone += "---------------------------------------------------------------------------------------------------------\n"
             for i in range(1, iparams.n_bins + 1):
-                i_binner = binner_template_asu_indices == i
-                miller_indices_template_bin = miller_array_template_asu.indices().select(
-                    i_binner
-                )
                 # for all reflections
-                mdh_bin = deepcopy(mdh)
-                mdh_bin.reduce_by_miller_index(miller_indices_template_bin)
-                cc12, n_refl_cc12 = mdh_bin.get_cc12()
-                cciso, n_refl_cciso = mdh_bin.get_cciso(miller_array_iso)
-                cc_anom_acentric, n_refl_anom_acentric = mdh_bin.get_cc_anom()
-                completeness = (
-                    mdh_bin.get_size() / len(miller_indices_template_bin)
-                ) * 100
-                multiplicity = mdh_bin.get_multiplicity()
+                bin_stats = msh.get_bin_stats(i)
+                cc12, n_refl_cc12 = bin_stats["cc12"]
+                cciso, n_refl_cciso = bin_stats["cciso"]
+                cc_anom_acentric, n_refl_anom_acentric = bin_stats["cc_anom"]
+                completeness = bin_stats["completeness"]
+                multiplicity = bin_stats["multiplicity"]
                 txt_out += (
                     "%02d %7.2f - %7.2f %5.1f %6.0f / %6.0f %7.2f %7.2f %7.2f %7.2f %6.0f %7.2f %6.0f %7.2f %6.0f %8.2f %10.1f %8.1f %6.2f\n"
                     % (
@@ -672,33 +712,27 @@ class intensities_scaler(object):
                         binner_template_asu.bin_d_range(i)[0],
                         binner_template_asu.bin_d_range(i)[1],
                         completeness,
-                        mdh_bin.get_size(),
-                        len(miller_indices_template_bin),
+                        bin_stats["n_refl"],
+                        bin_stats["n_template"],
                         multiplicity,
-                        mdh_bin.get_r_meas() * 100,
-                        mdh_bin.get_r_split() * 100,
+                        bin_stats["r_meas"] * 100,
+                        bin_stats["r_split"] * 100,
                         cc12 * 100,
                         n_refl_cc12,
                         cciso * 100,
                         n_refl_cciso,
                         cc_anom_acentric,
                         n_refl_anom_acentric,
-                        mdh_bin.get_mean_IoversigI(),
-                        mdh_bin.get_mean_I(),
-                        mdh_bin.get_mean_sigI(),
-                        mdh_bin.get_second_moment(),
+                        bin_stats["mean_IoversigI"],
+                        bin_stats["mean_I"],
+                        bin_stats["mean_sigI"],
+                        bin_stats["second_moment"],
                     )
                 )
                 # for reflections on cones
-                mdh_astar_bin = deepcopy(mdh_astar)
-                mdh_astar_bin.reduce_by_miller_index(miller_indices_template_bin)
-                cc12_astar, n_refl_cc12_astar = mdh_astar_bin.get_cc12()
-                mdh_bstar_bin = deepcopy(mdh_bstar)
-                mdh_bstar_bin.reduce_by_miller_index(miller_indices_template_bin)
-                cc12_bstar, n_refl_cc12_bstar = mdh_bstar_bin.get_cc12()
-                mdh_cstar_bin = deepcopy(mdh_cstar)
-                mdh_cstar_bin.reduce_by_miller_index(miller_indices_template_bin)
-                cc12_cstar, n_refl_cc12_cstar = mdh_cstar_bin.get_cc12()
+                (cc12_astar, n_refl_cc12_astar), mean_I_astar = msh.get_cone_stats(0, i)
+                (cc12_bstar, n_refl_cc12_bstar), mean_I_bstar = msh.get_cone_stats(1, i)
+                (cc12_cstar, n_refl_cc12_cstar), mean_I_cstar = msh.get_cone_stats(2, i)
                 txt_out_cone += (
                     "%02d %7.2f - %7.2f %7.2f %7.2f %7.2f %10.1f %10.1f %10.1f %6.0f %6.0f %6.0f\n"
                     % (
@@ -708,9 +742,9 @@ class intensities_scaler(object):
                         cc12_astar * 100,
                         cc12_bstar * 100,
                         cc12_cstar * 100,
-                        mdh_astar_bin.get_mean_I(),
-                        mdh_bstar_bin.get_mean_I(),
-                        mdh_cstar_bin.get_mean_I(),
+                        mean_I_astar,
+                        mean_I_bstar,
+                        mean_I_cstar,
                         n_refl_cc12_astar,
                         n_refl_cc12_bstar,
                         n_refl_cc12_cstar,
@@ -722,9 +756,9 @@ class intensities_scaler(object):
                 sp_n_obs.append(multiplicity)
                 sp_cc12.append(cc12)
                 sp_cc12_anom.append(cc_anom_acentric)
-                sp_rmerge.append(mdh_bin.get_r_meas() * 100)
-                sp_i_o_sigi.append(mdh_bin.get_mean_IoversigI())
-                sp_isqr.append(mdh.get_second_moment())
+                sp_rmerge.append(bin_stats["r_meas"] * 100)
+                sp_i_o_sigi.append(bin_stats["mean_IoversigI"])
+                sp_isqr.append(second_moment)
             # txt out total for all reflections
             cc12, n_refl_cc12 = mdh.get_cc12()
             cciso, n_refl_cciso = mdh.get_cciso(miller_array_iso)
@@ -748,15 +782,15 @@ class intensities_scaler(object):
                     mdh.get_mean_IoversigI(),
                     mdh.get_mean_I(),
                     mdh.get_mean_sigI(),
-                    mdh.get_second_moment(),
+                    second_moment,
                 )
             )
             txt_out += "--------------------------------------------------------------------------------------------------------------------------------------------------\n"
             txt_out += "\n"
             # txt out total for reflections on cones
-            cc12_astar, n_refl_cc12_astar = mdh_astar.get_cc12()
-            cc12_bstar, n_refl_cc12_bstar = mdh_bstar.get_cc12()
-            cc12_cstar, n_refl_cc12_cstar = mdh_cstar.get_cc12()
+            (cc12_astar, n_refl_cc12_astar), mean_I_astar = msh.get_cone_stats(0)
+            (cc12_bstar, n_refl_cc12_bstar), mean_I_bstar = msh.get_cone_stats(1)
+            (cc12_cstar, n_refl_cc12_cstar), mean_I_cstar = msh.get_cone_stats(2)
             txt_out_cone += "----------------------------------------------------------------------------------------------------------\n"
             txt_out_cone += (
                 "       total         %7.2f %7.2f %7.2f %10.1f %10.1f %10.1f %6.0f %6.0f %6.0f\n"
@@ -764,9 +798,9 @@ class intensities_scaler(object):
                     cc12_astar * 100,
                     cc12_bstar * 100,
                     cc12_cstar * 100,
-                    mdh_astar.get_mean_I(),
-                    mdh_bstar.get_mean_I(),
-                    mdh_cstar.get_mean_I(),
+                    mean_I_astar,
+                    mean_I_bstar,
+                    mean_I_cstar,
                     n_refl_cc12_astar,
                     n_refl_cc12_bstar,
                     n_refl_cc12_cstar,
@@ -961,10 +995,11 @@ class intensities_scaler(object):
         SE_all = flex.double()
         uc_mean_set = []
         wavelength_mean_set = []
-        pickle_filename_all = flex.std_string()
+        frame_id_all = flex.int()
+        frame_files_all = []
         for res in result:
             for prep_output in res:
-                _, _, mi, mio, I, sigI, G, B, p, rs, wavelength, sin, SE, uc_mean, wavelength_mean, pickle_filename_set, txt_out = (
+                _, _, mi, mio, I, sigI, G, B, p, rs, wavelength, sin, SE, uc_mean, wavelength_mean, frame_id_set, frame_files, txt_out = (
                     prep_output
                 )
                 mi_all.extend(mi)
@@ -980,7 +1015,8 @@ class intensities_scaler(object):
                 SE_all.extend(SE)
                 uc_mean_set.extend(uc_mean)
                 wavelength_mean_set.append(wavelength_mean)
-                pickle_filename_all.extend(pickle_filename_set)
+                frame_id_all.extend(frame_id_set + len(frame_files_all))
+                frame_files_all.extend(frame_files)
         uc_mean = np.mean(np.array(uc_mean_set).reshape(-1, 6), axis=0)
         wavelength_mean = np.mean(wavelength_mean_set)
         ms_template = crystal.symmetry(
@@ -1004,20 +1040,14 @@ class intensities_scaler(object):
         wavelength_all_sort = wavelength_all.select(perm)
         sin_all_sort = sin_all.select(perm)
         SE_all_sort = SE_all.select(perm)
-        pickle_filename_all_sort = pickle_filename_all.select(perm)
+        frame_id_all_sort = frame_id_all.select(perm)
         ma_uniq = (
             ma_all.merge_equivalents()
             .array()
             .complete_array(d_min=iparams.merge.d_min, d_max=iparams.merge.d_max)
         )
-        matches_uniq = miller.match_multi_indices(
-            miller_indices_unique=ma_uniq.indices(), miller_indices=mi_all_sort
-        )
-        pair_0 = flex.int([pair[0] for pair in matches_uniq.pairs()])
-        pair_1 = flex.int([pair[1] for pair in matches_uniq.pairs()])
-        group_id_list = flex.int(
-            [pair_0[pair_1[i]] for i in range(len(matches_uniq.pairs()))]
-        )
+        pair_0, pair_1 = miller_index_lookup(ma_uniq.indices()).lookup(mi_all_sort)
+        group_id_list = flex.int(pair_0[pair_1].tolist())
         tally = Counter()
         for elem in group_id_list:
             tally[elem] += 1
@@ -1038,6 +1068,7 @@ class intensities_scaler(object):
             SE_all_sort,
             uc_mean,
             wavelength_mean,
-            pickle_filename_all_sort,
+            frame_id_all_sort,
+            frame_files_all,
             "",
         )
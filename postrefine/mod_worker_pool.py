@@ -0,0 +1,130 @@
+"""
+Description : Long-lived worker processes for prime.postrefine.
+
+Each worker owns a fixed shard of the frames for the whole run. Prepared
+observations stay in the input cache of the worker and the last
+postref_results of each frame stay with the worker, so a post-refinement
+cycle only sends the reference set and the parameters to each worker once
+instead of pickling them into a task per frame.
+"""
+from __future__ import absolute_import, division, print_function
+import multiprocessing, traceback
+from six.moves import range
+from six.moves import zip
+
+
+def _worker_main(conn, frames, frame_files):
+    from .postrefine import postref_handler
+    from .mod_input_cache import set_input_cache
+
+    prh = postref_handler()
+    pres_set = dict((frame_no, None) for frame_no in frames)
+    flag_input_cache = False
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        task_name, iparams, task_args = task
+        try:
+            if not flag_input_cache:
+                set_input_cache(iparams)
+                flag_input_cache = True
+            if task_name == "mean_I":
+                (avg_mode,) = task_args
+                frame_results = [
+                    prh.calc_mean_intensity(frame_file, iparams, avg_mode)
+                    for frame_file in frame_files
+                ]
+            elif task_name == "scale":
+                # the whole shard at once
+                mean_of_mean_I, avg_mode = task_args
+                frame_results = prh.scale_frames_by_mean_I(
+                    frames, frame_files, iparams, mean_of_mean_I, avg_mode
+                )
+            elif task_name == "postrefine":
+                miller_array_ref, avg_mode, skip_modes = task_args
+                frame_results = prh.postrefine_frames(
+                    frames,
+                    frame_files,
+                    iparams,
+                    miller_array_ref,
+                    [pres_set[frame_no] for frame_no in frames],
+                    avg_mode,
+                    skip_modes=[skip_modes.get(frame_no) for frame_no in frames],
+                )
+                for frame_no, result in zip(frames, frame_results):
+                    pres_set[frame_no] = result[0] if result is not None else None
+            results = list(zip(frames, frame_results))
+            conn.send(("ok", results))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+    conn.close()
+
+
+class frame_worker_pool(object):
+    """Pool of n_processors worker processes, frame i is handled by worker
+    i % n_processors in all stages and cycles."""
+
+    def __init__(self, frames, frame_files, n_processors):
+        self.n_frames = len(frame_files)
+        n_workers = max(1, min(n_processors, self.n_frames))
+        self.connections = []
+        self.workers = []
+        for i_worker in range(n_workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_worker_main,
+                args=(
+                    worker_conn,
+                    list(frames)[i_worker::n_workers],
+                    frame_files[i_worker::n_workers],
+                ),
+            )
+            worker.daemon = True
+            worker.start()
+            self.connections.append(conn)
+            self.workers.append(worker)
+        self.frame_positions = dict((frame_no, i) for i, frame_no in enumerate(frames))
+
+    def run_task(self, task_name, iparams, *task_args):
+        """Run task on all frames and return results in the order of frames."""
+        for conn in self.connections:
+            conn.send((task_name, iparams, task_args))
+        results = [None] * self.n_frames
+        errors = []
+        for conn in self.connections:
+            status, worker_results = conn.recv()
+            if status == "error":
+                errors.append(worker_results)
+                continue
+            for frame_no, result in worker_results:
+                results[self.frame_positions[frame_no]] = result
+        if errors:
+            raise RuntimeError("Worker process failed:\n" + "\n".join(errors))
+        return results
+
+    def calc_mean_intensity(self, iparams, avg_mode):
+        return self.run_task("mean_I", iparams, avg_mode)
+
+    def scale_frame_by_mean_I(self, iparams, mean_of_mean_I, avg_mode):
+        return self.run_task("scale", iparams, mean_of_mean_I, avg_mode)
+
+    def postrefine_by_frame(self, iparams, miller_array_ref, avg_mode, skip_modes=None):
+        """Post-refine all frames starting from the results of the previous
+        cycle kept by the workers (skip_modes: frame_no -> skip mode of the
+        frames that are not refined)."""
+        if skip_modes is None:
+            skip_modes = {}
+        return self.run_task(
+            "postrefine", iparams, miller_array_ref, avg_mode, skip_modes
+        )
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.connections, self.workers = [], []
@@ -11,7 +11,15 @@ from .mod_partiality import partiality_handler
 from .mod_lbfgs_partiality import lbfgs_partiality_handler
 from .mod_mx import mx_handler
 import math, os
+import numpy as np
 from .mod_input import read_frame
+from .mod_input_cache import get_input_cache, get_target_anomalous_flag
+from .mod_hkl import (
+    get_rejection_selection,
+    miller_index_lookup,
+    miller_indices_as_numpy,
+)
+from .mod_reference import reference_handler
 from six.moves import range
 from six.moves import zip
 
@@ -42,13 +50,7 @@ class postref_handler(object):
                     "Identified isoform(%s) is not the requested isoform (%s)"
                     % (observations_pickle["identified_isoform"], iparams.isoform_name),
                 )
-        if iparams.flag_weak_anomalous:
-            if avg_mode == "final":
-                target_anomalous_flag = iparams.target_anomalous_flag
-            else:
-                target_anomalous_flag = False
-        else:
-            target_anomalous_flag = iparams.target_anomalous_flag
+        target_anomalous_flag = get_target_anomalous_flag(iparams, avg_mode)
         img_filename_only = ""
         if pickle_filename:
             img_filename_only = os.path.basename(pickle_filename)
@@ -212,16 +214,11 @@ class postref_handler(object):
         # remove observations from rejection list
         if iparams.rejections:
             if pickle_filename in iparams.rejections:
-                miller_indices_ori_rejected = iparams.rejections[pickle_filename]
-                i_sel_flag = flex.bool([True] * len(observations.data()))
-                cnrej = 0
-                for miller_index_ori_rejected in miller_indices_ori_rejected:
-                    for i_index_ori, miller_index_ori in enumerate(
-                        observations.indices()
-                    ):
-                        if miller_index_ori_rejected == miller_index_ori:
-                            i_sel_flag[i_index_ori] = False
-                            cnrej += 1
+                i_sel_flag = flex.bool(
+                    get_rejection_selection(
+                        observations.indices(), iparams.rejections[pickle_filename]
+                    ).tolist()
+                )
                 observations = observations.customized_copy(
                     indices=observations.indices().select(i_sel_flag),
                     data=observations.data().select(i_sel_flag),
@@ -293,6 +290,25 @@ class postref_handler(object):
         )
         return inputs, "OK"
 
+    def read_input(self, pickle_filename, iparams, avg_mode):
+        """Read the frame and return organize_input results. If the input
+        cache is on, results are looked up (and stored) there first."""
+        input_cache = get_input_cache(iparams)
+        if input_cache is not None:
+            cache_key = input_cache.get_key(pickle_filename, iparams, avg_mode)
+            cached_result = input_cache.get(cache_key)
+            if cached_result is not None:
+                return cached_result
+        observations_pickle = read_frame(pickle_filename)
+        if observations_pickle is None:
+            return None, "empty or bad input file"
+        result = self.organize_input(
+            observations_pickle, iparams, avg_mode, pickle_filename=pickle_filename
+        )
+        if input_cache is not None:
+            input_cache.put(cache_key, result)
+        return result
+
     def get_observations_non_polar(
         self, observations_original, pickle_filename, iparams
     ):
@@ -311,19 +327,174 @@ class postref_handler(object):
         return observations_alt, ind_pickle[pickle_filename]
 
     def postrefine_by_frame(
-        self, frame_no, pickle_filename, iparams, miller_array_ref, pres_in, avg_mode
+        self,
+        frame_no,
+        pickle_filename,
+        iparams,
+        miller_array_ref,
+        pres_in,
+        avg_mode,
+        skip_mode=None,
+    ):
+        return self.postrefine_frames(
+            [frame_no],
+            [pickle_filename],
+            iparams,
+            miller_array_ref,
+            [pres_in],
+            avg_mode,
+            skip_modes=[skip_mode],
+        )[0]
+
+    def postrefine_frames(
+        self,
+        frame_nos,
+        pickle_filenames,
+        iparams,
+        miller_array_ref,
+        pres_in_set,
+        avg_mode,
+        skip_modes=None,
+    ):
+        """Post-refine frames (a shard of the frames of the run) starting from
+        pres_in_set and return a (pres, txt_out) of each frame. Initial
+        partialities of the frames without post-refinement results are
+        evaluated in one partiality_handler.calc_partiality_batch call.
+        Frames with a skip mode (see mod_convergence) are not refined, their
+        results in pres_in_set are reused or refreshed."""
+        lsqrh = leastsqr_handler()
+        results = [None] * len(frame_nos)
+        frames_in = []
+        if skip_modes is None:
+            skip_modes = [None] * len(frame_nos)
+        for i_frame, (pickle_filename, pres_in) in enumerate(
+            zip(pickle_filenames, pres_in_set)
+        ):
+            if skip_modes[i_frame] == "reuse":
+                results[i_frame] = self.reuse_postrefine_frame(pickle_filename, pres_in)
+                continue
+            elif skip_modes[i_frame] == "refresh":
+                results[i_frame] = self.refresh_postrefine_frame(
+                    frame_nos[i_frame], pickle_filename, iparams, pres_in, avg_mode
+                )
+                continue
+            frame_in, txt_exception = self.prepare_postrefine_frame(
+                pickle_filename, iparams, miller_array_ref, avg_mode
+            )
+            if frame_in is None:
+                results[i_frame] = (None, txt_exception)
+                continue
+            I_ref_sel, observations_original_sel, wavelength, crystal_init_orientation, alpha_angle_set, spot_pred_x_mm_set, spot_pred_y_mm_set, observations_non_polar_sel, detector_distance_mm = (
+                frame_in
+            )
+            try:
+                context = lsqrh.get_refinement_context(
+                    I_ref_sel,
+                    observations_original_sel,
+                    wavelength,
+                    crystal_init_orientation,
+                    alpha_angle_set,
+                    spot_pred_x_mm_set,
+                    spot_pred_y_mm_set,
+                    iparams,
+                    pres_in,
+                    detector_distance_mm,
+                )
+            except Exception:
+                txt_exception += "optimization failed.\n"
+                results[i_frame] = (None, txt_exception)
+                continue
+            frames_in.append((i_frame, frame_in, context, txt_exception))
+        lsqrh.calc_partiality_init_batch(
+            [
+                context
+                for i_frame, frame_in, context, txt_exception in frames_in
+                if pres_in_set[i_frame] is None
+            ]
+        )
+        for i_frame, frame_in, context, txt_exception in frames_in:
+            I_ref_sel, observations_original_sel, wavelength, crystal_init_orientation, alpha_angle_set, spot_pred_x_mm_set, spot_pred_y_mm_set, observations_non_polar_sel, detector_distance_mm = (
+                frame_in
+            )
+            pres_in = pres_in_set[i_frame]
+            # 4. Do least-squares refinement
+            try:
+                refined_params, stats, n_refl_postrefined = lsqrh.optimize(
+                    I_ref_sel,
+                    observations_original_sel,
+                    wavelength,
+                    crystal_init_orientation,
+                    alpha_angle_set,
+                    spot_pred_x_mm_set,
+                    spot_pred_y_mm_set,
+                    iparams,
+                    pres_in,
+                    observations_non_polar_sel,
+                    detector_distance_mm,
+                    context=context,
+                )
+            except Exception:
+                txt_exception += "optimization failed.\n"
+                results[i_frame] = (None, txt_exception)
+                continue
+            results[i_frame] = self.finish_postrefine_frame(
+                frame_nos[i_frame],
+                pickle_filenames[i_frame],
+                iparams,
+                pres_in,
+                avg_mode,
+                refined_params,
+                stats,
+                (lsqrh.n_iterations, lsqrh.n_calls),
+            )
+        return results
+
+    def reuse_postrefine_frame(self, pickle_filename, pres_in):
+        """Return pres_in (converged in the previous cycle) as the result of
+        the frame."""
+        pickle_filepaths = pickle_filename.split("/")
+        img_filename_only = pickle_filepaths[len(pickle_filepaths) - 1]
+        txt_postref = "{0:40} => skipped (converged)".format(img_filename_only)
+        print(txt_postref)
+        txt_postref += "\n"
+        return pres_in, txt_postref
+
+    def refresh_postrefine_frame(
+        self, frame_no, pickle_filename, iparams, pres_in, avg_mode
     ):
+        """Return the result of a frame that converged in the previous cycle
+        with its observations and partialities recomputed from the refined
+        parameters of pres_in."""
+        refined_params = flex.double(pres_in.refined_params)
+        # pres_in.crystal_orientation is already rotated
+        refined_params[2] = 0
+        refined_params[3] = 0
+        stats = (
+            pres_in.SE,
+            pres_in.R_sq,
+            pres_in.CC_init,
+            pres_in.CC_final,
+            pres_in.R_init,
+            pres_in.R_final,
+            pres_in.R_xy_init,
+            pres_in.R_xy_final,
+            pres_in.CC_iso_init,
+            pres_in.CC_iso_final,
+        )
+        return self.finish_postrefine_frame(
+            frame_no, pickle_filename, iparams, pres_in, avg_mode, refined_params, stats
+        )
+
+    def prepare_postrefine_frame(
+        self, pickle_filename, iparams, miller_array_ref, avg_mode
+    ):
+        """Read the frame and return the reflections matched with the
+        reference set (see leastsqr_handler.optimize)."""
         # 1. Prepare data
-        observations_pickle = read_frame(pickle_filename)
         pickle_filepaths = pickle_filename.split("/")
         img_filename_only = pickle_filepaths[len(pickle_filepaths) - 1]
         txt_exception = " {0:40} ==> ".format(img_filename_only)
-        if observations_pickle is None:
-            txt_exception += "empty or bad input file\n"
-            return None, txt_exception
-        inputs, txt_organize_input = self.organize_input(
-            observations_pickle, iparams, avg_mode, pickle_filename=pickle_filename
-        )
+        inputs, txt_organize_input = self.read_input(pickle_filename, iparams, avg_mode)
         if inputs is not None:
             observations_original, alpha_angle, spot_pred_x_mm, spot_pred_y_mm, detector_distance_mm, wavelength, crystal_init_orientation = (
                 inputs
@@ -335,44 +506,54 @@ class postref_handler(object):
         observations_non_polar, index_basis_name = self.get_observations_non_polar(
             observations_original, pickle_filename, iparams
         )
-        matches = miller.match_multi_indices(
-            miller_indices_unique=miller_array_ref.indices(),
-            miller_indices=observations_non_polar.indices(),
-        )
-        pair_0 = flex.size_t([pair[0] for pair in matches.pairs()])
-        pair_1 = flex.size_t([pair[1] for pair in matches.pairs()])
-        references_sel = miller_array_ref.select(pair_0)
+        if isinstance(miller_array_ref, reference_handler):
+            i_ref, i_obs = miller_array_ref.match(observations_non_polar.indices())
+            pair_1 = flex.size_t(i_obs.tolist())
+            I_ref_sel = flex.double(np.ascontiguousarray(miller_array_ref.I[i_ref]))
+        else:
+            i_ref, i_obs = miller_index_lookup(miller_array_ref.indices()).lookup(
+                observations_non_polar.indices()
+            )
+            pair_1 = flex.size_t(i_obs.tolist())
+            I_ref_sel = miller_array_ref.select(flex.size_t(i_ref.tolist())).data()
         observations_original_sel = observations_original.select(pair_1)
         observations_non_polar_sel = observations_non_polar.select(pair_1)
         alpha_angle_set = alpha_angle.select(pair_1)
         spot_pred_x_mm_set = spot_pred_x_mm.select(pair_1)
         spot_pred_y_mm_set = spot_pred_y_mm.select(pair_1)
-        # 4. Do least-squares refinement
-        lsqrh = leastsqr_handler()
-        try:
-            refined_params, stats, n_refl_postrefined = lsqrh.optimize(
-                references_sel.data(),
-                observations_original_sel,
-                wavelength,
-                crystal_init_orientation,
-                alpha_angle_set,
-                spot_pred_x_mm_set,
-                spot_pred_y_mm_set,
-                iparams,
-                pres_in,
-                observations_non_polar_sel,
-                detector_distance_mm,
-            )
-        except Exception:
-            txt_exception += "optimization failed.\n"
-            return None, txt_exception
+        frame_in = (
+            I_ref_sel,
+            observations_original_sel,
+            wavelength,
+            crystal_init_orientation,
+            alpha_angle_set,
+            spot_pred_x_mm_set,
+            spot_pred_y_mm_set,
+            observations_non_polar_sel,
+            detector_distance_mm,
+        )
+        return frame_in, txt_exception
+
+    def finish_postrefine_frame(
+        self,
+        frame_no,
+        pickle_filename,
+        iparams,
+        pres_in,
+        avg_mode,
+        refined_params,
+        stats,
+        solver_counts=None,
+    ):
+        """Return (pres, txt_out) of a frame from its refined parameters.
+        solver_counts are the iterations and function calls of the solver."""
+        pickle_filepaths = pickle_filename.split("/")
+        img_filename_only = pickle_filepaths[len(pickle_filepaths) - 1]
         # caculate partiality for output (with target_anomalous check)
         G_fin, B_fin, rotx_fin, roty_fin, ry_fin, rz_fin, r0_fin, re_fin, voigt_nu_fin, a_fin, b_fin, c_fin, alpha_fin, beta_fin, gamma_fin = (
             refined_params
         )
-        inputs, txt_organize_input = self.organize_input(
-            observations_pickle, iparams, avg_mode, pickle_filename=pickle_filename
-        )
+        inputs, txt_organize_input = self.read_input(pickle_filename, iparams, avg_mode)
         observations_original, alpha_angle, spot_pred_x_mm, spot_pred_y_mm, detector_distance_mm, wavelength, crystal_init_orientation = (
             inputs
         )
@@ -464,22 +645,18 @@ class postref_handler(object):
             beta_fin,
             gamma_fin,
         )
+        if solver_counts is not None:
+            txt_postref += " ITER:{0:4d} NFUN:{1:5d}".format(*solver_counts)
         print(txt_postref)
         txt_postref += "\n"
         return pres, txt_postref
 
     def calc_mean_intensity(self, pickle_filename, iparams, avg_mode):
-        observations_pickle = read_frame(pickle_filename)
         pickle_filepaths = pickle_filename.split("/")
         txt_exception = " {0:40} ==> ".format(
             pickle_filepaths[len(pickle_filepaths) - 1]
         )
-        if observations_pickle is None:
-            txt_exception += "empty or bad input file\n"
-            return None, txt_exception
-        inputs, txt_organize_input = self.organize_input(
-            observations_pickle, iparams, avg_mode, pickle_filename=pickle_filename
-        )
+        inputs, txt_organize_input = self.read_input(pickle_filename, iparams, avg_mode)
         if inputs is not None:
             observations_original, alpha_angle_obs, spot_pred_x_mm, spot_pred_y_mm, detector_distance_mm, wavelength, crystal_init_orientation = (
                 inputs
@@ -503,16 +680,87 @@ class postref_handler(object):
     def scale_frame_by_mean_I(
         self, frame_no, pickle_filename, iparams, mean_of_mean_I, avg_mode
     ):
-        observations_pickle = read_frame(pickle_filename)
+        return self.scale_frames_by_mean_I(
+            [frame_no], [pickle_filename], iparams, mean_of_mean_I, avg_mode
+        )[0]
+
+    def scale_frames_by_mean_I(
+        self, frame_nos, pickle_filenames, iparams, mean_of_mean_I, avg_mode
+    ):
+        """Scale frames (a shard of the frames of the run) and return a
+        (pres, txt_out) of each frame. Initial partialities of all frames are
+        evaluated in one partiality_handler.calc_partiality_batch call."""
+        ph = partiality_handler()
+        results = [None] * len(frame_nos)
+        frames_in = []
+        for i_frame, (frame_no, pickle_filename) in enumerate(
+            zip(frame_nos, pickle_filenames)
+        ):
+            frame_in, txt_exception = self.prepare_scale_frame(
+                frame_no, pickle_filename, iparams, mean_of_mean_I, avg_mode
+            )
+            if frame_in is None:
+                results[i_frame] = (None, txt_exception)
+            else:
+                frames_in.append((i_frame, frame_in))
+        if not frames_in:
+            return results
+        A_star_set = []
+        frame_params = []
+        miller_indices_set = []
+        two_theta_set = []
+        alpha_angle_set = []
+        offsets = [0]
+        for i_frame, frame_in in frames_in:
+            frame_no, pickle_filename, observations_original, alpha_angle, two_theta, wavelength, crystal_init_orientation, frame_params_init = frame_in[
+                :8
+            ]
+            rotx, roty, ry, rz, r0, re, voigt_nu = frame_params_init
+            A_star = ph.calc_reciprocal_matrix(
+                crystal_init_orientation.unit_cell(),
+                rotx,
+                roty,
+                crystal_init_orientation,
+            )
+            A_star_set.append(A_star.elems)
+            frame_params.append((ry, rz, r0, re, voigt_nu, wavelength))
+            miller_indices_set.append(
+                miller_indices_as_numpy(observations_original.indices())
+            )
+            two_theta_set.append(two_theta.as_numpy_array())
+            alpha_angle_set.append(alpha_angle.as_numpy_array())
+            offsets.append(offsets[-1] + len(two_theta))
+        partiality_set, rs_set, rh_set = ph.calc_partiality_batch(
+            A_star_set,
+            np.concatenate(miller_indices_set),
+            offsets,
+            frame_params,
+            np.concatenate(two_theta_set),
+            np.concatenate(alpha_angle_set),
+            iparams.partiality_model,
+            iparams.flag_beam_divergence,
+        )
+        for (i_frame, frame_in), i_st, i_en in zip(
+            frames_in, offsets[:-1], offsets[1:]
+        ):
+            results[i_frame] = self.finish_scale_frame(
+                frame_in,
+                flex.double(partiality_set[i_st:i_en]),
+                flex.double(rs_set[i_st:i_en]),
+                flex.double(rh_set[i_st:i_en]),
+                iparams,
+            )
+        return results
+
+    def prepare_scale_frame(
+        self, frame_no, pickle_filename, iparams, mean_of_mean_I, avg_mode
+    ):
+        """Read the frame and return its initial scale factors and parameters
+        (see finish_scale_frame)."""
         pickle_filepaths = pickle_filename.split("/")
         img_filename_only = pickle_filepaths[len(pickle_filepaths) - 1]
         txt_exception = " {0:40} ==> ".format(img_filename_only)
-        if observations_pickle is None:
-            txt_exception += "empty or bad input file\n"
-            return None, txt_exception
-        inputs, txt_organize_input = self.organize_input(
-            observations_pickle, iparams, avg_mode, pickle_filename=pickle_filename
-        )
+        inputs, txt_organize_input = self.read_input(pickle_filename, iparams, avg_mode)
         if inputs is not None:
             observations_original, alpha_angle, spot_pred_x_mm, spot_pred_y_mm, detector_distance_mm, wavelength, crystal_init_orientation = (
                 inputs
@@ -543,7 +791,6 @@ class postref_handler(object):
         observations_non_polar, index_basis_name = self.get_observations_non_polar(
             observations_original, pickle_filename, iparams
         )
-        uc_params = observations_original.unit_cell().parameters()
         ph = partiality_handler()
         r0 = ph.calc_spot_radius(
             sqr(crystal_init_orientation.reciprocal_matrix()),
@@ -583,26 +830,35 @@ class postref_handler(object):
             0,
             0,
         )
-        partiality_init, delta_xy_init, rs_init, rh_init = ph.calc_partiality_anisotropy_set(
-            crystal_init_orientation.unit_cell(),
-            rotx,
-            roty,
-            observations_original.indices(),
-            ry,
-            rz,
-            r0,
-            re,
-            voigt_nu,
-            two_theta,
+        frame_in = (
+            frame_no,
+            pickle_filename,
+            observations_original,
             alpha_angle,
+            two_theta,
             wavelength,
             crystal_init_orientation,
-            spot_pred_x_mm,
-            spot_pred_y_mm,
+            (rotx, roty, ry, rz, r0, re, voigt_nu),
+            observations_non_polar,
+            observations_original_sel,
             detector_distance_mm,
-            iparams.partiality_model,
-            iparams.flag_beam_divergence,
+            index_basis_name,
+            G,
+            B,
+            stats,
+        )
+        return frame_in, txt_exception
+
+    def finish_scale_frame(self, frame_in, partiality_init, rs_init, rh_init, iparams):
+        """Return (pres, txt_out) of a frame from prepare_scale_frame and its
+        initial partiality, rs and rh."""
+        frame_no, pickle_filename, observations_original, alpha_angle, two_theta, wavelength, crystal_init_orientation, frame_params_init, observations_non_polar, observations_original_sel, detector_distance_mm, index_basis_name, G, B, stats = (
+            frame_in
         )
+        rotx, roty, ry, rz, r0, re, voigt_nu = frame_params_init
+        pickle_filepaths = pickle_filename.split("/")
+        img_filename_only = pickle_filepaths[len(pickle_filepaths) - 1]
+        uc_params = observations_original.unit_cell().parameters()
         if iparams.flag_plot_expert:
             n_bins = 20
             binner = observations_original.setup_binner(n_bins=n_bins)
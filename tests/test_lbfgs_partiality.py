@@ -0,0 +1,159 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+
+pytest.importorskip("cctbx")
+
+from cctbx import crystal, miller
+from cctbx.array_family import flex
+from cctbx.crystal_orientation import crystal_orientation, basis_type
+from scitbx.matrix import col, sqr
+from prime.postrefine.mod_input import master_phil
+from prime.postrefine.mod_lbfgs_partiality import (
+    lbfgs_partiality_handler,
+    refinement_context,
+)
+
+WAVELENGTH = 1.0
+DETECTOR_DISTANCE_MM = 100.0
+# G, B, rotx, roty, ry, rz, r0, re of the test frame
+G, B = (1.2, 5.0)
+ROTX, ROTY = (1.0e-3, -2.0e-3)
+RY, RZ, R0, RE = (2.0e-3, 1.0e-3, 3.0e-3, 1.0e-3)
+NU = {"Lorentzian": 0.5, "Voigt": 0.5, "Lognormal": 0.008}
+# indices of ry, rz, r0, re and nu in the refined params of each mode
+RS_PARAMS = {
+    "scale_factor": (),
+    "crystal_orientation": (),
+    "reflecting_range": (0, 1, 2, 3, 4),
+    "unit_cell": (),
+    "allparams": (2, 3, 4, 5, 6),
+}
+
+
+def get_context(partiality_model, flag_beam_divergence, n_refl=100):
+    """Return refinement_context of a synthetic tetragonal frame with the
+    n_refl reflections closest to the Ewald sphere."""
+    iparams = master_phil.extract()
+    iparams.partiality_model = partiality_model
+    iparams.flag_beam_divergence = flag_beam_divergence
+    symmetry = crystal.symmetry(
+        unit_cell=(79, 79, 38, 90, 90, 90), space_group_symbol="P43212"
+    )
+    # all symmetry mates, so that many reflections lie close to the sphere
+    miller_set = miller.set(
+        symmetry,
+        symmetry.build_miller_set(anomalous_flag=True, d_min=2.5)
+        .expand_to_p1()
+        .indices(),
+        anomalous_flag=True,
+    )
+    orientation = crystal_orientation(
+        sqr(symmetry.unit_cell().orthogonalization_matrix()).transpose(),
+        basis_type.direct,
+    )
+    orientation = orientation.rotate_thru((1, 0, 0), 0.4).rotate_thru((0, 1, 0), 0.3)
+    S0 = -1 * col((0, 0, 1.0 / WAVELENGTH))
+    sd_array = (
+        sqr(orientation.reciprocal_matrix()).elems
+        * miller_set.indices().as_vec3_double()
+        + S0.elems
+    )
+    rh = np.abs(sd_array.norms().as_numpy_array() - (1 / WAVELENGTH))
+    sd_z = sd_array.parts()[2].as_numpy_array()
+    rh[sd_z > -0.5 / WAVELENGTH] = np.inf
+    i_sel = np.argsort(rh)[:n_refl]
+    miller_set = miller_set.select(flex.size_t(i_sel.tolist()))
+    sd_x, sd_y, sd_z = sd_array.select(flex.size_t(i_sel.tolist())).parts()
+    d_ratio = -DETECTOR_DISTANCE_MM / sd_z
+    random_state = np.random.RandomState(0)
+    I_r = flex.double(random_state.uniform(100, 1000, n_refl))
+    I_o = flex.double(random_state.uniform(10, 500, n_refl))
+    miller_array_o = miller_set.array(data=I_o, sigmas=flex.sqrt(I_o) + 1)
+    return refinement_context(
+        I_r,
+        miller_array_o,
+        WAVELENGTH,
+        flex.double(random_state.uniform(0, 2 * np.pi, n_refl)),
+        orientation,
+        sd_x * d_ratio + flex.double(random_state.normal(0, 0.05, n_refl)),
+        sd_y * d_ratio + flex.double(random_state.normal(0, 0.05, n_refl)),
+        DETECTOR_DISTANCE_MM,
+        iparams,
+    )
+
+
+def get_params(context, refine_mode):
+    """Return (refined params, const_params) of refine_mode."""
+    nu = NU[context.iparams.partiality_model]
+    cell = tuple(context.miller_array_o.unit_cell().parameters())
+    cell_params = tuple(lbfgs_partiality_handler().prep_input(cell, context.cs))
+    if refine_mode == "scale_factor":
+        return (G, B), (ROTX, ROTY, RY, RZ, R0, RE, nu) + cell
+    elif refine_mode == "crystal_orientation":
+        return (ROTX, ROTY), (G, B, RY, RZ, R0, RE, nu) + cell
+    elif refine_mode == "reflecting_range":
+        return (RY, RZ, R0, RE, nu), (G, B, ROTX, ROTY) + cell
+    elif refine_mode == "unit_cell":
+        return cell_params, (G, B, ROTX, ROTY, RY, RZ, R0, RE, nu)
+    elif refine_mode == "allparams":
+        return (ROTX, ROTY, RY, RZ, R0, RE, nu) + cell_params, (G, B)
+
+
+def calc_jacobian_fd(lph, params, context, flag_central=True):
+    """Return derivatives of func by central (step relative to each
+    parameter) or forward (step 1e-7, as lbfgs_handler) differences."""
+    jacobian = []
+    for i in range(len(params)):
+        params_plus = list(params)
+        params_minus = list(params)
+        if flag_central:
+            delta = 1.0e-6 * max(abs(params[i]), 1.0e-2)
+            params_plus[i] += delta
+            params_minus[i] -= delta
+            width = 2 * delta
+        else:
+            delta = 1.0e-7
+            params_plus[i] += delta
+            width = delta
+        f_plus = lph.func(flex.double(params_plus), context)
+        f_minus = lph.func(flex.double(params_minus), context)
+        jacobian.append((f_plus - f_minus).as_numpy_array() / width)
+    return jacobian
+
+
+@pytest.mark.parametrize("flag_beam_divergence", [False, True])
+@pytest.mark.parametrize("partiality_model", ["Lorentzian", "Voigt", "Lognormal"])
+@pytest.mark.parametrize(
+    "refine_mode",
+    [
+        "scale_factor",
+        "crystal_orientation",
+        "reflecting_range",
+        "unit_cell",
+        "allparams",
+    ],
+)
+def test_func_and_jacobian(refine_mode, partiality_model, flag_beam_divergence):
+    context = get_context(partiality_model, flag_beam_divergence)
+    params, const_params = get_params(context, refine_mode)
+    context = context.for_mode(refine_mode, const_params, B)
+    lph = lbfgs_partiality_handler()
+    params = flex.double(params)
+    error, jacobian = lph.func_and_jacobian(params, context)
+    assert np.allclose(
+        error.as_numpy_array(), lph.func(params, context).as_numpy_array()
+    )
+    assert len(jacobian) == len(params)
+    jacobian_fd = calc_jacobian_fd(lph, params, context)
+    jacobian_fd_forward = calc_jacobian_fd(lph, params, context, flag_central=False)
+    for i, (dfvec, dfvec_fd) in enumerate(zip(jacobian, jacobian_fd)):
+        if partiality_model == "Lognormal" and i in RS_PARAMS[refine_mode]:
+            # forward differences of func, as lbfgs_handler
+            assert np.allclose(
+                dfvec.as_numpy_array(), jacobian_fd_forward[i], rtol=1.0e-6, atol=1.0e-3
+            )
+        else:
+            assert np.abs(dfvec.as_numpy_array() - dfvec_fd).max() <= 1.0e-4 * max(
+                np.abs(dfvec_fd).max(), 1
+            )
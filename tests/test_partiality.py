@@ -0,0 +1,169 @@
+from __future__ import absolute_import, division, print_function
+import math
+import numpy as np
+import pytest
+
+pytest.importorskip("cctbx")
+
+from cctbx import crystal
+from cctbx.array_family import flex
+from cctbx.crystal_orientation import crystal_orientation, basis_type
+from scitbx.matrix import col, sqr
+from prime.postrefine.mod_partiality import (
+    get_nearest_grid_index,
+    get_partiality_kernel,
+    partiality_handler,
+)
+
+DETECTOR_DISTANCE_MM = 100.0
+# model, nu of the partiality models
+PARTIALITY_MODELS = [
+    ("Lorentzian", 0.5),
+    ("Voigt", 0.5),
+    ("Voigt", -0.2),
+    ("Voigt", 1.3),
+    ("Lognormal", 0.008),
+]
+
+
+def get_sigma_grid(zero):
+    """Return the FWHM grid searched by calc_lognpdf_array for nu = zero."""
+    sig_range = np.arange(50) / 100
+    t = sig_range * math.sqrt(math.log(4))
+    return zero * (np.exp(t) - np.exp(-1 * t))
+
+
+def get_nearest_grid_index_loop(grid, values):
+    """The per-reflection lookup that get_nearest_grid_index replaces."""
+    return np.array([np.argmin(np.abs(value - grid)) for value in values])
+
+
+@pytest.mark.parametrize("zero", [0, 0.001, 0.008, 0.05, 1])
+def test_get_nearest_grid_index(zero):
+    grid = get_sigma_grid(zero)
+    random_state = np.random.RandomState(0)
+    values = np.concatenate(
+        [
+            random_state.uniform(-0.1, 1.1, 1000) * max(grid.max(), 1.0e-3),
+            grid,
+            (grid[1:] + grid[:-1]) / 2,
+            [np.nan, np.inf, -np.inf, 0, -1],
+        ]
+    )
+    assert np.array_equal(
+        get_nearest_grid_index(grid, values), get_nearest_grid_index_loop(grid, values)
+    )
+
+
+def get_frame(cell, rotx, roty, wavelength, n_refl, seed=0):
+    """Return (A_star, miller_indices, bragg_angle_set, alpha_angle_set,
+    spot_pred_x_mm_set, spot_pred_y_mm_set) of a synthetic frame with the
+    n_refl reflections closest to the Ewald sphere."""
+    symmetry = crystal.symmetry(unit_cell=cell, space_group_symbol="P1")
+    miller_set = symmetry.build_miller_set(anomalous_flag=True, d_min=2.5)
+    orientation = crystal_orientation(
+        sqr(symmetry.unit_cell().orthogonalization_matrix()).transpose(),
+        basis_type.direct,
+    )
+    orientation = orientation.rotate_thru((1, 0, 0), rotx).rotate_thru((0, 1, 0), roty)
+    A_star = sqr(orientation.reciprocal_matrix())
+    S0 = -1 * col((0, 0, 1.0 / wavelength))
+    sd_array = A_star.elems * miller_set.indices().as_vec3_double() + S0.elems
+    rh = np.abs(sd_array.norms().as_numpy_array() - (1 / wavelength))
+    sd_z = sd_array.parts()[2].as_numpy_array()
+    rh[sd_z > -0.5 / wavelength] = np.inf
+    i_sel = flex.size_t(np.argsort(rh)[:n_refl].tolist())
+    miller_indices = miller_set.indices().select(i_sel)
+    sd_x, sd_y, sd_z = sd_array.select(i_sel).parts()
+    d_ratio = -DETECTOR_DISTANCE_MM / sd_z
+    random_state = np.random.RandomState(seed)
+    return (
+        A_star,
+        miller_indices,
+        flex.double(random_state.uniform(0.01, 0.5, n_refl)),
+        flex.double(random_state.uniform(0, 2 * np.pi, n_refl)),
+        sd_x * d_ratio + flex.double(random_state.normal(0, 0.05, n_refl)),
+        sd_y * d_ratio + flex.double(random_state.normal(0, 0.05, n_refl)),
+    )
+
+
+@pytest.mark.parametrize("flag_beam_divergence", [False, True])
+@pytest.mark.parametrize("partiality_model, nu", PARTIALITY_MODELS)
+def test_calc_partiality_set_kernel(partiality_model, nu, flag_beam_divergence):
+    kernel = get_partiality_kernel()
+    if kernel is None:
+        pytest.skip("prime extension not built")
+    wavelength = 1.0
+    A_star, miller_indices, bragg, alpha, x, y = get_frame(
+        (79, 79, 38, 90, 90, 90), 0.4, 0.3, wavelength, 200
+    )
+    # ry, rz, r0, re, nu, ..., partiality_model, flag_beam_divergence
+    args = (2.0e-3, 1.0e-3, 3.0e-3, 1.0e-3, nu, bragg, alpha, wavelength, x, y)
+    args += (DETECTOR_DISTANCE_MM, partiality_model, flag_beam_divergence)
+    result = kernel(flex.double(A_star.elems), miller_indices, *args)
+    result_py = partiality_handler().calc_partiality_set_py(
+        A_star, miller_indices, *args
+    )
+    # partiality, delta_xy, rs and rh
+    for values, values_py in zip(result, result_py):
+        assert np.allclose(
+            values.as_numpy_array(), values_py.as_numpy_array(), rtol=1.0e-9
+        )
+
+
+@pytest.mark.parametrize("flag_beam_divergence", [False, True])
+@pytest.mark.parametrize("partiality_model", ["Lorentzian", "Voigt", "Lognormal"])
+def test_calc_partiality_batch(partiality_model, flag_beam_divergence):
+    # cell, rotx, roty, wavelength, n_refl of each frame
+    frames = [
+        ((79, 79, 38, 90, 90, 90), 0.4, 0.3, 1.0, 120),
+        ((78.5, 79.2, 38.1, 90, 90, 90), -0.2, 0.7, 0.98, 40),
+        ((80, 80, 37.5, 90, 90, 90), 1.1, -0.5, 1.02, 75),
+    ]
+    # ry, rz, r0, re, nu of each frame
+    if partiality_model == "Lognormal":
+        nu_set = (0.008, 0.01, 0.008)
+    else:
+        nu_set = (0.5, -0.2, 1.3)
+    frame_params = [
+        (2.0e-3, 1.0e-3, 3.0e-3, 1.0e-3, nu_set[0]),
+        (1.0e-3, 2.5e-3, 2.0e-3, 4.0e-3, nu_set[1]),
+        (0, 1.5e-3, 5.0e-3, 0, nu_set[2]),
+    ]
+    ph = partiality_handler()
+    A_star_set = []
+    miller_indices = flex.miller_index()
+    bragg_angle_set = flex.double()
+    alpha_angle_set = flex.double()
+    offsets = [0]
+    results_py = []
+    for i_frame, (frame, params) in enumerate(zip(frames, frame_params)):
+        cell, rotx, roty, wavelength, n_refl = frame
+        A_star, hkl, bragg, alpha, x, y = get_frame(
+            cell, rotx, roty, wavelength, n_refl, seed=i_frame
+        )
+        A_star_set.append(A_star.elems)
+        miller_indices.extend(hkl)
+        bragg_angle_set.extend(bragg)
+        alpha_angle_set.extend(alpha)
+        offsets.append(offsets[-1] + n_refl)
+        args = params + (bragg, alpha, wavelength, x, y, DETECTOR_DISTANCE_MM)
+        args += (partiality_model, flag_beam_divergence)
+        partiality_set, _, rs_set, rh_set = ph.calc_partiality_set_py(
+            A_star, hkl, *args
+        )
+        results_py.append((partiality_set, rs_set, rh_set))
+    result = ph.calc_partiality_batch(
+        A_star_set,
+        miller_indices,
+        offsets,
+        [params + (frame[3],) for frame, params in zip(frames, frame_params)],
+        bragg_angle_set,
+        alpha_angle_set,
+        partiality_model,
+        flag_beam_divergence,
+    )
+    # partiality, rs and rh
+    for values, values_py in zip(result, zip(*results_py)):
+        values_py = np.concatenate([v.as_numpy_array() for v in values_py])
+        assert np.allclose(values, values_py, rtol=1.0e-9)